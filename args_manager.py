@@ -37,8 +37,56 @@ args_parser.parser.add_argument("--enable-auto-describe-image", action='store_tr
 args_parser.parser.add_argument("--always-download-new-model", action='store_true',
                                 help="Always download newer models", default=False)
 
+args_parser.parser.add_argument("--max-sampling-batch-size", type=int, default=8,
+                                help="Maximum number of images sampled together in one batch. "
+                                  "The actual batch size is also limited by free memory. Set to 1 to disable batching.")
+
+args_parser.parser.add_argument("--lora-cache-size", type=int, default=1024,
+                                help="RAM budget in MB for caching model weights merged with LoRAs. The merged weights of "
+                                     "a whole LoRA stack are cached as one entry and must fit, about 4 GB for the UNet of "
+                                     "SDXL with a stack patching all attention and feed forward layers. Set to 0 to disable.")
+args_parser.parser.add_argument("--lora-cache-disk-size", type=int, default=0,
+                                help="Disk budget in MB for merged LoRA weights, kept across restarts in the cache path.")
+
+args_parser.parser.add_argument("--model-pool-size", type=int, default=2,
+                                help="Number of checkpoints kept loaded in RAM for fast switching between them.")
+args_parser.parser.add_argument("--model-pool-memory", type=int, default=None,
+                                help="RAM budget in MB for the checkpoints kept loaded, by default only --model-pool-size applies.")
+
+args_parser.parser.add_argument("--clip-cache-size", type=int, default=256,
+                                help="RAM budget in MB for caching CLIP text conditionings. Set to 0 to disable.")
+args_parser.parser.add_argument("--clip-cache-disk-size", type=int, default=0,
+                                help="Disk budget in MB for CLIP text conditionings, kept across restarts in the cache path.")
+
+args_parser.parser.add_argument("--vae-tiled-single-pass", action='store_true',
+                                help="Tiled VAE encoding and decoding in one pass instead of averaging three passes "
+                                  "with different tile shapes. About three times faster, seams can be more visible.")
+
+args_parser.parser.add_argument("--sde-noise", type=str, default='torchsde', choices=['torchsde', 'device'],
+                                help="Brownian noise source of the SDE samplers. 'torchsde' reproduces the images of "
+                                  "earlier versions for the same seeds, 'device' samples on the GPU without torchsde.")
+
+args_parser.parser.add_argument("--debug-sync-points", action='store_true',
+                                help="Print the number of host-device synchronizations of every sampling step. CUDA only.")
+
+args_parser.parser.add_argument("--preview-interval", type=float, default=0.1,
+                                help="Minimum number of seconds between two sampling previews.")
+
+args_parser.parser.add_argument("--image-writer-threads", type=int, default=2,
+                                help="Number of background threads encoding and saving output images. "
+                                  "Set to 0 to save images on the worker thread.")
+args_parser.parser.add_argument("--image-writer-queue-size", type=int, default=8,
+                                help="Maximum number of output images waiting to be saved before the worker blocks.")
+
+args_parser.parser.add_argument("--api-port", type=int, default=None,
+                                help="Serve the HTTP generation API on this port, on the address given by --listen.")
+args_parser.parser.add_argument("--headless", action='store_true',
+                                help="Only serve the HTTP generation API, do not launch the Gradio UI. Requires --api-port.")
+
 args_parser.parser.add_argument("--rebuild-hash-cache", help="Generates missing model and LoRA hashes.",
                                 type=int, nargs="?", metavar="CPU_NUM_THREADS", const=-1)
+args_parser.parser.add_argument("--hash-cache-warm-up", help="Generates missing model and LoRA hashes in the background after startup.",
+                                type=int, nargs="?", metavar="NUM_THREADS", const=1)
 
 args_parser.parser.set_defaults(
     disable_cuda_malloc=True,
@@ -0,0 +1,109 @@
+"""
+Compares eager and streamed (positioned reads, one tensor at a time) checkpoint loading on the CPU.
+
+    python benchmarks/checkpoint_loading.py [--checkpoint model.safetensors] [--size small|sd15]
+
+Without --checkpoint a synthetic SD 1.5 style checkpoint with random weights is written to a temporary
+directory. Every mode is measured in a fresh process so that peak RSS is not shared between runs.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import setup_fooocus, rss_mb, max_rss_mb
+
+
+def write_synthetic_checkpoint(filename, size):
+    import torch
+    import safetensors.torch
+    import ldm_patched.modules.supported_models as supported_models
+    import ldm_patched.modules.sd1_clip as sd1_clip
+    from ldm_patched.ldm.models.autoencoder import AutoencoderKL
+
+    channel_mult, num_res_blocks = ([1, 2, 4, 4], 2) if size == 'sd15' else ([1, 2], 1)
+    unet_config = {
+        "use_checkpoint": False, "image_size": 32, "use_spatial_transformer": True, "legacy": False,
+        "adm_in_channels": None, "dtype": torch.float16, "in_channels": 4, "out_channels": 4,
+        "model_channels": 320, "num_res_blocks": [num_res_blocks] * len(channel_mult),
+        "transformer_depth": [1] * num_res_blocks * (len(channel_mult) - 1) + [0] * num_res_blocks,
+        "transformer_depth_output": [1] * (num_res_blocks + 1) * (len(channel_mult) - 1) + [0] * (num_res_blocks + 1),
+        "channel_mult": channel_mult, "transformer_depth_middle": 1, "use_linear_in_transformer": False,
+        "context_dim": 768, "use_temporal_resblock": False, "use_temporal_attention": False,
+    }
+    config = supported_models.SD15(unet_config)
+    config.unet_config.update(config.unet_extra_config)
+
+    sd = {}
+    unet = config.get_model({}).diffusion_model
+    sd.update({'model.diffusion_model.' + k: v.half() for k, v in unet.state_dict().items()})
+    del unet
+    clip = sd1_clip.SD1ClipModel(device='cpu')
+    sd.update({'cond_stage_model.' + k[len('clip_l.'):]: v.half() for k, v in clip.state_dict().items()})
+    del clip
+    ddconfig = {'double_z': True, 'z_channels': 4, 'resolution': 256, 'in_channels': 3, 'out_ch': 3, 'ch': 128,
+                'ch_mult': [1, 2, 4, 4], 'num_res_blocks': 2, 'attn_resolutions': [], 'dropout': 0.0}
+    vae = AutoencoderKL(ddconfig=ddconfig, embed_dim=4)
+    sd.update({'first_stage_model.' + k: v.half() for k, v in vae.state_dict().items()})
+    del vae
+    safetensors.torch.save_file({k: v.contiguous() for k, v in sd.items()}, filename)
+
+
+def run_child(checkpoint, mode):
+    setup_fooocus()
+    import ldm_patched.modules.utils
+    import ldm_patched.modules.sd
+
+    if mode == 'eager':
+        lazy_loader = ldm_patched.modules.utils.load_torch_file
+        ldm_patched.modules.utils.load_torch_file = lambda *args, **kwargs: lazy_loader(*args, **{**kwargs, 'lazy': False})
+
+    baseline_rss = rss_mb()
+    start_time = time.perf_counter()
+    unet, clip, vae, _, _ = ldm_patched.modules.sd.load_checkpoint_guess_config(checkpoint)
+    load_time = time.perf_counter() - start_time
+    print(json.dumps(dict(mode=mode, load_time=load_time, baseline_rss=baseline_rss,
+                          peak_rss=max_rss_mb(), final_rss=rss_mb())))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default=None)
+    parser.add_argument('--size', choices=['small', 'sd15'], default='small')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--child', choices=['eager', 'lazy'], default=None)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(args.checkpoint, args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        checkpoint = args.checkpoint
+        if checkpoint is None:
+            checkpoint = os.path.join(temp_dir, 'synthetic.safetensors')
+            write_in_child(checkpoint, args.size)
+        print(f'Checkpoint: {checkpoint} ({os.path.getsize(checkpoint) / (1024 * 1024):.0f} MB)')
+
+        for mode in ['eager', 'lazy']:
+            for _ in range(args.repeat):
+                output = subprocess.run([sys.executable, __file__, '--checkpoint', checkpoint, '--child', mode],
+                                        check=True, capture_output=True, text=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f'{mode:>5}: {result["load_time"]:6.2f} s, '
+                      f'peak RSS +{result["peak_rss"] - result["baseline_rss"]:6.0f} MB, '
+                      f'final RSS +{result["final_rss"] - result["baseline_rss"]:6.0f} MB')
+
+
+def write_in_child(checkpoint, size):
+    code = (f'import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); '
+            f'import checkpoint_loading as b; b.setup_fooocus(); b.write_synthetic_checkpoint({checkpoint!r}, {size!r})')
+    subprocess.run([sys.executable, '-c', code], check=True, capture_output=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import os
+import resource
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_fooocus(extra_args=()):
+    """Configures Fooocus for the CPU, must run before anything from the repository is imported."""
+    sys.argv = [sys.argv[0], '--always-cpu', '--disable-analytics', *extra_args]
+    sys.path.insert(0, root)
+    os.chdir(root)
+    import args_manager
+    import modules.patch
+    modules.patch.patch_all()
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
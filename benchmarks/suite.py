@@ -0,0 +1,285 @@
+"""
+Times the main code paths of a generation on the CPU with tiny randomly initialized SDXL models.
+
+    python benchmarks/suite.py [--filter ksampler] [--repeat 5] [--output results.json]
+    python benchmarks/suite.py --save-baseline
+    python benchmarks/suite.py --fail-on-regression
+
+Results are written as JSON to --output. When --baseline exists, the median time of every benchmark is compared
+with it and benchmarks slower or faster than --threshold are reported as regressions or improvements. Baselines
+are only meaningful on the machine they were recorded on, record one before starting a change. Both files are
+kept in benchmarks/ by default and ignored by git.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import root, setup_fooocus
+
+benchmark_samplers = ['euler', 'euler_ancestral', 'dpmpp_2m', 'dpmpp_2m_sde_gpu', 'dpmpp_3m_sde_gpu', 'uni_pc']
+benchmark_schedulers = ['normal', 'exponential', 'sgm_uniform']
+
+prompts = ['a photograph of an astronaut riding a horse',
+           'a watercolor painting of a lighthouse at dawn, soft light',
+           'a cat sitting on a windowsill, highly detailed, 8k',
+           'an isometric city block at night, neon signs, rain']
+
+
+def create_benchmarks(path):
+    """Returns a list of (name, run, prepare), prepare is called before every run and not timed."""
+    import numpy as np
+    import torch
+
+    import modules.anisotropic as anisotropic
+    import modules.config
+    import modules.core as core
+    import modules.inpaint_worker as inpaint_worker
+    import modules.patch
+    import modules.private_logger as private_logger
+    import modules.upscaler as upscaler
+    import tiny_models
+    from ldm_patched.modules.samplers import calculate_sigmas_scheduler
+
+    modules.patch.patch_settings[os.getpid()] = modules.patch.PatchSettings()
+    modules.config.path_vae_approx = os.path.join(path, 'vae_approx')
+    modules.config.path_outputs = os.path.join(path, 'outputs')
+    tiny_models.write_vae_approx(modules.config.path_vae_approx)
+
+    model = tiny_models.create_tiny_sdxl(path)
+    lora_filename = tiny_models.write_tiny_lora(model, os.path.join(path, 'tiny_lora.safetensors'))
+    model.refresh_loras([(lora_filename, 0.8)])
+
+    def clip_encode():
+        return [model.clip.encode_from_tokens(model.clip.tokenize(p), return_pooled=True) for p in prompts]
+
+    cond, pooled = clip_encode()[0]
+    positive = [[cond, {'pooled_output': pooled}]]
+    negative = [[torch.zeros_like(cond), {'pooled_output': torch.zeros_like(pooled)}]]
+    latent = core.generate_empty_latent(width=256, height=256, batch_size=1)
+    large_latent = {'samples': torch.randn(1, 4, 64, 64, generator=torch.Generator().manual_seed(0))}
+    large_pixels = torch.rand(1, 640, 640, 3, generator=torch.Generator().manual_seed(0))
+    # the sharpness filter runs on the eps and x0 of the positive prompt at every step, 128x128 is a 1024px image
+    eps = torch.randn(1, 4, 128, 128, generator=torch.Generator().manual_seed(1))
+    x0 = torch.randn(1, 4, 128, 128, generator=torch.Generator().manual_seed(2))
+
+    def sample(sampler_name, scheduler, noise='torchsde', deep_cache_interval=0):
+        def run():
+            # set up the shared Brownian noise like default_pipeline.process_diffusion does
+            sigmas = calculate_sigmas_scheduler(model.unet.model, scheduler, 8)
+            modules.patch.BrownianTreeNoiseSamplerPatched.global_init(
+                latent['samples'], float(sigmas[sigmas > 0].min()), float(sigmas.max()), seed=12345, cpu=False,
+                noise=noise)
+            modules.patch.patch_settings[os.getpid()].deep_cache_interval = deep_cache_interval
+            try:
+                return core.ksampler(model.unet, positive, negative, latent, seed=12345, steps=8, cfg=7.0,
+                                     sampler_name=sampler_name, scheduler=scheduler, disable_preview=True)
+            finally:
+                modules.patch.patch_settings[os.getpid()].deep_cache_interval = 0
+        return run
+
+    def brownian_noise(noise):
+        # the noise queries of 30 dpmpp_2m_sde steps for a batch of 4 1024px images
+        sigmas = calculate_sigmas_scheduler(model.unet.model, 'karras', 30).tolist()
+        x = torch.zeros(4, 4, 128, 128)
+
+        def run():
+            modules.patch.BrownianTreeNoiseSamplerPatched.global_init(
+                x, sigmas[-2], sigmas[0], seed=[12345 + i for i in range(4)], cpu=False, noise=noise)
+            noise_sampler = modules.patch.BrownianTreeNoiseSamplerPatched()
+            for sigma, sigma_next in zip(sigmas[:-2], sigmas[1:-1]):
+                noise_sampler(sigma, sigma_next)
+        return run
+
+    control_lora = core.load_controlnet(
+        tiny_models.write_tiny_control_lora(model, os.path.join(path, 'tiny_control_lora.safetensors')))
+    hint = torch.rand(1, 256, 256, 3, generator=torch.Generator().manual_seed(3))
+
+    def sample_control_lora():
+        # the softness of modules.patch expects the ten control outputs of SDXL
+        modules.patch.patch_settings[os.getpid()].controlnet_softness = 0.0
+        try:
+            controlled_positive, controlled_negative = core.apply_controlnet(positive, negative, control_lora, hint,
+                                                                             1.0, 0.0, 1.0)
+            return core.ksampler(model.unet, controlled_positive, controlled_negative, latent, seed=12345, steps=8,
+                                 cfg=7.0, sampler_name='euler', scheduler='karras', disable_preview=True)
+        finally:
+            modules.patch.patch_settings[os.getpid()].controlnet_softness = 0.25
+
+    def pre_run_control_lora():
+        control = control_lora.copy()
+        control.pre_run(model.unet.model, lambda percent: model.unet.model.model_sampling.percent_to_sigma(percent))
+        control.cleanup()
+
+    def reset_loras():
+        model.visited_loras = ''
+
+    def patch_model(weight_cache):
+        patcher = model.unet_with_lora
+
+        def run():
+            patcher.weight_cache = weight_cache
+            patcher.patch_model()
+            patcher.unpatch_model()
+        return run
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(1536, 1536, 3), dtype=np.uint8)
+    mask = np.zeros((1536, 1536), dtype=np.uint8)
+    mask[200:1300, 300:1200] = 255
+    # smaller inpaint areas are upscaled with the ESRGAN model first, which is not part of this benchmark
+    a, b, c, d = inpaint_worker.solve_abcd(mask, *inpaint_worker.compute_initial_abcd(mask > 0), k=0.618)
+    assert inpaint_worker.get_image_shape_ceil(image[a:b, c:d]) >= 1024
+    fill_image = image[:1024, :1024]
+    fill_mask = mask[:1024, :1024]
+
+    esrgan = upscaler.Upscaler(tiny_models.create_tiny_esrgan_state_dict())
+    upscale_image = image[:384, :384]
+
+    output_image = rng.integers(0, 256, size=(1024, 1024, 3), dtype=np.uint8)
+    metadata = [('Prompt', 'prompt', prompts[0]), ('Seed', 'seed', '12345')]
+
+    def log():
+        private_logger.output_writer.wait([private_logger.log(output_image, metadata, output_format='png')])
+
+    benchmarks = [(f'ksampler/{sampler_name}/karras', sample(sampler_name, 'karras'), None)
+                  for sampler_name in benchmark_samplers]
+    benchmarks += [(f'ksampler/dpmpp_2m_sde_gpu/{scheduler}', sample('dpmpp_2m_sde_gpu', scheduler), None)
+                   for scheduler in benchmark_schedulers]
+    benchmarks += [
+        ('ksampler/dpmpp_2m_sde_gpu/device_noise', sample('dpmpp_2m_sde_gpu', 'karras', noise='device'), None),
+        ('ksampler/euler/control_lora', sample_control_lora, None),
+        ('controlnet/control_lora_pre_run', pre_run_control_lora, None),
+        ('ksampler/dpmpp_2m_sde_gpu/deep_cache', sample('dpmpp_2m_sde_gpu', 'karras', deep_cache_interval=3), None),
+        ('brownian/torchsde', brownian_noise('torchsde'), None),
+        ('brownian/device', brownian_noise('device'), None),
+    ]
+    benchmarks += [
+        ('vae/decode', lambda: core.decode_vae(model.vae, large_latent, tiled=False), None),
+        ('vae/decode_tiled', lambda: core.decode_vae(model.vae, large_latent, tiled=True), None),
+        ('vae/decode_tiled_single_pass', lambda: model.vae.decode_tiled(large_latent['samples'], single_pass=True), None),
+        ('vae/encode_tiled', lambda: core.encode_vae(model.vae, large_pixels, tiled=True), None),
+        ('anisotropic/filter', lambda: anisotropic.adaptive_anisotropic_filter(eps, x0), None),
+        ('anisotropic/filter_unfold', lambda: anisotropic._bilateral_blur(eps, x0, (13, 13), 3.0, 3.0), None),
+        ('clip/encode', clip_encode, None),
+        ('clip/encode_batch', lambda: model.clip.encode_from_tokens_batch([model.clip.tokenize(p) for p in prompts]), None),
+        ('lora/refresh_loras', lambda: model.refresh_loras([(lora_filename, 0.8)]), reset_loras),
+        ('lora/patch_model', patch_model(None), None),
+        ('lora/patch_model_cached', patch_model(core.lora_weight_cache), None),
+        ('inpaint/worker', lambda: inpaint_worker.InpaintWorker(image, mask, use_fill=True), None),
+        ('inpaint/fill', lambda: inpaint_worker.fooocus_fill(fill_image, fill_mask), None),
+        ('inpaint/morphological_open', lambda: inpaint_worker.morphological_open(mask), None),
+        ('upscaler/upscale', lambda: esrgan.upscale(upscale_image), None),
+        ('private_logger/log', log, None),
+    ]
+    return benchmarks
+
+
+def measure(run, prepare=None, warmup=1, repeat=5):
+    times = []
+    for i in range(warmup + repeat):
+        if prepare is not None:
+            prepare()
+        start_time = time.perf_counter()
+        run()
+        if i >= warmup:
+            times.append(time.perf_counter() - start_time)
+    return dict(median=statistics.median(times), min=min(times), mean=statistics.mean(times),
+                stdev=statistics.stdev(times) if len(times) > 1 else 0.0, times=times)
+
+
+def get_environment():
+    import torch
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return dict(python=platform.python_version(), torch=torch.__version__, platform=platform.platform(),
+                processor=platform.processor(), cpu_count=os.cpu_count(), torch_threads=torch.get_num_threads(),
+                commit=commit, time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def compare(results, baseline, threshold):
+    comparison = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median'] / baseline[name]['median']
+        if ratio > 1 + threshold:
+            status = 'regression'
+        elif ratio < 1 - threshold:
+            status = 'improvement'
+        else:
+            status = 'unchanged'
+        comparison[name] = dict(baseline_median=baseline[name]['median'], ratio=ratio, status=status)
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filter', type=str, default=None, help='Only run benchmarks whose name contains this.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=None, help='Number of torch CPU threads.')
+    parser.add_argument('--output', type=str, default=os.path.join(root, 'benchmarks', 'results.json'))
+    parser.add_argument('--baseline', type=str, default=os.path.join(root, 'benchmarks', 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative change of the median time reported as regression or improvement.')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    setup_fooocus()
+    import torch
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        for name, run, prepare in create_benchmarks(path):
+            if args.filter is not None and args.filter not in name:
+                continue
+            results[name] = measure(run, prepare, args.warmup, args.repeat)
+        import modules.private_logger
+        modules.private_logger.output_writer.wait()
+
+    report = dict(environment=get_environment(), results=results)
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            report['baseline'] = args.baseline
+            report['comparison'] = compare(results, json.load(f)['results'], args.threshold)
+
+    print()
+    print(f'{"benchmark":<40} {"median":>10} {"min":>10} {"baseline":>10} {"ratio":>7}')
+    for name, result in results.items():
+        line = f'{name:<40} {result["median"] * 1000:8.1f}ms {result["min"] * 1000:8.1f}ms'
+        if name in report.get('comparison', {}):
+            c = report['comparison'][name]
+            line += f' {c["baseline_median"] * 1000:8.1f}ms {c["ratio"]:6.2f}x {c["status"]}'
+        print(line)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Baseline written to {args.baseline}')
+
+    regressions = [name for name, c in report.get('comparison', {}).items() if c['status'] == 'regression']
+    if args.fail_on_regression and len(regressions) > 0:
+        print(f'Regressions: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Randomly initialized SDXL models small enough to run the real sampling, VAE and CLIP code paths on the CPU.
+
+The UNet keeps the SDXL layout (ADM conditioning on pooled CLIP-G output and image size, three levels with
+transformers only in the lower ones, linear projections in the transformers) with far fewer channels and blocks.
+The CLIP-L and CLIP-G towers use the real tokenizer and vocabulary with narrow hidden layers, CLIP-G projects to
+the real pooled size. The VAE keeps the SDXL latent format and 8x downscaling.
+"""
+
+import json
+import os
+
+import safetensors.torch
+import torch
+
+clip_hidden_size = 64
+clip_layers = 3
+# the ADM handling in modules.patch expects the real pooled CLIP-G size
+pooled_size = 1280
+latent_channels = 4
+
+
+def get_tiny_unet_config():
+    import ldm_patched.modules.model_detection as model_detection
+
+    context_dim = 2 * clip_hidden_size
+    unet_config = {
+        "use_checkpoint": False, "image_size": 32, "out_channels": 4, "use_spatial_transformer": True,
+        "legacy": False, "num_classes": "sequential", "adm_in_channels": pooled_size + 6 * 256,
+        "dtype": torch.float32, "in_channels": latent_channels, "model_channels": 64,
+        "num_res_blocks": [1, 1, 1], "transformer_depth": [0, 1, 1], "transformer_depth_output": [0, 0, 1, 1, 1, 1],
+        "channel_mult": [1, 2, 2], "transformer_depth_middle": 1, "use_linear_in_transformer": True,
+        "context_dim": context_dim, "use_temporal_resblock": False, "use_temporal_attention": False,
+    }
+
+    # check that the layout round-trips through checkpoint detection like a real SDXL checkpoint would
+    import ldm_patched.modules.supported_models as supported_models
+    config = supported_models.SDXL(dict(unet_config))
+    config.unet_config.update(config.unet_extra_config)
+    sd = {'model.diffusion_model.' + k: v for k, v in config.get_model({}).diffusion_model.state_dict().items()}
+    detected = model_detection.detect_unet_config(sd, 'model.diffusion_model.', torch.float32)
+    assert all(detected[k] == unet_config[k] for k in detected), detected
+    return unet_config
+
+
+def write_clip_config(path, name, hidden_act):
+    filename = os.path.join(path, f'tiny_clip_{name}.json')
+    with open(filename, 'w') as f:
+        json.dump({
+            "attention_dropout": 0.0, "bos_token_id": 0, "dropout": 0.0, "eos_token_id": 2, "hidden_act": hidden_act,
+            "hidden_size": clip_hidden_size, "initializer_factor": 1.0, "initializer_range": 0.02,
+            "intermediate_size": 4 * clip_hidden_size, "layer_norm_eps": 1e-05, "max_position_embeddings": 77,
+            "model_type": "clip_text_model", "num_attention_heads": 2, "num_hidden_layers": clip_layers,
+            "pad_token_id": 1, "projection_dim": clip_hidden_size, "torch_dtype": "float32", "vocab_size": 49408
+        }, f)
+    return filename
+
+
+def create_tiny_clip(path):
+    import ldm_patched.modules.sd
+    import ldm_patched.modules.sd1_clip as sd1_clip
+    import ldm_patched.modules.sdxl_clip as sdxl_clip
+    from ldm_patched.modules.supported_models_base import ClipTarget
+
+    config_l = write_clip_config(path, 'l', 'quick_gelu')
+    config_g = write_clip_config(path, 'g', 'gelu')
+
+    class TinySDXLClipModel(sdxl_clip.SDXLClipModel):
+        def __init__(self, device='cpu', dtype=None):
+            torch.nn.Module.__init__(self)
+            self.clip_l = sd1_clip.SDClipModel(layer='hidden', layer_idx=-2, device=device, dtype=dtype,
+                                               textmodel_json_config=config_l, layer_norm_hidden_state=False)
+            self.clip_g = sd1_clip.SDClipModel(layer='hidden', layer_idx=-2, device=device, dtype=dtype,
+                                               textmodel_json_config=config_g, layer_norm_hidden_state=False,
+                                               special_tokens={"start": 49406, "end": 49407, "pad": 0})
+            self.clip_g.text_projection = torch.nn.Parameter(torch.randn(clip_hidden_size, pooled_size) * 0.02)
+
+    return ldm_patched.modules.sd.CLIP(target=ClipTarget(sdxl_clip.SDXLTokenizer, TinySDXLClipModel))
+
+
+def create_tiny_vae():
+    import ldm_patched.modules.sd
+    from ldm_patched.ldm.models.autoencoder import AutoencoderKL
+
+    ddconfig = {'double_z': True, 'z_channels': latent_channels, 'resolution': 256, 'in_channels': 3, 'out_ch': 3,
+                'ch': 32, 'ch_mult': [1, 1, 2, 2], 'num_res_blocks': 1, 'attn_resolutions': [], 'dropout': 0.0}
+    config = {'params': {'ddconfig': ddconfig, 'embed_dim': latent_channels}}
+    sd = AutoencoderKL(ddconfig=ddconfig, embed_dim=latent_channels).state_dict()
+    return ldm_patched.modules.sd.VAE(sd=sd, config=config)
+
+
+def create_tiny_sdxl(path, seed=0):
+    """Returns a core.StableDiffusionModel, path receives the CLIP configs and a placeholder checkpoint file."""
+    import ldm_patched.modules.model_management as model_management
+    import ldm_patched.modules.model_patcher
+    import ldm_patched.modules.supported_models as supported_models
+    import modules.core as core
+
+    torch.manual_seed(seed)
+    config = supported_models.SDXL(get_tiny_unet_config())
+    model = config.get_model({})
+    model.eval()
+    unet = ldm_patched.modules.model_patcher.ModelPatcher(model, load_device=model_management.get_torch_device(),
+                                                          offload_device=model_management.unet_offload_device())
+
+    # the LoRA and CLIP caches identify models by their checkpoint file
+    filename = os.path.join(path, 'tiny_sdxl.safetensors')
+    safetensors.torch.save_file({'seed': torch.tensor([seed])}, filename)
+
+    return core.StableDiffusionModel(unet=unet, clip=create_tiny_clip(path), vae=create_tiny_vae(), filename=filename)
+
+
+def write_tiny_lora(model, filename, rank=4, seed=0):
+    """Writes a kohya style LoRA for every UNet and CLIP linear and convolution weight of the model."""
+    generator = torch.Generator().manual_seed(seed)
+    lora = {}
+    for key_map, state_dict in [(model.lora_key_map_unet, model.unet.model.state_dict()),
+                                (model.lora_key_map_clip, model.clip.cond_stage_model.state_dict())]:
+        for lora_key, weight_key in key_map.items():
+            if not lora_key.startswith('lora_') or weight_key not in state_dict or state_dict[weight_key].ndim not in [2, 4]:
+                continue
+            weight = state_dict[weight_key]
+            down_shape = (rank, weight.shape[1]) + tuple(weight.shape[2:])
+            up_shape = (weight.shape[0], rank) + (1,) * (weight.ndim - 2)
+            lora[f'{lora_key}.lora_down.weight'] = torch.randn(down_shape, generator=generator) * 0.01
+            lora[f'{lora_key}.lora_up.weight'] = torch.randn(up_shape, generator=generator) * 0.01
+            lora[f'{lora_key}.alpha'] = torch.tensor(float(rank))
+    safetensors.torch.save_file(lora, filename)
+    return filename
+
+
+def write_tiny_control_lora(model, filename, rank=4, seed=0):
+    """
+    Writes a Control-LoRA for the UNet of model: a hint encoder, zero convolutions and the middle block output of
+    its own, LoRA up and down weights for the linear layers of the transformers.
+    """
+    import ldm_patched.controlnet.cldm
+
+    generator = torch.Generator().manual_seed(seed)
+    unet_config = model.unet.model.model_config.unet_config.copy()
+    unet_config.pop('out_channels')
+    control_model = ldm_patched.controlnet.cldm.ControlNet(hint_channels=3, **unet_config)
+    unet_sd = model.unet.model.diffusion_model.state_dict()
+
+    control_lora = {'lora_controlnet': torch.tensor([])}
+    for k, v in control_model.state_dict().items():
+        if k not in unet_sd:
+            control_lora[k] = torch.randn(v.shape, generator=generator) * 0.02
+        elif k.endswith('.weight') and v.ndim == 2 and '.transformer_blocks.' in k:
+            module_name = k[:-len('.weight')]
+            control_lora[f'{module_name}.up'] = torch.randn((v.shape[0], rank), generator=generator) * 0.01
+            control_lora[f'{module_name}.down'] = torch.randn((rank, v.shape[1]), generator=generator) * 0.01
+    safetensors.torch.save_file(control_lora, filename)
+    return filename
+
+
+def write_vae_approx(path):
+    """get_previewer needs the latent previewer weights even if previews are disabled."""
+    import modules.core as core
+
+    os.makedirs(path, exist_ok=True)
+    torch.save(core.VAEApprox().state_dict(), os.path.join(path, 'xlvaeapp.pth'))
+
+
+def create_tiny_esrgan_state_dict(num_filters=16, num_blocks=1, seed=0):
+    """A 4x ESRGAN with the layout of modules.upscaler's model, fewer filters and residual blocks."""
+    generator = torch.Generator().manual_seed(seed)
+    growth = 32  # fixed by RRDBNet
+    shapes = {'conv_first': (num_filters, 3)}
+    for i in range(num_blocks):
+        for r in range(1, 4):
+            for j in range(1, 5):
+                shapes[f'RRDB_trunk.{i}.RDB{r}.conv{j}'] = (growth, num_filters + (j - 1) * growth)
+            shapes[f'RRDB_trunk.{i}.RDB{r}.conv5'] = (num_filters, num_filters + 4 * growth)
+    for name in ['trunk_conv', 'upconv1', 'upconv2', 'HRconv']:
+        shapes[name] = (num_filters, num_filters)
+    shapes['conv_last'] = (3, num_filters)
+
+    state_dict = {}
+    for name, (out_channels, in_channels) in shapes.items():
+        state_dict[f'{name}.weight'] = torch.randn((out_channels, in_channels, 3, 3), generator=generator) * (1.0 / (in_channels * 9)) ** 0.5
+        state_dict[f'{name}.bias'] = torch.zeros(out_channels)
+    state_dict['conv_last.bias'] += 0.5
+    return state_dict
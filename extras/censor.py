@@ -1,4 +1,6 @@
 import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -15,46 +17,137 @@ preprocessor_config_path = os.path.join(safety_checker_repo_root, "configs", "pr
 
 
 class Censor:
-    def __init__(self):
+    """
+    Blacks out images the safety checker flags as NSFW.
+
+    Images are checked in batches of up to max_batch_size. They are resized, cropped and normalized as
+    CLIPImageProcessor does, but with torch on the device of the checker.
+
+    The checker is loaded through model_management, in fp16 where the device supports it, and stays loaded until
+    model_management needs the memory. When it runs on the CPU while sampling runs on another device, submit checks
+    images on a background thread so that the worker can go on sampling. model_management is not thread safe, so a
+    checker on the sampling device always runs on the calling thread. Checks are serialized on the lock, so that
+    censor called by the worker thread never runs the checker at the same time as a background check.
+    """
+
+    def __init__(self, max_batch_size=8):
         self.safety_checker_model: ModelPatcher | None = None
         self.clip_image_processor: CLIPImageProcessor | None = None
         self.load_device = torch.device('cpu')
         self.offload_device = torch.device('cpu')
+        self.dtype = torch.float32
+        self.max_batch_size = max(max_batch_size, 1)
+        self.lock = threading.RLock()
+        self.executor = None
 
     def init(self):
-        if self.safety_checker_model is None and self.clip_image_processor is None:
-            safety_checker_model = modules.config.downloading_safety_checker_model()
-            self.clip_image_processor = CLIPImageProcessor.from_json_file(preprocessor_config_path)
-            clip_config = CLIPConfig.from_json_file(config_path)
-            model = StableDiffusionSafetyChecker.from_pretrained(safety_checker_model, config=clip_config)
-            model.eval()
+        with self.lock:
+            if self.safety_checker_model is None and self.clip_image_processor is None:
+                safety_checker_model = modules.config.downloading_safety_checker_model()
+                clip_image_processor = CLIPImageProcessor.from_json_file(preprocessor_config_path)
+                clip_config = CLIPConfig.from_json_file(config_path)
+                model = StableDiffusionSafetyChecker.from_pretrained(safety_checker_model, config=clip_config)
+                self.set_model(model, clip_image_processor)
 
-            self.load_device = model_management.text_encoder_device()
-            self.offload_device = model_management.text_encoder_offload_device()
+    def set_model(self, model, clip_image_processor):
+        model.eval()
 
-            model.to(self.offload_device)
+        self.load_device = model_management.text_encoder_device()
+        self.offload_device = model_management.text_encoder_offload_device()
+        self.dtype = torch.float16 if model_management.should_use_fp16(device=self.load_device) else torch.float32
 
-            self.safety_checker_model = ModelPatcher(model, load_device=self.load_device, offload_device=self.offload_device)
+        model.to(device=self.offload_device, dtype=self.dtype)
 
-    def censor(self, images: list | np.ndarray) -> list | np.ndarray:
+        self.clip_image_processor = clip_image_processor
+        self.safety_checker_model = ModelPatcher(model, load_device=self.load_device, offload_device=self.offload_device)
+
+    def runs_in_background(self):
         self.init()
-        model_management.load_model_gpu(self.safety_checker_model)
+        return model_management.is_device_cpu(self.load_device) and \
+            not model_management.is_device_cpu(model_management.get_torch_device())
+
+    def to_pixels(self, images: np.ndarray) -> torch.Tensor:
+        if images.ndim == 3:
+            images = images[..., None]
+        pixels = torch.from_numpy(np.ascontiguousarray(images)).to(self.load_device).float() / 255.0
+        return pixels.expand(-1, -1, -1, 3) if pixels.shape[-1] == 1 else pixels[..., :3]
+
+    def preprocess(self, pixels: torch.Tensor) -> torch.Tensor:
+        """Turns BHWC pixels in [0, 1] into the clip_input of the checker, like CLIPImageProcessor."""
+        processor = self.clip_image_processor
+        size = processor.size['shortest_edge'] if isinstance(processor.size, dict) else processor.size
+        crop_size = processor.crop_size
+        crop_height, crop_width = (crop_size['height'], crop_size['width']) if isinstance(crop_size, dict) \
+            else (crop_size, crop_size)
+
+        x = pixels.movedim(-1, 1).to(device=self.load_device, dtype=torch.float32)
+        height, width = x.shape[2:]
+        short, long = (height, width) if height <= width else (width, height)
+        new_short, new_long = size, int(size * long / short)
+        new_height, new_width = (new_short, new_long) if height <= width else (new_long, new_short)
+        # PIL's bicubic filter, which CLIPImageProcessor resizes with, is antialiased
+        x = torch.nn.functional.interpolate(x, size=(new_height, new_width), mode='bicubic', antialias=True,
+                                            align_corners=False)
+
+        top = (new_height - crop_height) // 2
+        left = (new_width - crop_width) // 2
+        x = x[:, :, top:top + crop_height, left:left + crop_width].clamp(0, 1)
+
+        mean = torch.tensor(processor.image_mean, device=x.device).view(1, -1, 1, 1)
+        std = torch.tensor(processor.image_std, device=x.device).view(1, -1, 1, 1)
+        return ((x - mean) / std).to(self.dtype)
+
+    @torch.no_grad()
+    @torch.inference_mode()
+    def check(self, images: list[np.ndarray]) -> list[bool]:
+        """Returns whether each image has NSFW content."""
+        with self.lock:
+            self.init()
+            # a checker on the CPU may run on a background thread, which must not touch model_management
+            if not model_management.is_device_cpu(self.load_device):
+                model_management.load_model_gpu(self.safety_checker_model)
+
+            has_nsfw_concepts = []
+            for start in range(0, len(images), self.max_batch_size):
+                batch = images[start:start + self.max_batch_size]
+                if all(image.shape == batch[0].shape for image in batch) and batch[0].ndim == 3:
+                    clip_input = self.preprocess(self.to_pixels(np.stack(batch)))
+                else:
+                    clip_input = torch.cat([self.preprocess(self.to_pixels(image[None])) for image in batch])
+                # the images are only blacked out in place of the list entries, which censor does itself
+                _, batch_has_nsfw_concepts = self.safety_checker_model.model(images=list(batch), clip_input=clip_input)
+                has_nsfw_concepts += batch_has_nsfw_concepts
+            return has_nsfw_concepts
 
+    def censor(self, images: list | np.ndarray) -> list | np.ndarray:
         single = False
-        if not isinstance(images, (list, np.ndarray)):
+        if not isinstance(images, list):
             images = [images]
             single = True
 
-        safety_checker_input = self.clip_image_processor(images, return_tensors="pt")
-        safety_checker_input.to(device=self.load_device)
-        checked_images, has_nsfw_concept = self.safety_checker_model.model(images=images,
-                                                                           clip_input=safety_checker_input.pixel_values)
-        checked_images = [image.astype(np.uint8) for image in checked_images]
+        has_nsfw_concepts = self.check(images)
+        checked_images = [np.zeros(image.shape, dtype=np.uint8) if has_nsfw_concept else image.astype(np.uint8)
+                          for image, has_nsfw_concept in zip(images, has_nsfw_concepts)]
 
         if single:
             checked_images = checked_images[0]
 
         return checked_images
 
+    def submit(self, images: list) -> Future:
+        """Returns a future of censor(images), done on a background thread if runs_in_background()."""
+        if not self.runs_in_background():
+            future = Future()
+            future.set_result(self.censor(images))
+            return future
+
+        if self.executor is None:
+            # no background check can hold the lock before the executor exists
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(1, thread_name_prefix='censor')
+        return self.executor.submit(self.censor, images)
+
 
-default_censor = Censor().censor
+censor = Censor()
+default_censor = censor.censor
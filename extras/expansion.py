@@ -8,15 +8,16 @@
 import os
 import torch
 import math
+import threading
 import ldm_patched.modules.model_management as model_management
 
-from transformers.generation.logits_process import LogitsProcessorList
-from transformers import AutoTokenizer, AutoModelForCausalLM, set_seed
+from collections import OrderedDict
+from transformers import AutoTokenizer, AutoModelForCausalLM
 from modules.config import path_fooocus_expansion
 from ldm_patched.modules.model_patcher import ModelPatcher
 
 
-# limitation of np.random.seed(), called from transformers.set_seed()
+# limitation of np.random.seed(), called from transformers.set_seed() in earlier versions, kept for the same results
 SEED_LIMIT_NUMPY = 2**32
 neg_inf = - 8192.0
 
@@ -35,10 +36,14 @@ def remove_pattern(x, pattern):
 
 
 class FooocusExpansion:
-    def __init__(self):
-        self.tokenizer = AutoTokenizer.from_pretrained(path_fooocus_expansion)
-
-        positive_words = open(os.path.join(path_fooocus_expansion, 'positive.txt'),
+    def __init__(self, path=path_fooocus_expansion, max_batch_size=16, cache_size=1024):
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.max_batch_size = max(max_batch_size, 1)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (prompt, seed) -> expansion
+        self.lock = threading.Lock()
+
+        positive_words = open(os.path.join(path, 'positive.txt'),
                               encoding='utf-8').read().splitlines()
         positive_words = ['Ġ' + x.lower() for x in positive_words if x != '']
 
@@ -59,7 +64,7 @@ class FooocusExpansion:
         # t198 = self.tokenizer('\n', return_tensors="np")
         # eos = self.tokenizer.eos_token_id
 
-        self.model = AutoModelForCausalLM.from_pretrained(path_fooocus_expansion)
+        self.model = AutoModelForCausalLM.from_pretrained(path)
         self.model.eval()
 
         load_device = model_management.text_encoder_device()
@@ -81,49 +86,114 @@ class FooocusExpansion:
     @torch.no_grad()
     @torch.inference_mode()
     def logits_processor(self, input_ids, scores):
-        assert scores.ndim == 2 and scores.shape[0] == 1
+        assert scores.ndim == 2
         self.logits_bias = self.logits_bias.to(scores)
+        input_ids = input_ids.to(scores.device).long()
+
+        # tokens already in a row get the same bias as words outside of the vocab, the comma is always allowed
+        banned_scores = scores.gather(1, input_ids) + neg_inf
+        comma_scores = scores[:, 11].clone()
 
-        bias = self.logits_bias.clone()
-        bias[0, input_ids[0].to(bias.device).long()] = neg_inf
-        bias[0, 11] = 0
+        scores = scores + self.logits_bias
+        scores.scatter_(1, input_ids, banned_scores)
+        scores[:, 11] = comma_scores
 
-        return scores + bias
+        return scores
 
     @torch.no_grad()
     @torch.inference_mode()
-    def __call__(self, prompt, seed):
-        if prompt == '':
-            return ''
+    def sample(self, input_ids, max_new_tokens, seeds):
+        # Same sampling as model.generate(do_sample=True, top_k=100) with the logits processor after set_seed(seed),
+        # but with one generator per row so that every row gives what it would give alone.
+        device = input_ids.device
+        generators = [torch.Generator(device=device).manual_seed(seed) for seed in seeds]
+        eos_token_id = self.tokenizer.eos_token_id
+        unfinished = torch.ones(input_ids.shape[0], dtype=torch.bool, device=device)
+        attention_mask = torch.ones_like(input_ids)
+
+        model_input_ids = input_ids
+        past_key_values = None
+
+        for _ in range(max_new_tokens):
+            outputs = self.model(input_ids=model_input_ids, attention_mask=attention_mask,
+                                 past_key_values=past_key_values, use_cache=True)
+            past_key_values = outputs.past_key_values
+
+            scores = self.logits_processor(input_ids, outputs.logits[:, -1, :].float())
+            top_k_scores = torch.topk(scores, min(100, scores.shape[-1]))[0][..., -1, None]
+            scores = scores.masked_fill(scores < top_k_scores, -float('inf'))
+            probs = torch.nn.functional.softmax(scores, dim=-1)
+
+            next_tokens = torch.cat([torch.multinomial(probs[i:i + 1], num_samples=1, generator=generator)
+                                     for i, generator in enumerate(generators)]).squeeze(1)
+            next_tokens = torch.where(unfinished, next_tokens, eos_token_id)
+            unfinished = unfinished & (next_tokens != eos_token_id)
+
+            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=1)
+            attention_mask = torch.cat([attention_mask, attention_mask[:, -1:]], dim=1)
+            model_input_ids = next_tokens[:, None]
+
+            if not unfinished.any():
+                break
+
+        return input_ids
 
-        if self.patcher.current_device != self.patcher.load_device:
+    @torch.no_grad()
+    @torch.inference_mode()
+    def expand(self, prompts, seeds):
+        """
+        Expands every prompt with its seed. Results are cached by (prompt, seed), the remaining prompts are sampled
+        in batches of prompts with the same number of tokens, which need no padding and give the same results as
+        expanding them one by one.
+        """
+        results = [None] * len(prompts)
+        groups = {}
+
+        for i, (prompt, seed) in enumerate(zip(prompts, seeds)):
+            if prompt == '':
+                results[i] = ''
+                continue
+
+            seed = int(seed) % SEED_LIMIT_NUMPY
+            prompt = safe_str(prompt) + ','
+            with self.lock:
+                if (prompt, seed) in self.cache:
+                    self.cache.move_to_end((prompt, seed))
+                    results[i] = self.cache[(prompt, seed)]
+                    continue
+
+            tokens = tuple(self.tokenizer(prompt, return_tensors="pt").data['input_ids'][0].tolist())
+            groups.setdefault(len(tokens), {}).setdefault((prompt, seed), (tokens, []))[1].append(i)
+
+        if len(groups) > 0 and self.patcher.current_device != self.patcher.load_device:
             print('Fooocus Expansion loaded by itself.')
             model_management.load_model_gpu(self.patcher)
 
-        seed = int(seed) % SEED_LIMIT_NUMPY
-        set_seed(seed)
-        prompt = safe_str(prompt) + ','
-
-        tokenized_kwargs = self.tokenizer(prompt, return_tensors="pt")
-        tokenized_kwargs.data['input_ids'] = tokenized_kwargs.data['input_ids'].to(self.patcher.load_device)
-        tokenized_kwargs.data['attention_mask'] = tokenized_kwargs.data['attention_mask'].to(self.patcher.load_device)
+        for current_token_length, group in groups.items():
+            max_token_length = 75 * int(math.ceil(float(current_token_length) / 75.0))
+            max_new_tokens = max_token_length - current_token_length
+            rows = list(group.items())
+
+            for batch_start in range(0, len(rows), self.max_batch_size):
+                batch = rows[batch_start:batch_start + self.max_batch_size]
+                if max_new_tokens == 0:
+                    responses = [prompt[:-1] for (prompt, _), _ in batch]
+                else:
+                    input_ids = torch.tensor([tokens for _, (tokens, _) in batch], device=self.patcher.load_device)
+                    # https://huggingface.co/blog/introducing-csearch
+                    # https://huggingface.co/docs/transformers/generation_strategies
+                    features = self.sample(input_ids, max_new_tokens, [seed for (_, seed), _ in batch])
+                    responses = [safe_str(x) for x in self.tokenizer.batch_decode(features, skip_special_tokens=True)]
+
+                for (key, (_, indices)), result in zip(batch, responses):
+                    for i in indices:
+                        results[i] = result
+                    with self.lock:
+                        self.cache[key] = result
+                        while len(self.cache) > self.cache_size:
+                            self.cache.popitem(last=False)
+
+        return results
 
-        current_token_length = int(tokenized_kwargs.data['input_ids'].shape[1])
-        max_token_length = 75 * int(math.ceil(float(current_token_length) / 75.0))
-        max_new_tokens = max_token_length - current_token_length
-
-        if max_new_tokens == 0:
-            return prompt[:-1]
-
-        # https://huggingface.co/blog/introducing-csearch
-        # https://huggingface.co/docs/transformers/generation_strategies
-        features = self.model.generate(**tokenized_kwargs,
-                                       top_k=100,
-                                       max_new_tokens=max_new_tokens,
-                                       do_sample=True,
-                                       logits_processor=LogitsProcessorList([self.logits_processor]))
-
-        response = self.tokenizer.batch_decode(features, skip_special_tokens=True)
-        result = safe_str(response[0])
-
-        return result
+    def __call__(self, prompt, seed):
+        return self.expand([prompt], [seed])[0]
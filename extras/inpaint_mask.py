@@ -1,5 +1,8 @@
 import sys
+import threading
+from collections import OrderedDict
 
+import ldm_patched.modules.model_management as model_management
 import modules.config
 import numpy as np
 import torch
@@ -32,6 +35,50 @@ class SAMOptions:
         self.model_type = model_type
 
 
+mask_models = OrderedDict()  # (mask model, options) -> rembg session or SamPredictor, least recently used first
+mask_models_size = 2
+mask_models_lock = threading.Lock()
+sam_predictor_lock = threading.Lock()
+
+
+def get_mask_model(key, loader):
+    with mask_models_lock:
+        if key in mask_models:
+            mask_models.move_to_end(key)
+            return mask_models[key]
+
+        # drop the least recently used models before loading so that they are not held twice
+        while len(mask_models) >= mask_models_size:
+            mask_models.popitem(last=False)
+        model = loader()
+        mask_models[key] = model
+        return model
+
+
+def rembg_providers():
+    # run the ONNX models of rembg on the device model_management uses, all available providers on others
+    device = model_management.get_torch_device()
+    if model_management.is_device_cpu(device):
+        return ['CPUExecutionProvider']
+    if device.type == 'cuda':
+        return ['CUDAExecutionProvider', 'CPUExecutionProvider']
+    return None
+
+
+def get_rembg_session(mask_model, extras):
+    providers = rembg_providers()
+    key = (mask_model, tuple(providers or []), tuple(sorted(extras.items())))
+    return get_mask_model(key, lambda: new_session(mask_model, providers, **extras))
+
+
+def get_sam_predictor(model_type):
+    def load():
+        sam_checkpoint = modules.config.download_sam_model(model_type)
+        return SamPredictor(sam_model_registry[model_type](checkpoint=sam_checkpoint))
+
+    return get_mask_model(('sam', model_type), load)
+
+
 def optimize_masks(masks: torch.Tensor) -> torch.Tensor:
     """
     removes small disconnected regions and holes
@@ -61,7 +108,7 @@ def generate_mask_from_image(image: np.ndarray, mask_model: str = 'sam', extras=
     if mask_model != 'sam' or sam_options is None:
         result = remove(
             image,
-            session=new_session(mask_model, **extras),
+            session=get_rembg_session(mask_model, extras),
             only_mask=True,
             **extras
         )
@@ -80,16 +127,10 @@ def generate_mask_from_image(image: np.ndarray, mask_model: str = 'sam', extras=
     boxes[:, :2] = boxes[:, :2] - boxes[:, 2:] / 2
     boxes[:, 2:] = boxes[:, 2:] + boxes[:, :2]
 
-    sam_checkpoint = modules.config.download_sam_model(sam_options.model_type)
-    sam = sam_model_registry[sam_options.model_type](checkpoint=sam_checkpoint)
-
-    sam_predictor = SamPredictor(sam)
     final_mask_tensor = torch.zeros((image.shape[0], image.shape[1]))
     dino_detection_count = boxes.size(0)
 
     if dino_detection_count > 0:
-        sam_predictor.set_image(image)
-
         if sam_options.dino_erode_or_dilate != 0:
             for index in range(boxes.size(0)):
                 assert boxes.size(1) == 4
@@ -106,13 +147,18 @@ def generate_mask_from_image(image: np.ndarray, mask_model: str = 'sam', extras=
                 draw.rectangle(box.tolist(), fill="white")
             return np.array(debug_dino_image), dino_detection_count, sam_detection_count, sam_detection_on_mask_count
 
+        # the predictor keeps the embeddings of the last images, enhancing one image with several prompts encodes it once
+        sam_predictor = get_sam_predictor(sam_options.model_type)
         transformed_boxes = sam_predictor.transform.apply_boxes_torch(boxes, image.shape[:2])
-        masks, _, _ = sam_predictor.predict_torch(
-            point_coords=None,
-            point_labels=None,
-            boxes=transformed_boxes,
-            multimask_output=False,
-        )
+        # the cached predictor is shared, the image it is set to has to stay the same until predict_torch is done
+        with sam_predictor_lock:
+            sam_predictor.set_image(image)
+            masks, _, _ = sam_predictor.predict_torch(
+                point_coords=None,
+                point_labels=None,
+                boxes=transformed_boxes,
+                multimask_output=False,
+            )
 
         masks = optimize_masks(masks)
         sam_detection_count = len(masks)
@@ -4,6 +4,9 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 import torch
 from ldm_patched.modules import model_management
@@ -21,7 +24,8 @@ class SamPredictor:
         self,
         model: Sam,
         load_device=model_management.text_encoder_device(),
-        offload_device=model_management.text_encoder_offload_device()
+        offload_device=model_management.text_encoder_offload_device(),
+        embeddings_size: int = 4,
     ) -> None:
         """
         Uses SAM to calculate the image embedding for an image, and then
@@ -29,6 +33,8 @@ class SamPredictor:
 
         Arguments:
           model (Sam): The model to use for mask prediction.
+          embeddings_size (int): The number of image embeddings to keep, so
+            that setting one of these images again does not encode it again.
         """
         super().__init__()
 
@@ -40,6 +46,8 @@ class SamPredictor:
         self.patcher = ModelPatcher(model, load_device=self.load_device, offload_device=self.offload_device)
 
         self.transform = ResizeLongestSide(model.image_encoder.img_size)
+        self.embeddings_size = embeddings_size
+        self.embeddings = OrderedDict()  # (shape, dtype, image_format, sha256) -> (features, original_size, input_size)
         self.reset_image()
 
     def set_image(
@@ -60,6 +68,15 @@ class SamPredictor:
             "RGB",
             "BGR",
         ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        image = np.ascontiguousarray(image)
+        key = (image.shape, image.dtype.str, image_format, hashlib.sha256(image.data).hexdigest())
+        if key in self.embeddings:
+            self.embeddings.move_to_end(key)
+            self.reset_image()
+            self.features, self.original_size, self.input_size = self.embeddings[key]
+            self.is_image_set = True
+            return
+
         if image_format != self.patcher.model.image_format:
             image = image[..., ::-1]
 
@@ -70,6 +87,11 @@ class SamPredictor:
 
         self.set_torch_image(input_image_torch, image.shape[:2])
 
+        if self.embeddings_size > 0:
+            self.embeddings[key] = (self.features, self.original_size, self.input_size)
+            while len(self.embeddings) > self.embeddings_size:
+                self.embeddings.popitem(last=False)
+
     @torch.no_grad()
     def set_torch_image(
         self,
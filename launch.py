@@ -149,4 +149,15 @@ config.default_base_model_name, config.checkpoint_downloads = download_models(
 config.update_files()
 init_cache(config.model_filenames, config.paths_checkpoints, config.lora_filenames, config.paths_loras)
 
-from webui import *
+if args.headless and args.api_port is None:
+    print('--headless requires --api-port, launching the Gradio UI instead.')
+    args.headless = False
+
+if args.api_port is not None:
+    import modules.api
+    import modules.async_worker
+
+    modules.api.start(args.listen, args.api_port, block=args.headless)
+
+if not args.headless:
+    from webui import *
@@ -279,8 +279,8 @@ class VAEDecodeTiled:
 
     CATEGORY = "_for_testing"
 
-    def decode(self, vae, samples, tile_size):
-        return (vae.decode_tiled(samples["samples"], tile_x=tile_size // 8, tile_y=tile_size // 8, ), )
+    def decode(self, vae, samples, tile_size, single_pass=False):
+        return (vae.decode_tiled(samples["samples"], tile_x=tile_size // 8, tile_y=tile_size // 8, single_pass=single_pass), )
 
 class VAEEncode:
     @classmethod
@@ -317,9 +317,9 @@ class VAEEncodeTiled:
 
     CATEGORY = "_for_testing"
 
-    def encode(self, vae, pixels, tile_size):
+    def encode(self, vae, pixels, tile_size, single_pass=False):
         pixels = VAEEncode.vae_encode_crop_pixels(pixels)
-        t = vae.encode_tiled(pixels[:,:,:,:3], tile_x=tile_size, tile_y=tile_size, )
+        t = vae.encode_tiled(pixels[:,:,:,:3], tile_x=tile_size, tile_y=tile_size, single_pass=single_pass)
         return ({"samples":t}, )
 
 class VAEEncodeForInpaint:
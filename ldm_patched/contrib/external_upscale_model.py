@@ -51,7 +51,9 @@ class ImageUpscaleWithModel:
             try:
                 steps = in_img.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(in_img.shape[3], in_img.shape[2], tile_x=tile, tile_y=tile, overlap=overlap)
                 pbar = ldm_patched.modules.utils.ProgressBar(steps)
-                s = ldm_patched.modules.utils.tiled_scale(in_img, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap, upscale_amount=upscale_model.scale, pbar=pbar)
+                memory_per_tile = (tile * tile * in_img.shape[1]) * in_img.element_size() * max(upscale_model.scale, 1.0) * 384.0
+                batch_size = max(1, int(free_memory / memory_per_tile))
+                s = ldm_patched.modules.utils.tiled_scale(in_img, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap, upscale_amount=upscale_model.scale, pbar=pbar, max_batch_size=batch_size)
                 oom = False
             except model_management.OOM_EXCEPTION as e:
                 tile //= 2
@@ -255,11 +255,83 @@ class ControlLoraOps:
                 return torch.nn.functional.conv2d(input, weight, bias, self.stride, self.padding, self.dilation, self.groups)
 
 
+class ControlLoraNetwork:
+    """
+    The control network of a Control-LoRA, built once per control weights and UNet config (which includes the dtype)
+    and kept in control_lora_networks.
+
+    Only the control weights are parameters of the network, model_management loads and offloads them through
+    patcher like any other model. The weights the network shares with the UNet are plain attributes that point to the
+    UNet parameters themselves, they are linked before every sampling run and unlinked after it so that the network
+    never keeps an offloaded or replaced UNet alive.
+    """
+
+    def __init__(self, control_weights, diffusion_model, controlnet_config, operations):
+        self.control_weights = control_weights
+        self.controlnet_config = controlnet_config
+        self.control_model = ldm_patched.controlnet.cldm.ControlNet(**controlnet_config, operations=operations)
+        dtype = controlnet_config["dtype"]
+
+        self.links = []
+        for k in diffusion_model.state_dict().keys():
+            if k in control_weights:
+                continue
+            module_name, _, name = k.rpartition('.')
+            try:
+                module = self.control_model.get_submodule(module_name)
+            except AttributeError:
+                continue
+            if not hasattr(module, name):
+                continue
+            module._parameters.pop(name, None)
+            object.__setattr__(module, name, None)
+            self.links.append((module, name, k))
+
+        for k in control_weights:
+            if k not in {"lora_controlnet"}:
+                ldm_patched.modules.utils.set_attr(self.control_model, k, control_weights[k].to(dtype))
+
+        self.patcher = ldm_patched.modules.model_patcher.ModelPatcher(
+            self.control_model, load_device=ldm_patched.modules.model_management.get_torch_device(),
+            offload_device=ldm_patched.modules.model_management.unet_offload_device())
+        self.loaded_outside_model_management = False
+
+    def is_loaded(self):
+        return any(m.model is self.patcher for m in ldm_patched.modules.model_management.current_loaded_models)
+
+    def link(self, diffusion_model):
+        if not self.is_loaded():
+            # the first run of a network, get_models could not return it before it existed
+            self.control_model.to(self.patcher.load_device)
+            self.loaded_outside_model_management = True
+        sd = diffusion_model.state_dict(keep_vars=True)
+        for module, name, k in self.links:
+            object.__setattr__(module, name, sd[k])
+
+    def unlink(self):
+        for module, name, k in self.links:
+            object.__setattr__(module, name, None)
+        if self.loaded_outside_model_management and not self.is_loaded():
+            self.control_model.to(self.patcher.offload_device)
+        self.loaded_outside_model_management = False
+
+
+control_lora_networks = {}  # id(control_weights) -> ControlLoraNetwork
+control_lora_networks_size = 4
+
+
 class ControlLora(ControlNet):
     def __init__(self, control_weights, global_average_pooling=False, device=None):
         ControlBase.__init__(self, device)
         self.control_weights = control_weights
         self.global_average_pooling = global_average_pooling
+        self.control_network = None
+
+    def get_network(self):
+        network = control_lora_networks.get(id(self.control_weights))
+        if network is not None and network.control_weights is self.control_weights:
+            return network
+        return None
 
     def pre_run(self, model, percent_to_timestep_function):
         super().pre_run(model, percent_to_timestep_function)
@@ -276,24 +348,17 @@ class ControlLora(ControlNet):
                 pass
             dtype = self.manual_cast_dtype
 
-        controlnet_config["operations"] = control_lora_ops
         controlnet_config["dtype"] = dtype
-        self.control_model = ldm_patched.controlnet.cldm.ControlNet(**controlnet_config)
-        self.control_model.to(ldm_patched.modules.model_management.get_torch_device())
-        diffusion_model = model.diffusion_model
-        sd = diffusion_model.state_dict()
-        cm = self.control_model.state_dict()
-
-        for k in sd:
-            weight = sd[k]
-            try:
-                ldm_patched.modules.utils.set_attr(self.control_model, k, weight)
-            except:
-                pass
+        network = self.get_network()
+        if network is None or network.controlnet_config != controlnet_config:
+            if network is None and len(control_lora_networks) >= control_lora_networks_size:
+                control_lora_networks.pop(next(iter(control_lora_networks)))
+            network = ControlLoraNetwork(self.control_weights, model.diffusion_model, controlnet_config, control_lora_ops)
+            control_lora_networks[id(self.control_weights)] = network
 
-        for k in self.control_weights:
-            if k not in {"lora_controlnet"}:
-                ldm_patched.modules.utils.set_attr(self.control_model, k, self.control_weights[k].to(dtype).to(ldm_patched.modules.model_management.get_torch_device()))
+        network.link(model.diffusion_model)
+        self.control_network = network
+        self.control_model = network.control_model
 
     def copy(self):
         c = ControlLora(self.control_weights, global_average_pooling=self.global_average_pooling)
@@ -301,15 +366,23 @@ class ControlLora(ControlNet):
         return c
 
     def cleanup(self):
-        del self.control_model
+        if self.control_network is not None:
+            self.control_network.unlink()
+        self.control_network = None
         self.control_model = None
         super().cleanup()
 
     def get_models(self):
         out = ControlBase.get_models(self)
+        network = self.get_network()
+        if network is not None:
+            out.append(network.patcher)
         return out
 
     def inference_memory_requirements(self, dtype):
+        if self.get_network() is not None:
+            # the control weights are loaded by model_management
+            return ControlBase.inference_memory_requirements(self, dtype)
         return ldm_patched.modules.utils.calculate_parameters(self.control_weights) * ldm_patched.modules.model_management.dtype_size(dtype) + ControlBase.inference_memory_requirements(self, dtype)
 
 def load_controlnet(ckpt_path, model=None):
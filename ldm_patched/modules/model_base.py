@@ -156,14 +156,17 @@ class BaseModel(torch.nn.Module):
         return out
 
     def load_model_weights(self, sd, unet_prefix=""):
-        to_load = {}
+        to_load = sd.empty() if isinstance(sd, utils.LazyStateDict) else {}
         keys = list(sd.keys())
         for k in keys:
             if k.startswith(unet_prefix):
-                to_load[k[len(unet_prefix):]] = sd.pop(k)
+                utils.rename_key(sd, k, k[len(unet_prefix):], target=to_load)
 
         to_load = self.model_config.process_unet_state_dict(to_load)
-        m, u = self.diffusion_model.load_state_dict(to_load, strict=False)
+        if isinstance(to_load, utils.LazyStateDict):
+            m, u = utils.load_state_dict_streaming(self.diffusion_model, to_load)
+        else:
+            m, u = self.diffusion_model.load_state_dict(to_load, strict=False)
         if len(m) > 0:
             print("unet missing:", m)
 
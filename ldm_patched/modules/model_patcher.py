@@ -23,6 +23,8 @@ class ModelPatcher:
             self.current_device = current_device
 
         self.weight_inplace_update = weight_inplace_update
+        self.weight_cache = None
+        self.weight_cache_key = None
 
     def model_size(self):
         if self.size > 0:
@@ -41,6 +43,8 @@ class ModelPatcher:
         n.object_patches = self.object_patches.copy()
         n.model_options = copy.deepcopy(self.model_options)
         n.model_keys = self.model_keys
+        n.weight_cache = self.weight_cache
+        n.weight_cache_key = self.weight_cache_key
         return n
 
     def is_clone(self, other):
@@ -141,6 +145,8 @@ class ModelPatcher:
             return self.model.get_dtype()
 
     def add_patches(self, patches, strength_patch=1.0, strength_model=1.0):
+        # merged weights cached under the old key no longer match the patches
+        self.weight_cache_key = None
         p = set()
         for k in patches:
             if k in self.model_keys:
@@ -183,11 +189,28 @@ class ModelPatcher:
 
         if patch_weights:
             model_sd = self.model_state_dict()
+            keys = [key for key in self.patches if key in model_sd]
             for key in self.patches:
                 if key not in model_sd:
                     print("could not patch. key doesn't exist in model:", key)
-                    continue
 
+            # the merged weights of all keys are cached as one entry, a stack is either merged or loaded as a whole
+            merged_weights = None
+            cache_merged_weights = False
+            if self.weight_cache is not None and self.weight_cache_key is not None:
+                merged_weights = self.weight_cache.get(self.weight_cache_key)
+                if merged_weights is not None and any(key not in merged_weights for key in keys):
+                    merged_weights = None
+                # copying a stack that the cache cannot hold to the CPU would be wasted
+                if merged_weights is None:
+                    merged_bytes = sum(model_sd[key].nelement() * model_sd[key].element_size() for key in keys)
+                    cache_merged_weights = merged_bytes <= self.weight_cache.max_bytes
+                    if not cache_merged_weights:
+                        print(f'[{self.weight_cache.name}] Merged weights of {merged_bytes / (1024 * 1024):.0f} MB '
+                              f'exceed the cache size of {self.weight_cache.max_bytes / (1024 * 1024):.0f} MB, not cached.')
+            new_merged_weights = {}
+
+            for key in keys:
                 weight = model_sd[key]
 
                 inplace_update = self.weight_inplace_update
@@ -195,16 +218,25 @@ class ModelPatcher:
                 if key not in self.backup:
                     self.backup[key] = weight.to(device=self.offload_device, copy=inplace_update)
 
-                if device_to is not None:
-                    temp_weight = ldm_patched.modules.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+                if merged_weights is not None:
+                    out_weight = merged_weights[key].to(device=weight.device if device_to is None else device_to, dtype=weight.dtype, copy=True)
                 else:
-                    temp_weight = weight.to(torch.float32, copy=True)
-                out_weight = self.calculate_weight(self.patches[key], temp_weight, key).to(weight.dtype)
+                    if device_to is not None:
+                        temp_weight = ldm_patched.modules.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+                    else:
+                        temp_weight = weight.to(torch.float32, copy=True)
+                    out_weight = self.calculate_weight(self.patches[key], temp_weight, key).to(weight.dtype)
+                    del temp_weight
+                    if cache_merged_weights:
+                        new_merged_weights[key] = out_weight.to('cpu', copy=True)
+
                 if inplace_update:
                     ldm_patched.modules.utils.copy_to_param(self.model, key, out_weight)
                 else:
                     ldm_patched.modules.utils.set_attr(self.model, key, out_weight)
-                del temp_weight
+
+            if cache_merged_weights:
+                self.weight_cache.put(self.weight_cache_key, new_merged_weights)
 
             if device_to is not None:
                 self.model.to(device_to)
@@ -505,6 +505,9 @@ def encode_model_conds(model_function, conds, noise, device, prompt_type, **kwar
     return conds
 
 class Sampler:
+    # whether the model is only called with sigmas[i] before the callback of step i, see KSAMPLERS_WITH_SIGMAS_OF_THEIR_OWN
+    steps_follow_sigmas = True
+
     def sample(self):
         pass
 
@@ -525,6 +528,10 @@ KSAMPLER_NAMES = ["euler", "euler_ancestral", "heun", "heunpp2","dpm_2", "dpm_2_
                   "lms", "dpm_fast", "dpm_adaptive", "dpmpp_2s_ancestral", "dpmpp_sde", "dpmpp_sde_gpu",
                   "dpmpp_2m", "dpmpp_2m_sde", "dpmpp_2m_sde_gpu", "dpmpp_3m_sde", "dpmpp_3m_sde_gpu", "ddpm", "lcm", "tcd", "edm_playground_v2.5", "restart"]
 
+# samplers that also call the model between the sigmas (second order steps, restarts) or with sigmas of their own
+KSAMPLERS_WITH_SIGMAS_OF_THEIR_OWN = ["heun", "heunpp2", "dpm_2", "dpm_2_ancestral", "dpm_fast", "dpm_adaptive",
+                                      "dpmpp_2s_ancestral", "dpmpp_sde", "dpmpp_sde_gpu", "restart"]
+
 class KSAMPLER(Sampler):
     def __init__(self, sampler_function, extra_options={}, inpaint_options={}):
         self.sampler_function = sampler_function
@@ -577,7 +584,10 @@ def ksampler(sampler_name, extra_options={}, inpaint_options={}):
     else:
         sampler_function = getattr(k_diffusion_sampling, "sample_{}".format(sampler_name))
 
-    return KSAMPLER(sampler_function, extra_options, inpaint_options)
+    sampler = KSAMPLER(sampler_function, extra_options, inpaint_options)
+    if sampler_name in KSAMPLERS_WITH_SIGMAS_OF_THEIR_OWN:
+        sampler.steps_follow_sigmas = False
+    return sampler
 
 def wrap_model(model):
     model_denoise = CFGNoisePredictor(model)
@@ -23,6 +23,12 @@ import ldm_patched.modules.supported_models_base
 import ldm_patched.taesd.taesd
 
 def load_model_weights(model, sd):
+    if isinstance(sd, ldm_patched.modules.utils.LazyStateDict):
+        m, u = ldm_patched.modules.utils.load_state_dict_streaming(model, sd)
+        if len(m) > 0:
+            print("extra", m)
+        return model
+
     m, u = model.load_state_dict(sd, strict=False)
     m = set(m)
     unexpected_keys = set(u)
@@ -200,31 +206,39 @@ class VAE:
 
         self.patcher = ldm_patched.modules.model_patcher.ModelPatcher(self.first_stage_model, load_device=self.device, offload_device=offload_device)
 
-    def decode_tiled_(self, samples, tile_x=64, tile_y=64, overlap = 16):
-        steps = samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x, tile_y, overlap)
-        steps += samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x // 2, tile_y * 2, overlap)
-        steps += samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x * 2, tile_y // 2, overlap)
+    def tiled_batch_size(self, memory_used, tile_shape):
+        free_memory = model_management.get_free_memory(self.device)
+        return max(1, int(free_memory / memory_used(tile_shape, self.vae_dtype)))
+
+    @torch.inference_mode()
+    def decode_tiled_(self, samples, tile_x=64, tile_y=64, overlap = 16, single_pass=False):
+        tile_shapes = [(tile_x, tile_y)] if single_pass else [(tile_x // 2, tile_y * 2), (tile_x * 2, tile_y // 2), (tile_x, tile_y)]
+        steps = sum(samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tx, ty, overlap) for tx, ty in tile_shapes)
         pbar = ldm_patched.modules.utils.ProgressBar(steps)
 
         decode_fn = lambda a: (self.first_stage_model.decode(a.to(self.vae_dtype).to(self.device)) + 1.0).float()
-        output = torch.clamp((
-            (ldm_patched.modules.utils.tiled_scale(samples, decode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar) +
-            ldm_patched.modules.utils.tiled_scale(samples, decode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar) +
-             ldm_patched.modules.utils.tiled_scale(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar))
-            / 3.0) / 2.0, min=0.0, max=1.0)
-        return output
-
-    def encode_tiled_(self, pixel_samples, tile_x=512, tile_y=512, overlap = 64):
-        steps = pixel_samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x, tile_y, overlap)
-        steps += pixel_samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x // 2, tile_y * 2, overlap)
-        steps += pixel_samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x * 2, tile_y // 2, overlap)
+        output = None
+        for tx, ty in tile_shapes:
+            batch_size = self.tiled_batch_size(self.memory_used_decode, (1, samples.shape[1], ty, tx))
+            pass_output = ldm_patched.modules.utils.tiled_scale(samples, decode_fn, tx, ty, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar, max_batch_size=batch_size)
+            output = pass_output if output is None else output.add_(pass_output)
+        output /= float(len(tile_shapes))
+        output /= 2.0
+        return output.clamp_(min=0.0, max=1.0)
+
+    @torch.inference_mode()
+    def encode_tiled_(self, pixel_samples, tile_x=512, tile_y=512, overlap = 64, single_pass=False):
+        tile_shapes = [(tile_x, tile_y)] if single_pass else [(tile_x, tile_y), (tile_x * 2, tile_y // 2), (tile_x // 2, tile_y * 2)]
+        steps = sum(pixel_samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tx, ty, overlap) for tx, ty in tile_shapes)
         pbar = ldm_patched.modules.utils.ProgressBar(steps)
 
         encode_fn = lambda a: self.first_stage_model.encode((2. * a - 1.).to(self.vae_dtype).to(self.device)).float()
-        samples = ldm_patched.modules.utils.tiled_scale(pixel_samples, encode_fn, tile_x, tile_y, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
-        samples += ldm_patched.modules.utils.tiled_scale(pixel_samples, encode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
-        samples += ldm_patched.modules.utils.tiled_scale(pixel_samples, encode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
-        samples /= 3.0
+        samples = None
+        for tx, ty in tile_shapes:
+            batch_size = self.tiled_batch_size(self.memory_used_encode, (1, pixel_samples.shape[1], ty, tx))
+            pass_samples = ldm_patched.modules.utils.tiled_scale(pixel_samples, encode_fn, tx, ty, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar, max_batch_size=batch_size)
+            samples = pass_samples if samples is None else samples.add_(pass_samples)
+        samples /= float(len(tile_shapes))
         return samples
 
     def decode(self, samples_in):
@@ -246,9 +260,9 @@ class VAE:
         pixel_samples = pixel_samples.to(self.output_device).movedim(1,-1)
         return pixel_samples
 
-    def decode_tiled(self, samples, tile_x=64, tile_y=64, overlap = 16):
+    def decode_tiled(self, samples, tile_x=64, tile_y=64, overlap = 16, single_pass=False):
         model_management.load_model_gpu(self.patcher)
-        output = self.decode_tiled_(samples, tile_x, tile_y, overlap)
+        output = self.decode_tiled_(samples, tile_x, tile_y, overlap, single_pass)
         return output.movedim(1,-1)
 
     def encode(self, pixel_samples):
@@ -270,10 +284,10 @@ class VAE:
 
         return samples
 
-    def encode_tiled(self, pixel_samples, tile_x=512, tile_y=512, overlap = 64):
+    def encode_tiled(self, pixel_samples, tile_x=512, tile_y=512, overlap = 64, single_pass=False):
         model_management.load_model_gpu(self.patcher)
         pixel_samples = pixel_samples.movedim(-1,1)
-        samples = self.encode_tiled_(pixel_samples, tile_x=tile_x, tile_y=tile_y, overlap=overlap)
+        samples = self.encode_tiled_(pixel_samples, tile_x=tile_x, tile_y=tile_y, overlap=overlap, single_pass=single_pass)
         return samples
 
     def get_sd(self):
@@ -428,7 +442,8 @@ def load_checkpoint(config_path=None, ckpt_path=None, output_vae=True, output_cl
     return (ldm_patched.modules.model_patcher.ModelPatcher(model, load_device=model_management.get_torch_device(), offload_device=offload_device), clip, vae)
 
 def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, vae_filename_param=None):
-    sd = ldm_patched.modules.utils.load_torch_file(ckpt_path)
+    # safetensors checkpoints are read with positioned reads and streamed into the models one tensor at a time
+    sd = ldm_patched.modules.utils.load_torch_file(ckpt_path, lazy=True)
     sd_keys = sd.keys()
     clip = None
     clipvision = None
@@ -484,6 +499,10 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
     if len(left_over) > 0:
         print("left over keys:", left_over)
 
+    if isinstance(sd, ldm_patched.modules.utils.LazyStateDict):
+        # every tensor the models use has been copied into them
+        sd.close()
+
     if output_model:
         model_patcher = ldm_patched.modules.model_patcher.ModelPatcher(model, load_device=load_device, offload_device=model_management.unet_offload_device(), current_device=inital_load_device)
         if inital_load_device != torch.device("cpu"):
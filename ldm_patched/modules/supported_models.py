@@ -32,7 +32,7 @@ class SD15(supported_models_base.BASE):
         for x in k:
             if x.startswith("cond_stage_model.transformer.") and not x.startswith("cond_stage_model.transformer.text_model."):
                 y = x.replace("cond_stage_model.transformer.", "cond_stage_model.transformer.text_model.")
-                state_dict[y] = state_dict.pop(x)
+                utils.rename_key(state_dict, x, y)
 
         if 'cond_stage_model.transformer.text_model.embeddings.position_ids' in state_dict:
             ids = state_dict['cond_stage_model.transformer.text_model.embeddings.position_ids']
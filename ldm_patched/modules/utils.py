@@ -1,15 +1,150 @@
 import torch
 import math
 import struct
+import collections.abc
+import json
+import os
+import threading
 import ldm_patched.modules.checkpoint_pickle
 import safetensors.torch
 import numpy as np
 from PIL import Image
 
-def load_torch_file(ckpt, safe_load=False, device=None):
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES.update({"F8_E4M3": torch.float8_e4m3fn, "F8_E5M2": torch.float8_e5m2})
+
+
+class SafetensorsReader:
+    """
+    Reads single tensors from a safetensors file with positioned reads. Unlike a memory map, the pages of
+    tensors that were already copied into a model do not stay resident and count towards the process memory.
+    The file stays open until close().
+    """
+
+    def __init__(self, filename, device="cpu"):
+        self.filename = filename
+        self.device = device
+        self.lock = threading.Lock()
+        self.file = open(filename, "rb", buffering=0)
+        try:
+            header_size = struct.unpack("<Q", self.read_exactly(8))[0]
+            header = json.loads(self.read_exactly(header_size))
+            header.pop("__metadata__", None)
+            self.header = header
+            self.data_start = 8 + header_size
+            data_end = max([info["data_offsets"][1] for info in header.values()], default=0)
+            if self.data_start + data_end > os.fstat(self.file.fileno()).st_size:
+                raise ValueError(f"Safetensors file is truncated: {filename}")
+        except Exception:
+            self.file.close()
+            raise
+
+    def read_exactly(self, size):
+        data = self.file.read(size)
+        if data is None or len(data) != size:
+            raise ValueError(f"Safetensors file is truncated: {self.filename}")
+        return data
+
+    def keys(self):
+        return self.header.keys()
+
+    def get_shape(self, key):
+        return tuple(self.header[key]["shape"])
+
+    def get_tensor(self, key):
+        info = self.header[key]
+        begin, end = info["data_offsets"]
+        buffer = torch.empty(end - begin, dtype=torch.uint8)
+        view = memoryview(buffer.numpy())
+        read = 0
+        with self.lock:
+            self.file.seek(self.data_start + begin)
+            while read < len(view):
+                count = self.file.readinto(view[read:])
+                if not count:
+                    break
+                read += count
+        if read != len(view):
+            raise ValueError(f"Safetensors file is truncated: {self.filename}, "
+                             f"read {read} of {len(view)} bytes of {key}")
+        tensor = buffer.view(SAFETENSORS_DTYPES[info["dtype"]]).reshape(info["shape"])
+        if self.device != "cpu":
+            tensor = tensor.to(self.device)
+        return tensor
+
+    def close(self):
+        self.file.close()
+
+
+class LazyStateDict(collections.abc.MutableMapping):
+    """
+    State dict backed by a safetensors file. Tensors are read from the file one at a time when they are
+    accessed, renaming keys through rename_key() does not read them at all.
+    """
+
+    def __init__(self, handle, sources=None):
+        self.handle = handle
+        self.sources = sources if sources is not None else {k: k for k in handle.keys()}  # key -> file key or tensor
+
+    def __getitem__(self, key):
+        source = self.sources[key]
+        if isinstance(source, str):
+            return self.handle.get_tensor(source)
+        return source
+
+    def __setitem__(self, key, value):
+        self.sources[key] = value
+
+    def __delitem__(self, key):
+        del self.sources[key]
+
+    def __contains__(self, key):
+        return key in self.sources
+
+    def __iter__(self):
+        return iter(list(self.sources))
+
+    def __len__(self):
+        return len(self.sources)
+
+    def keys(self):
+        return self.sources.keys()
+
+    def shape(self, key):
+        source = self.sources[key]
+        if isinstance(source, str):
+            return self.handle.get_shape(source)
+        return tuple(source.shape)
+
+    def empty(self):
+        return LazyStateDict(self.handle, {})
+
+    def move_key(self, key, target, new_key):
+        target.sources[new_key] = self.sources.pop(key)
+
+    def close(self):
+        self.handle.close()
+
+
+def rename_key(sd, key, new_key, target=None):
+    if target is None:
+        target = sd
+    if isinstance(sd, LazyStateDict) and isinstance(target, LazyStateDict):
+        sd.move_key(key, target, new_key)
+    else:
+        target[new_key] = sd.pop(key)
+
+
+def load_torch_file(ckpt, safe_load=False, device=None, lazy=False):
     if device is None:
         device = torch.device("cpu")
-    if ckpt.lower().endswith(".safetensors"):
+    if ckpt.lower().endswith(".safetensors") and lazy:
+        sd = LazyStateDict(SafetensorsReader(ckpt, device=device.type))
+    elif ckpt.lower().endswith(".safetensors"):
         sd = safetensors.torch.load_file(ckpt, device=device.type)
     else:
         if safe_load:
@@ -38,27 +173,53 @@ def calculate_parameters(sd, prefix=""):
     params = 0
     for k in sd.keys():
         if k.startswith(prefix):
-            params += sd[k].nelement()
+            if isinstance(sd, LazyStateDict):
+                params += math.prod(sd.shape(k))
+            else:
+                params += sd[k].nelement()
     return params
 
 def state_dict_key_replace(state_dict, keys_to_replace):
     for x in keys_to_replace:
         if x in state_dict:
-            state_dict[keys_to_replace[x]] = state_dict.pop(x)
+            rename_key(state_dict, x, keys_to_replace[x])
     return state_dict
 
 def state_dict_prefix_replace(state_dict, replace_prefix, filter_keys=False):
     if filter_keys:
-        out = {}
+        out = state_dict.empty() if isinstance(state_dict, LazyStateDict) else {}
     else:
         out = state_dict
     for rp in replace_prefix:
         replace = list(map(lambda a: (a, "{}{}".format(replace_prefix[rp], a[len(rp):])), filter(lambda a: a.startswith(rp), state_dict.keys())))
         for x in replace:
-            w = state_dict.pop(x[0])
-            out[x[1]] = w
+            rename_key(state_dict, x[0], x[1], target=out)
     return out
 
+def load_state_dict_streaming(module, sd):
+    """
+    Like module.load_state_dict(sd, strict=False) followed by popping the loaded keys from sd, but copies
+    tensors into the module one at a time so that a LazyStateDict is never fully materialized.
+    Returns the missing and unexpected keys.
+    """
+    own_state = module.state_dict(keep_vars=True)
+    unexpected = []
+    with torch.no_grad():
+        for k in list(sd.keys()):
+            if k not in own_state:
+                unexpected.append(k)
+                continue
+            param = own_state.pop(k)
+            input_param = sd.pop(k)
+            if len(param.shape) == 0 and len(input_param.shape) == 1:
+                input_param = input_param[0]
+            if input_param.shape != param.shape:
+                raise RuntimeError(f"size mismatch for {k}: copying a param with shape {tuple(input_param.shape)}, "
+                                   f"the shape in current model is {tuple(param.shape)}.")
+            param.copy_(input_param)
+            del input_param
+    return list(own_state.keys()), unexpected
+
 
 def transformers_convert(sd, prefix_from, prefix_to, number):
     keys_to_replace = {
@@ -71,7 +232,7 @@ def transformers_convert(sd, prefix_from, prefix_to, number):
     for k in keys_to_replace:
         x = k.format(prefix_from)
         if x in sd:
-            sd[keys_to_replace[k].format(prefix_to)] = sd.pop(x)
+            rename_key(sd, x, keys_to_replace[k].format(prefix_to))
 
     resblock_to_replace = {
         "ln_1": "layer_norm1",
@@ -87,7 +248,7 @@ def transformers_convert(sd, prefix_from, prefix_to, number):
                 k = "{}transformer.resblocks.{}.{}.{}".format(prefix_from, resblock, x, y)
                 k_to = "{}encoder.layers.{}.{}.{}".format(prefix_to, resblock, resblock_to_replace[x], y)
                 if k in sd:
-                    sd[k_to] = sd.pop(k)
+                    rename_key(sd, k, k_to)
 
         for y in ["weight", "bias"]:
             k_from = "{}transformer.resblocks.{}.attn.in_proj_{}".format(prefix_from, resblock, y)
@@ -404,32 +565,56 @@ def common_upscale(samples, width, height, upscale_method, crop):
 def get_tiled_scale_steps(width, height, tile_x, tile_y, overlap):
     return math.ceil((height / (tile_y - overlap))) * math.ceil((width / (tile_x - overlap)))
 
+def tiled_feather_mask(height, width, feather, device="cpu"):
+    # same weights as multiplying the border rows and columns by (t + 1) / feather one at a time
+    def ramp(n):
+        i = torch.arange(n, dtype=torch.float32, device=device)
+        return torch.clamp((1.0 / feather) * (i + 1), max=1.0) * torch.clamp((1.0 / feather) * (n - i), max=1.0)
+
+    if feather < 1:
+        return torch.ones((height, width), device=device)
+    return ramp(height)[:, None] * ramp(width)[None, :]
+
 @torch.inference_mode()
-def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None):
-    output = torch.empty((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)), device=output_device)
-    for b in range(samples.shape[0]):
-        s = samples[b:b+1]
-        out = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
-        out_div = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
-        for y in range(0, s.shape[2], tile_y - overlap):
-            for x in range(0, s.shape[3], tile_x - overlap):
-                s_in = s[:,:,y:y+tile_y,x:x+tile_x]
-
-                ps = function(s_in).to(output_device)
-                mask = torch.ones_like(ps)
-                feather = round(overlap * upscale_amount)
-                for t in range(feather):
-                        mask[:,:,t:1+t,:] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,mask.shape[2] -1 -t: mask.shape[2]-t,:] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,:,t:1+t] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,:,mask.shape[3]- 1 - t: mask.shape[3]- t] *= ((1.0/feather) * (t + 1))
-                out[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += ps * mask
-                out_div[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += mask
-                if pbar is not None:
-                    pbar.update(1)
-
-        output[b:b+1] = out/out_div
-    return output
+def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None, max_batch_size = 1):
+    """
+    Applies function to overlapping tiles of samples and blends the results with feathered borders.
+    Tiles of the same shape are passed to function together, up to max_batch_size at a time, so function must
+    process every item of its input batch independently.
+    """
+    output = torch.zeros((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)), device=output_device)
+    weight = torch.zeros((1, 1, output.shape[2], output.shape[3]), device=output_device)
+    feather = round(overlap * upscale_amount)
+    masks = {}
+
+    tiles = {}
+    for y in range(0, samples.shape[2], tile_y - overlap):
+        for x in range(0, samples.shape[3], tile_x - overlap):
+            shape = (min(tile_y, samples.shape[2] - y), min(tile_x, samples.shape[3] - x))
+            tiles.setdefault(shape, []).extend((b, y, x) for b in range(samples.shape[0]))
+
+    max_batch_size = max(1, max_batch_size)
+    batches = [((h, w), positions[i:i + max_batch_size]) for (h, w), positions in tiles.items()
+               for i in range(0, len(positions), max_batch_size)]
+
+    def run(job):
+        (h, w), batch = job
+        return function(torch.cat([samples[b:b+1, :, y:y+h, x:x+w] for b, y, x in batch])).to(output_device)
+
+    for (_, batch), ps in zip(batches, map(run, batches)):
+        ph, pw = ps.shape[2], ps.shape[3]
+        if (ph, pw) not in masks:
+            masks[(ph, pw)] = tiled_feather_mask(ph, pw, feather, output_device)
+        mask = masks[(ph, pw)]
+        for p, (b, y, x) in zip(ps, batch):
+            oy, ox = round(y * upscale_amount), round(x * upscale_amount)
+            output[b, :, oy:oy+ph, ox:ox+pw].addcmul_(p, mask)
+            if b == 0:
+                weight[0, :, oy:oy+ph, ox:ox+pw] += mask
+        if pbar is not None:
+            pbar.update(len(batch))
+
+    return output.div_(weight)
 
 PROGRESS_BAR_ENABLED = True
 def set_progress_bar_enabled(enabled):
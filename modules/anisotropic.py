@@ -115,6 +115,60 @@ def _bilateral_blur(
     return out
 
 
+def _bilateral_blur_accumulate(
+    input: Tensor,
+    guidance: Tensor | None,
+    kernel_size: tuple[int, int] | int,
+    sigma_color: float | Tensor,
+    sigma_space: tuple[float, float] | Tensor,
+    border_type: str = 'reflect',
+    color_distance_type: str = 'l1',
+) -> Tensor:
+    # Same result as _bilateral_blur, but the weighted sum is accumulated one kernel offset at a time instead of
+    # unfolding all Ky x Kx neighbours, so that it needs a few buffers of the input size instead of (B, C, H, W, Ky x Kx)
+    # ones for the input, the guidance and every intermediate.
+
+    if color_distance_type not in ['l1', 'l2']:
+        raise ValueError("color_distance_type only acceps l1 or l2")
+
+    if isinstance(sigma_color, Tensor):
+        sigma_color = sigma_color.to(device=input.device, dtype=input.dtype).view(-1, 1, 1, 1)
+
+    ky, kx = _unpack_2d_ks(kernel_size)
+    pad_y, pad_x = _compute_zero_padding(kernel_size)
+    height, width = input.shape[-2:]
+
+    padded_input = pad(input, (pad_x, pad_x, pad_y, pad_y), mode=border_type)
+
+    if guidance is None:
+        guidance = input
+        padded_guidance = padded_input
+    else:
+        padded_guidance = pad(guidance, (pad_x, pad_x, pad_y, pad_y), mode=border_type)
+
+    space_kernel = get_gaussian_kernel2d(kernel_size, sigma_space, device=input.device, dtype=input.dtype)
+    space_kernel = space_kernel.view(-1, ky * kx, 1, 1, 1)
+    color_scale = -0.5 / sigma_color ** 2
+
+    # accumulate in float32 so that half precision inputs do not lose precision over the Ky x Kx additions
+    accumulate_dtype = torch.promote_types(input.dtype, torch.float32)
+    numerator = torch.zeros(input.shape, device=input.device, dtype=accumulate_dtype)
+    denominator = torch.zeros((input.shape[0], 1, height, width), device=input.device, dtype=accumulate_dtype)
+
+    for y in range(ky):
+        for x in range(kx):
+            diff = padded_guidance[:, :, y:y + height, x:x + width] - guidance
+            if color_distance_type == 'l1':
+                color_distance_sq = diff.abs_().sum(1, keepdim=True).square_()
+            else:
+                color_distance_sq = diff.square_().sum(1, keepdim=True)
+            kernel = color_distance_sq.mul_(color_scale).exp_().mul_(space_kernel[:, y * kx + x])
+            numerator.addcmul_(padded_input[:, :, y:y + height, x:x + width], kernel)
+            denominator.add_(kernel)
+
+    return numerator.div_(denominator).to(input.dtype)
+
+
 def bilateral_blur(
     input: Tensor,
     kernel_size: tuple[int, int] | int = (13, 13),
@@ -123,7 +177,7 @@ def bilateral_blur(
     border_type: str = 'reflect',
     color_distance_type: str = 'l1',
 ) -> Tensor:
-    return _bilateral_blur(input, None, kernel_size, sigma_color, sigma_space, border_type, color_distance_type)
+    return _bilateral_blur_accumulate(input, None, kernel_size, sigma_color, sigma_space, border_type, color_distance_type)
 
 
 def adaptive_anisotropic_filter(x, g=None):
@@ -132,7 +186,7 @@ def adaptive_anisotropic_filter(x, g=None):
     s, m = torch.std_mean(g, dim=(1, 2, 3), keepdim=True)
     s = s + 1e-5
     guidance = (g - m) / s
-    y = _bilateral_blur(x, guidance,
+    y = _bilateral_blur_accumulate(x, guidance,
                         kernel_size=(13, 13),
                         sigma_color=3.0,
                         sigma_space=3.0,
@@ -150,7 +204,7 @@ def joint_bilateral_blur(
     border_type: str = 'reflect',
     color_distance_type: str = 'l1',
 ) -> Tensor:
-    return _bilateral_blur(input, guidance, kernel_size, sigma_color, sigma_space, border_type, color_distance_type)
+    return _bilateral_blur_accumulate(input, guidance, kernel_size, sigma_color, sigma_space, border_type, color_distance_type)
 
 
 class _BilateralBlur(torch.nn.Module):
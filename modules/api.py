@@ -0,0 +1,247 @@
+import base64
+import io
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+import fooocus_version
+from modules.auth import auth_enabled, check_auth
+
+image_params = ['uov_input_image', 'inpaint_mask_image_upload', 'enhance_input_image']
+
+jobs = {}
+jobs_lock = threading.Lock()
+
+
+def decode_image(data):
+    if data is None or isinstance(data, np.ndarray):
+        return data
+    if ',' in data and data.startswith('data:'):
+        data = data.split(',', 1)[1]
+    image = Image.open(io.BytesIO(base64.b64decode(data)))
+    return np.array(image.convert('RGB'))
+
+
+def encode_image(image, output_format='png'):
+    if isinstance(image, str):
+        with open(image, 'rb') as f:
+            return base64.b64encode(f.read()).decode('ascii')
+    output_format = 'jpeg' if output_format == 'jpg' else output_format
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format=output_format.upper())
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def decode_params(params):
+    params = dict(params)
+    for key in image_params:
+        if key in params:
+            params[key] = decode_image(params[key])
+    if isinstance(params.get('inpaint_input_image'), dict):
+        params['inpaint_input_image'] = {k: decode_image(v) for k, v in params['inpaint_input_image'].items()}
+    elif 'inpaint_input_image' in params:
+        params['inpaint_input_image'] = {'image': decode_image(params['inpaint_input_image']), 'mask': None}
+    if 'image_prompts' in params:
+        params['image_prompts'] = [{**x, 'image': decode_image(x['image'])} for x in params['image_prompts']]
+    return params
+
+
+def create_task(params):
+    import modules.async_worker as worker
+
+    task = worker.AsyncTask.from_params(decode_params(params))
+    task.keep_results_in_memory = True
+    task.job_id = uuid.uuid4().hex
+    return task
+
+
+def submit_task(task, client_id=None):
+    import ldm_patched.modules.model_management as model_management
+    import modules.async_worker as worker
+
+    with model_management.interrupt_processing_mutex:
+        model_management.interrupt_processing = False
+
+    task.client_id = client_id
+    with jobs_lock:
+        jobs[task.job_id] = task
+    worker.async_tasks.put(task)
+
+
+def stop_task(task):
+    import ldm_patched.modules.model_management as model_management
+    import modules.async_worker as worker
+
+    task.last_stop = 'stop'
+    if task.processing:
+        model_management.interrupt_current_processing()
+    elif worker.async_tasks.cancel(task):
+        task.yields.append(['finish', task.results])
+
+
+def iterate_events(task):
+    """Yields (flag, product) from the task until it finishes."""
+    try:
+        while True:
+            flag, product = task.yields.get()
+            yield flag, product
+            if flag == 'finish':
+                return
+    finally:
+        with jobs_lock:
+            jobs.pop(task.job_id, None)
+
+
+def event_to_json(task, flag, product):
+    if flag == 'preview':
+        percentage, title, image = product
+        return dict(job_id=task.job_id, progress=percentage, title=title,
+                    image=encode_image(image, 'jpeg') if image is not None else None)
+
+    from modules.private_logger import output_writer
+    output_writer.wait(product)
+    return dict(job_id=task.job_id, images=[encode_image(x, task.output_format) for x in product])
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    server_version = f'Fooocus/{fooocus_version.version}'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event(self, event, obj):
+        self.wfile.write(f'event: {event}\ndata: {json.dumps(obj)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def authorized(self):
+        if not auth_enabled:
+            return True
+        header = self.headers.get('Authorization', '')
+        if not header.startswith('Basic '):
+            return False
+        try:
+            user, password = base64.b64decode(header[6:]).decode('utf-8').split(':', 1)
+        except Exception:
+            return False
+        return check_auth(user, password)
+
+    def handle_request(self, routes):
+        if not self.authorized():
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', 'Basic realm="Fooocus"')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        path = self.path.split('?', 1)[0].rstrip('/')
+        for prefix, route in routes:
+            if path == prefix or (prefix.endswith('/') and path.startswith(prefix)):
+                try:
+                    route(path[len(prefix):])
+                except (ValueError, KeyError, TypeError) as e:
+                    self.send_json({'error': str(e)}, status=400)
+                return
+        self.send_json({'error': 'Not found'}, status=404)
+
+    def do_GET(self):
+        self.handle_request([
+            ('/v1/health', self.get_health),
+            ('/v1/queue', self.get_queue),
+        ])
+
+    def do_POST(self):
+        self.handle_request([
+            ('/v1/generation', self.post_generation),
+            ('/v1/jobs/', self.post_job_action),
+        ])
+
+    def get_health(self, _):
+        self.send_json({'status': 'ok', 'version': fooocus_version.version})
+
+    def get_queue(self, _):
+        import modules.async_worker as worker
+        self.send_json(worker.async_tasks.stats())
+
+    def post_generation(self, _):
+        params = self.read_json()
+        stream = bool(params.pop('stream', False)) or 'text/event-stream' in self.headers.get('Accept', '')
+        priority = int(params.pop('priority', 0))
+        client_id = params.pop('client_id', None) or self.client_address[0]
+
+        task = create_task(params)
+        task.priority = priority
+        submit_task(task, client_id)
+
+        if not stream:
+            results = []
+            for flag, product in iterate_events(task):
+                if flag == 'finish':
+                    results = product
+            self.send_json(dict(job_id=task.job_id, seed=task.seed,
+                                images=[encode_image(x, task.output_format) for x in results]))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            self.send_event('queued', dict(job_id=task.job_id, seed=task.seed))
+            for flag, product in iterate_events(task):
+                self.send_event(flag, event_to_json(task, flag, product))
+        except (BrokenPipeError, ConnectionResetError):
+            # client went away, do not keep generating for nobody
+            stop_task(task)
+
+    def post_job_action(self, path):
+        job_id, _, action = path.partition('/')
+        with jobs_lock:
+            task = jobs.get(job_id)
+        if task is None:
+            self.send_json({'error': f'Unknown job {job_id}'}, status=404)
+            return
+        if action == 'stop':
+            stop_task(task)
+        elif action == 'skip':
+            import ldm_patched.modules.model_management as model_management
+            task.last_stop = 'skip'
+            if task.processing:
+                model_management.interrupt_current_processing()
+        else:
+            self.send_json({'error': f'Unknown action {action}'}, status=404)
+            return
+        self.send_json({'job_id': job_id, 'action': action})
+
+
+def create_server(host, port):
+    return ThreadingHTTPServer((host, port), ApiHandler)
+
+
+def start(host, port, block=False):
+    server = create_server(host, port)
+    print(f'API server listening on http://{host}:{port}/v1')
+    if block:
+        server.serve_forever()
+    else:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
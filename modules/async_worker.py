@@ -1,7 +1,12 @@
+import random
 import threading
 
+import modules.constants as constants
+import modules.flags as flags
 from extras.inpaint_mask import generate_mask_from_image, SAMOptions
 from modules.patch import PatchSettings, patch_settings, patch_all
+from modules.task_events import TaskEvents
+from modules.task_scheduler import TaskScheduler
 import modules.config
 
 patch_all()
@@ -15,12 +20,17 @@ class AsyncTask:
         import args_manager
 
         self.args = args.copy()
-        self.yields = []
+        self.yields = TaskEvents()
         self.results = []
         self.last_stop = False
         self.processing = False
+        self.client_id = None
+        self.priority = 0
+        self.keep_results_in_memory = False
 
         self.performance_loras = []
+        self.images_to_enhance_count = 0
+        self.enhance_stats = {}
 
         if len(args) == 0:
             return
@@ -155,10 +165,165 @@ class AsyncTask:
                     enhance_mask_invert
                 ])
         self.should_enhance = self.enhance_checkbox and (self.enhance_uov_method != disabled.casefold() or len(self.enhance_ctrls) > 0)
-        self.images_to_enhance_count = 0
-        self.enhance_stats = {}
 
-async_tasks = []
+    @classmethod
+    def from_params(cls, params: dict):
+        """Build a task from named parameters, see get_default_task_params() for names and defaults."""
+        from modules.flags import Performance, MetadataScheme, ip_list, disabled
+        from modules.util import get_enabled_loras
+        import args_manager
+
+        values = get_default_task_params()
+        unknown = [k for k in params if k not in values]
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown parameters: {", ".join(unknown)}')
+        values.update(params)
+
+        task = cls(args=[])
+        for k, v in values.items():
+            setattr(task, k, v)
+
+        task.aspect_ratios_selection = str(task.aspect_ratios_selection).replace('*', '×')
+        task.style_selections = list(task.style_selections)
+        task.performance_selection = Performance(task.performance_selection)
+        task.steps = task.performance_selection.steps()
+        task.original_steps = task.steps
+        task.seed = int(task.seed)
+        if task.seed < 0:
+            task.seed = random.randint(constants.MIN_SEED, constants.MAX_SEED)
+        task.loras = get_enabled_loras([(bool(enabled), str(name), float(weight)) for enabled, name, weight in task.loras])
+        if args_manager.args.disable_image_log:
+            task.save_final_enhanced_image_only = False
+        if args_manager.args.disable_metadata:
+            task.save_metadata_to_images = False
+            task.metadata_scheme = MetadataScheme.FOOOCUS
+        else:
+            task.metadata_scheme = MetadataScheme(task.metadata_scheme)
+
+        task.cn_tasks = {x: [] for x in ip_list}
+        for image_prompt in values['image_prompts']:
+            cn_type = image_prompt.get('type', flags.default_ip)
+            cn_stop, cn_weight = flags.default_parameters[cn_type]
+            task.cn_tasks[cn_type].append([image_prompt['image'], image_prompt.get('stop', cn_stop),
+                                           image_prompt.get('weight', cn_weight)])
+        del task.image_prompts
+
+        enhance_defaults = get_default_enhance_params()
+        task.enhance_ctrls = [[{**enhance_defaults, **ctrl}[k] for k in enhance_defaults]
+                              for ctrl in values['enhance_ctrls']]
+
+        task.should_enhance = task.enhance_checkbox and (task.enhance_uov_method != disabled.casefold() or len(task.enhance_ctrls) > 0)
+        return task
+
+
+def get_default_task_params():
+    import modules.config as config
+
+    return dict(
+        generate_image_grid=False,
+        prompt=config.default_prompt,
+        negative_prompt=config.default_prompt_negative,
+        style_selections=list(config.default_styles),
+        performance_selection=config.default_performance,
+        aspect_ratios_selection=config.default_aspect_ratio.split(' ')[0],
+        image_number=config.default_image_number,
+        output_format=config.default_output_format,
+        seed=-1,
+        read_wildcards_in_order=False,
+        sharpness=config.default_sample_sharpness,
+        cfg_scale=config.default_cfg_scale,
+        base_model_name=config.default_base_model_name,
+        refiner_model_name=config.default_refiner_model_name,
+        refiner_switch=config.default_refiner_switch,
+        loras=[list(lora) for lora in config.default_loras],
+        input_image_checkbox=False,
+        current_tab='uov',
+        uov_method=flags.disabled,
+        uov_input_image=None,
+        outpaint_selections=[],
+        inpaint_input_image=None,
+        inpaint_additional_prompt='',
+        inpaint_mask_image_upload=None,
+        disable_preview=False,
+        disable_intermediate_results=False,
+        disable_seed_increment=False,
+        black_out_nsfw=config.default_black_out_nsfw,
+        adm_scaler_positive=1.5,
+        adm_scaler_negative=0.8,
+        adm_scaler_end=0.3,
+        adaptive_cfg=config.default_cfg_tsnr,
+        clip_skip=config.default_clip_skip,
+        sampler_name=config.default_sampler,
+        scheduler_name=config.default_scheduler,
+        vae_name=config.default_vae,
+        overwrite_step=config.default_overwrite_step,
+        overwrite_switch=config.default_overwrite_switch,
+        overwrite_width=-1,
+        overwrite_height=-1,
+        overwrite_vary_strength=-1,
+        overwrite_upscale_strength=config.default_overwrite_upscale,
+        mixing_image_prompt_and_vary_upscale=False,
+        mixing_image_prompt_and_inpaint=False,
+        debugging_cn_preprocessor=False,
+        skipping_cn_preprocessor=False,
+        canny_low_threshold=64,
+        canny_high_threshold=128,
+        refiner_swap_method=flags.refiner_swap_method,
+        controlnet_softness=0.25,
+        freeu_enabled=False,
+        freeu_b1=1.01,
+        freeu_b2=1.02,
+        freeu_s1=0.99,
+        freeu_s2=0.95,
+        debugging_inpaint_preprocessor=False,
+        inpaint_disable_initial_latent=False,
+        inpaint_engine=config.default_inpaint_engine_version,
+        inpaint_strength=1.0,
+        inpaint_respective_field=0.618,
+        inpaint_advanced_masking_checkbox=config.default_inpaint_advanced_masking_checkbox,
+        invert_mask_checkbox=config.default_invert_mask_checkbox,
+        inpaint_erode_or_dilate=0,
+        save_final_enhanced_image_only=config.default_save_only_final_enhanced_image,
+        save_metadata_to_images=config.default_save_metadata_to_images,
+        metadata_scheme=config.default_metadata_scheme,
+        image_prompts=[],
+        debugging_dino=False,
+        dino_erode_or_dilate=0,
+        debugging_enhance_masks_checkbox=False,
+        enhance_input_image=None,
+        enhance_checkbox=False,
+        enhance_uov_method=config.default_enhance_uov_method,
+        enhance_uov_processing_order=config.default_enhance_uov_processing_order,
+        enhance_uov_prompt_type=config.default_enhance_uov_prompt_type,
+        enhance_ctrls=[],
+        keep_results_in_memory=False,
+    )
+
+
+def get_default_enhance_params():
+    import modules.config as config
+
+    # same order as the values unpacked from AsyncTask.enhance_ctrls in handler()
+    return dict(
+        mask_dino_prompt_text='',
+        prompt='',
+        negative_prompt='',
+        mask_model=config.default_enhance_inpaint_mask_model,
+        mask_cloth_category=config.default_inpaint_mask_cloth_category,
+        mask_sam_model=config.default_inpaint_mask_sam_model,
+        mask_text_threshold=0.25,
+        mask_box_threshold=0.3,
+        mask_sam_max_detections=config.default_sam_max_detections,
+        inpaint_disable_initial_latent=False,
+        inpaint_engine=config.default_inpaint_engine_version,
+        inpaint_strength=1.0,
+        inpaint_respective_field=0.618,
+        inpaint_erode_or_dilate=0,
+        mask_invert=False,
+    )
+
+
+async_tasks = TaskScheduler()
 
 
 class EarlyReturnException(BaseException):
@@ -187,12 +352,14 @@ def worker():
     import modules.inpaint_worker as inpaint_worker
     import modules.constants as constants
     import extras.ip_adapter as ip_adapter
+    import extras.censor
     import extras.face_crop
     import fooocus_version
+    import args_manager
 
     from extras.censor import default_censor
     from modules.sdxl_styles import apply_style, get_random_style, fooocus_expansion, apply_arrays, random_style_name
-    from modules.private_logger import log
+    from modules.private_logger import log, output_writer
     from extras.expansion import safe_str
     from modules.util import (remove_empty_str, HWC3, resize_image, get_image_shape_ceil, set_image_shape_ceil,
                               get_shape_ceil, resample_image, erode_or_dilate, parse_lora_references_from_prompt,
@@ -239,6 +406,8 @@ def worker():
         if len(async_task.results) < 2:
             return
 
+        output_writer.wait(async_task.results)
+
         for img in async_task.results:
             if isinstance(img, str) and os.path.exists(img):
                 img = cv2.imread(img)
@@ -280,7 +449,7 @@ def worker():
     def process_task(all_steps, async_task, callback, controlnet_canny_path, controlnet_cpds_path, current_task_id,
                      denoising_strength, final_scheduler_name, goals, initial_latent, steps, switch, positive_cond,
                      negative_cond, task, loras, tiled, use_expansion, width, height, base_progress, preparation_steps,
-                     total_count, show_intermediate_results, persist_image=True):
+                     total_count, show_intermediate_results, persist_image=True, defer_saving=False):
         if async_task.last_stop is not False:
             ldm_patched.modules.model_management.interrupt_current_processing()
         if 'cn' in goals:
@@ -292,6 +461,7 @@ def worker():
                     positive_cond, negative_cond = core.apply_controlnet(
                         positive_cond, negative_cond,
                         pipeline.loaded_ControlNets[cn_path], cn_img, cn_weight, 0, cn_stop)
+        batch = task if isinstance(task, list) else [task]
         imgs = pipeline.process_diffusion(
             positive_cond=positive_cond,
             negative_cond=negative_cond,
@@ -299,7 +469,7 @@ def worker():
             switch=switch,
             width=width,
             height=height,
-            image_seed=task['task_seed'],
+            image_seed=[t['task_seed'] for t in batch] if len(batch) > 1 else batch[0]['task_seed'],
             callback=callback,
             sampler_name=async_task.sampler_name,
             scheduler_name=final_scheduler_name,
@@ -313,17 +483,47 @@ def worker():
         del positive_cond, negative_cond  # Save memory
         if inpaint_worker.current_task is not None:
             imgs = [inpaint_worker.current_task.post_process(x) for x in imgs]
-        current_progress = int(base_progress + (100 - preparation_steps) / float(all_steps) * steps)
+        current_progress = int(base_progress + (100 - preparation_steps) / float(all_steps) * steps * len(batch))
+        censored_imgs = None
         if modules.config.default_black_out_nsfw or async_task.black_out_nsfw:
             progressbar(async_task, current_progress, 'Checking for NSFW content ...')
-            imgs = default_censor(imgs)
-        progressbar(async_task, current_progress, f'Saving image {current_task_id + 1}/{total_count} to system ...')
-        img_paths = save_and_log(async_task, height, imgs, task, use_expansion, width, loras, persist_image)
-        yield_result(async_task, img_paths, current_progress, async_task.black_out_nsfw, False,
-                     do_not_show_finished_images=not show_intermediate_results or async_task.disable_intermediate_results)
-
+            censored_imgs = extras.censor.censor.submit(imgs)
+
+        def save(progress=current_progress):
+            checked_imgs = imgs if censored_imgs is None else censored_imgs.result()
+            img_paths = []
+            for i, (x, t) in enumerate(zip(checked_imgs, batch)):
+                progressbar(async_task, progress, f'Saving image {current_task_id + i + 1}/{total_count} to system ...')
+                img_paths += save_and_log(async_task, height, [x], t, use_expansion, width, loras, persist_image)
+            yield_result(async_task, img_paths, progress, async_task.black_out_nsfw, False,
+                         do_not_show_finished_images=not show_intermediate_results or async_task.disable_intermediate_results)
+            return checked_imgs, img_paths
+
+        # lets the caller sample the next batch while the NSFW check of this one runs, then save it with the progress
+        # reached by then
+        if defer_saving:
+            return save, current_progress
+
+        imgs, img_paths = save()
         return imgs, img_paths, current_progress
 
+    def get_task_batches(async_task, tasks, goals, width, height):
+        if 'inpaint' in goals or 'cn' in goals or async_task.sampler_name not in pipeline.batchable_sampler_names:
+            return [[task] for task in tasks]
+
+        max_batch_size = pipeline.get_sampling_batch_size(width, height, args_manager.args.max_sampling_batch_size)
+
+        def shapes(task):
+            return [c.shape for c, p in task['c']], [c.shape for c, p in task['uc']]
+
+        batches = []
+        for task in tasks:
+            if len(batches) > 0 and len(batches[-1]) < max_batch_size and shapes(batches[-1][0]) == shapes(task):
+                batches[-1].append(task)
+            else:
+                batches.append([task])
+        return batches
+
     def apply_patch_settings(async_task):
         patch_settings[pid] = PatchSettings(
             async_task.sharpness,
@@ -331,10 +531,14 @@ def worker():
             async_task.adm_scaler_positive,
             async_task.adm_scaler_negative,
             async_task.controlnet_softness,
-            async_task.adaptive_cfg
+            async_task.adaptive_cfg,
+            modules.config.default_deep_cache_interval if async_task.performance_selection == Performance.DEEP_CACHE else 0
         )
 
     def save_and_log(async_task, height, imgs, task, use_expansion, width, loras, persist_image=True) -> list:
+        if async_task.keep_results_in_memory:
+            return list(imgs)
+
         img_paths = []
         for x in imgs:
             d = [('Prompt', 'prompt', task['log_positive_prompt']),
@@ -732,26 +936,34 @@ def worker():
         if use_expansion:
             if advance_progress:
                 current_progress += 1
-            for i, t in enumerate(tasks):
-
-                progressbar(async_task, current_progress, f'Preparing Fooocus text #{i + 1} ...')
-                expansion = pipeline.final_expansion(t['task_prompt'], t['task_seed'])
+            progressbar(async_task, current_progress, 'Preparing Fooocus text ...')
+            expansions = pipeline.final_expansion.expand([t['task_prompt'] for t in tasks],
+                                                         [t['task_seed'] for t in tasks])
+            for t, expansion in zip(tasks, expansions):
                 print(f'[Prompt Expansion] {expansion}')
                 t['expansion'] = expansion
                 t['positive'] = copy.deepcopy(t['positive']) + [expansion]  # Deep copy.
         if advance_progress:
             current_progress += 1
+        use_negative = abs(float(async_task.cfg_scale) - 1.0) >= 1e-4
+        progressbar(async_task, current_progress, 'Encoding prompts ...')
+        # encode the unique texts of all tasks together, the conds of every task are assembled from them
+        encoded = pipeline.clip_encode_texts([text for t in tasks for text in t['positive']] +
+                                             [text for t in tasks for text in t['negative'] if use_negative])
         for i, t in enumerate(tasks):
             progressbar(async_task, current_progress, f'Encoding positive #{i + 1} ...')
-            t['c'] = pipeline.clip_encode(texts=t['positive'], pool_top_k=t['positive_top_k'])
+            t['c'] = pipeline.clip_encode(texts=t['positive'], pool_top_k=t['positive_top_k'], encoded=encoded)
         if advance_progress:
             current_progress += 1
         for i, t in enumerate(tasks):
-            if abs(float(async_task.cfg_scale) - 1.0) < 1e-4:
+            if not use_negative:
                 t['uc'] = pipeline.clone_cond(t['c'])
             else:
                 progressbar(async_task, current_progress, f'Encoding negative #{i + 1} ...')
-                t['uc'] = pipeline.clip_encode(texts=t['negative'], pool_top_k=t['negative_top_k'])
+                t['uc'] = pipeline.clip_encode(texts=t['negative'], pool_top_k=t['negative_top_k'], encoded=encoded)
+        clip_cache_stats = pipeline.clip_cond_cache.stats()
+        print(f'[CLIP Cache] {clip_cache_stats["hits"] + clip_cache_stats["disk_hits"]} hits, '
+              f'{clip_cache_stats["misses"]} misses, {clip_cache_stats["entries"]} entries')
         return tasks, use_expansion, loras, current_progress
 
     def apply_freeu(async_task):
@@ -988,7 +1200,8 @@ def worker():
                     progressbar(async_task, current_progress, 'Checking for NSFW content ...')
                     img = default_censor(img)
                 progressbar(async_task, current_progress, f'Saving image {current_task_id + 1}/{total_count} to system ...')
-                uov_image_path = log(img, d, output_format=async_task.output_format, persist_image=persist_image)
+                uov_image_path = img if async_task.keep_results_in_memory else \
+                    log(img, d, output_format=async_task.output_format, persist_image=persist_image)
                 yield_result(async_task, uov_image_path, current_progress, async_task.black_out_nsfw, False,
                              do_not_show_finished_images=not show_intermediate_results or async_task.disable_intermediate_results)
                 return current_progress, img, prompt, negative_prompt
@@ -1106,6 +1319,8 @@ def worker():
               f'{async_task.adm_scaler_negative} : '
               f'{async_task.adm_scaler_end}')
         print(f'[Parameters] Seed = {async_task.seed}')
+        if async_task.performance_selection == Performance.DEEP_CACHE:
+            print(f'[Parameters] Deep Cache Interval = {modules.config.default_deep_cache_interval}')
 
         apply_patch_settings(async_task)
 
@@ -1183,7 +1398,8 @@ def worker():
                     progressbar(async_task, 100, 'Checking for NSFW content ...')
                     async_task.uov_input_image = default_censor(async_task.uov_input_image)
                 progressbar(async_task, 100, 'Saving image to system ...')
-                uov_input_image_path = log(async_task.uov_input_image, d, output_format=async_task.output_format)
+                uov_input_image_path = async_task.uov_input_image if async_task.keep_results_in_memory else \
+                    log(async_task.uov_input_image, d, output_format=async_task.output_format)
                 yield_result(async_task, uov_input_image_path, 100, async_task.black_out_nsfw, False,
                              do_not_show_finished_images=True)
                 return
@@ -1267,47 +1483,86 @@ def worker():
         preparation_steps = current_progress
         total_count = async_task.image_number
 
+        current_batch_size = 1
+
         def callback(step, x0, x, total_steps, y):
             if step == 0:
                 async_task.callback_steps = 0
-            async_task.callback_steps += (100 - preparation_steps) / float(all_steps)
+            async_task.callback_steps += (100 - preparation_steps) / float(all_steps) * current_batch_size
+            if current_batch_size > 1:
+                images_text = f'images {current_task_id + 1}-{current_task_id + current_batch_size}/{total_count}'
+            else:
+                images_text = f'image {current_task_id + 1}/{total_count}'
             async_task.yields.append(['preview', (
                 int(current_progress + async_task.callback_steps),
-                f'Sampling step {step + 1}/{total_steps}, image {current_task_id + 1}/{total_count} ...', y)])
+                f'Sampling step {step + 1}/{total_steps}, {images_text} ...', y)])
 
         show_intermediate_results = len(tasks) > 1 or async_task.should_enhance
         persist_image = not async_task.should_enhance or not async_task.save_final_enhanced_image_only
 
-        for current_task_id, task in enumerate(tasks):
-            progressbar(async_task, current_progress, f'Preparing task {current_task_id + 1}/{async_task.image_number} ...')
+        task_batches = get_task_batches(async_task, tasks, goals, width, height)
+        if len(task_batches) < len(tasks):
+            print(f'[Sampler] Sampling {len(tasks)} images in batches of {[len(b) for b in task_batches]}')
+
+        # a background NSFW check of one batch runs while the next one is sampled, the batch is saved after that
+        defer_saving = (modules.config.default_black_out_nsfw or async_task.black_out_nsfw) and \
+            extras.censor.censor.runs_in_background()
+        pending_save = None
+
+        current_task_id = 0
+        for batch in task_batches:
+            current_batch_size = len(batch)
+            if current_batch_size > 1:
+                progressbar(async_task, current_progress, f'Preparing tasks {current_task_id + 1}-{current_task_id + current_batch_size}/{async_task.image_number} ...')
+                positive_cond = pipeline.batch_conds([t['c'] for t in batch])
+                negative_cond = pipeline.batch_conds([t['uc'] for t in batch])
+                task = batch
+            else:
+                progressbar(async_task, current_progress, f'Preparing task {current_task_id + 1}/{async_task.image_number} ...')
+                task = batch[0]
+                positive_cond, negative_cond = task['c'], task['uc']
             execution_start_time = time.perf_counter()
 
             try:
-                imgs, img_paths, current_progress = process_task(all_steps, async_task, callback, controlnet_canny_path,
-                                                                 controlnet_cpds_path, current_task_id,
-                                                                 denoising_strength, final_scheduler_name, goals,
-                                                                 initial_latent, async_task.steps, switch, task['c'],
-                                                                 task['uc'], task, loras, tiled, use_expansion, width,
-                                                                 height, current_progress, preparation_steps,
-                                                                 async_task.image_number, show_intermediate_results,
-                                                                 persist_image)
-
-                current_progress = int(preparation_steps + (100 - preparation_steps) / float(all_steps) * async_task.steps * (current_task_id + 1))
-                images_to_enhance += imgs
+                result = process_task(all_steps, async_task, callback, controlnet_canny_path, controlnet_cpds_path,
+                                      current_task_id, denoising_strength, final_scheduler_name, goals, initial_latent,
+                                      async_task.steps, switch, positive_cond, negative_cond, task, loras, tiled,
+                                      use_expansion, width, height, current_progress, preparation_steps,
+                                      async_task.image_number, show_intermediate_results, persist_image, defer_saving)
+
+                if defer_saving:
+                    save, current_progress = result
+                    if pending_save is not None:
+                        images_to_enhance += pending_save(current_progress)[0]
+                    pending_save = save
+                else:
+                    imgs, img_paths, current_progress = result
+                    images_to_enhance += imgs
+                current_progress = int(preparation_steps + (100 - preparation_steps) / float(all_steps) * async_task.steps * (current_task_id + current_batch_size))
 
             except ldm_patched.modules.model_management.InterruptProcessingException:
                 if async_task.last_stop == 'skip':
                     print('User skipped')
                     async_task.last_stop = False
+                    current_task_id += current_batch_size
                     continue
                 else:
                     print('User stopped')
                     break
+            finally:
+                del positive_cond, negative_cond
 
-            del task['c'], task['uc']  # Save memory
+            for t in batch:
+                del t['c'], t['uc']  # Save memory
+            current_task_id += current_batch_size
             execution_time = time.perf_counter() - execution_start_time
             print(f'Generating and saving time: {execution_time:.2f} seconds')
 
+        if pending_save is not None:
+            images_to_enhance += pending_save(current_progress)[0]
+
+        current_batch_size = 1
+
         if not async_task.should_enhance:
             print(f'[Enhance] Skipping, preconditions aren\'t met')
             stop_processing(async_task, processing_start_time)
@@ -1463,22 +1718,25 @@ def worker():
         return
 
     while True:
-        time.sleep(0.01)
-        if len(async_tasks) > 0:
-            task = async_tasks.pop(0)
-
-            try:
-                handler(task)
-                if task.generate_image_grid:
-                    build_image_wall(task)
-                task.yields.append(['finish', task.results])
-                pipeline.prepare_text_encoder(async_call=True)
-            except:
-                traceback.print_exc()
-                task.yields.append(['finish', task.results])
-            finally:
-                if pid in modules.patch.patch_settings:
-                    del modules.patch.patch_settings[pid]
+        task = async_tasks.get()
+        if task is None:
+            break
+
+        print(f'[Scheduler] Task started after waiting {async_tasks.last_wait_time:.2f} seconds, '
+              f'{len(async_tasks)} task(s) remaining in queue')
+        try:
+            handler(task)
+            if task.generate_image_grid:
+                build_image_wall(task)
+            task.yields.append(['finish', task.results])
+            pipeline.prepare_text_encoder(async_call=True)
+        except:
+            traceback.print_exc()
+            task.yields.append(['finish', task.results])
+        finally:
+            if pid in modules.patch.patch_settings:
+                del modules.patch.patch_settings[pid]
+            async_tasks.task_done(task)
     pass
 
 
@@ -0,0 +1,99 @@
+import math
+import struct
+from collections import OrderedDict
+
+import torch
+
+
+def mix_seed(seed, key):
+    # splitmix64 of the seed combined with the node key, torch generators take seeds below 2 ** 63
+    z = (seed * 0x9E3779B97F4A7C15 + key + 0x632BE59BD9B4E019) % 2 ** 64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) % 2 ** 64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) % 2 ** 64
+    return (z ^ (z >> 31)) % 2 ** 63
+
+
+class DeviceBrownianTree:
+    """
+    Drop-in replacement for BatchedBrownianTree that samples on the device of x without torchsde.
+
+    W(t) is found by bisecting [t0, t1] depth times. The value at the midpoint of every visited interval is drawn
+    from the Brownian bridge between the ends of the interval and W(t) from the bridge over the final interval, each
+    with noise seeded by (seed, node) so that the same t always gives the same W(t). Increments between times in
+    different final intervals have exactly the distribution of Brownian motion. Midpoint values are cached since
+    consecutive sampling steps share most of their path through the tree.
+
+    The noise of every batch item comes from its own seed and does not depend on the batch size. The results differ
+    from BatchedBrownianTree for the same seeds.
+    """
+
+    def __init__(self, x, t0, t1, seed=None, cpu=False, depth=16, cache_size=64):
+        t0, t1 = float(t0), float(t1)
+        self.sign = 1 if t0 < t1 else -1
+        self.t0, self.t1 = min(t0, t1), max(t0, t1)
+        self.depth = depth
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        if seed is None:
+            seed = torch.randint(0, 2 ** 63 - 1, []).item()
+        self.batched = True
+        try:
+            assert len(seed) == x.shape[0]
+            self.seeds = [int(s) for s in seed]
+            self.noise_shape = tuple(x.shape[1:])
+        except TypeError:
+            self.seeds = [int(seed)]
+            self.batched = False
+            self.noise_shape = tuple(x.shape)
+
+        self.device = x.device
+        self.dtype = x.dtype
+        self.generator = torch.Generator(device='cpu' if cpu else x.device)
+        self.w_start = torch.zeros((len(self.seeds),) + self.noise_shape, device=x.device, dtype=torch.float32)
+        self.w_end = self.noise(0) * math.sqrt(self.t1 - self.t0)
+
+    def noise(self, key):
+        out = torch.empty((len(self.seeds),) + self.noise_shape, device=self.generator.device, dtype=torch.float32)
+        for i, seed in enumerate(self.seeds):
+            self.generator.manual_seed(mix_seed(seed, key))
+            torch.randn(self.noise_shape, generator=self.generator, device=self.generator.device, out=out[i])
+        return out.to(self.device)
+
+    def midpoint(self, node, a, b, w_a, w_b):
+        w = self.cache.get(node)
+        if w is not None:
+            self.cache.move_to_end(node)
+            return w
+        w = (w_a + w_b) * 0.5 + self.noise(node) * math.sqrt((b - a) * 0.25)
+        self.cache[node] = w
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return w
+
+    def w(self, t):
+        t = min(max(t, self.t0), self.t1)
+        a, b = self.t0, self.t1
+        w_a, w_b = self.w_start, self.w_end
+        node = 1
+        for _ in range(self.depth):
+            if t == a:
+                return w_a
+            if t == b:
+                return w_b
+            m = (a + b) * 0.5
+            w_m = self.midpoint(node, a, b, w_a, w_b)
+            if t < m:
+                b, w_b, node = m, w_m, 2 * node
+            else:
+                a, w_a, node = m, w_m, 2 * node + 1
+        if t == a:
+            return w_a
+        # the leaf noise is keyed by t itself, leaves are numbered from 2 ** depth so the bit pattern is shifted past them
+        key = (struct.unpack('<q', struct.pack('<d', t))[0] << (self.depth + 1)) + node
+        return w_a + (w_b - w_a) * ((t - a) / (b - a)) + self.noise(key) * math.sqrt((t - a) * (b - t) / (b - a))
+
+    def __call__(self, t0, t1):
+        w = (self.w(float(t1)) - self.w(float(t0))) * self.sign
+        w = w.to(self.dtype)
+        return w if self.batched else w[0]
@@ -10,6 +10,7 @@ import modules.sdxl_styles
 
 from modules.model_loader import load_file_from_url
 from modules.extra_utils import makedirs_with_log, get_files_from_folder, try_eval_env_var
+from modules.file_index import FileIndex
 from modules.flags import OutputFormat, Performance, MetadataScheme
 
 
@@ -201,6 +202,7 @@ path_fooocus_expansion = get_dir_or_set_default('path_fooocus_expansion', '../mo
 path_wildcards = get_dir_or_set_default('path_wildcards', '../wildcards/')
 path_safety_checker = get_dir_or_set_default('path_safety_checker', '../models/safety_checker/')
 path_sam = get_dir_or_set_default('path_sam', '../models/sam/')
+path_cache = get_dir_or_set_default('path_cache', '../models/cache/')
 path_outputs = get_path_output()
 
 
@@ -574,6 +576,12 @@ default_clip_skip = get_config_item_or_set_default(
     validator=lambda x: isinstance(x, int) and 1 <= x <= modules.flags.clip_skip_max,
     expected_type=int
 )
+default_deep_cache_interval = get_config_item_or_set_default(
+    key='default_deep_cache_interval',
+    default_value=3,
+    validator=lambda x: isinstance(x, int) and x >= 1,
+    expected_type=int
+)
 default_overwrite_step = get_config_item_or_set_default(
     key='default_overwrite_step',
     default_value=-1,
@@ -797,6 +805,9 @@ vae_filenames = []
 wildcard_filenames = []
 
 
+file_index = FileIndex(os.path.join(path_cache, 'file_index.json'))
+
+
 def get_model_filenames(folder_paths, extensions=None, name_filter=None):
     if extensions is None:
         extensions = ['.pth', '.ckpt', '.bin', '.safetensors', '.fooocus.patch']
@@ -805,7 +816,7 @@ def get_model_filenames(folder_paths, extensions=None, name_filter=None):
     if not isinstance(folder_paths, list):
         folder_paths = [folder_paths]
     for folder in folder_paths:
-        files += get_files_from_folder(folder, extensions, name_filter)
+        files += file_index.list_files(folder, extensions, name_filter)
 
     return files
 
@@ -815,8 +826,9 @@ def update_files():
     model_filenames = get_model_filenames(paths_checkpoints)
     lora_filenames = get_model_filenames(paths_loras)
     vae_filenames = get_model_filenames(path_vae)
-    wildcard_filenames = get_files_from_folder(path_wildcards, ['.txt'])
+    wildcard_filenames = file_index.list_files(path_wildcards, ['.txt'])
     available_presets = get_presets()
+    file_index.save()
     return
 
 
@@ -11,6 +11,7 @@ import ldm_patched.modules.controlnet
 import modules.sample_hijack
 import ldm_patched.modules.samplers
 import ldm_patched.modules.latent_formats
+import args_manager
 
 from ldm_patched.modules.sd import load_checkpoint_guess_config
 from ldm_patched.contrib.external import VAEDecode, EmptyLatentImage, VAEEncode, VAEEncodeTiled, VAEDecodeTiled, \
@@ -19,6 +20,8 @@ from ldm_patched.contrib.external_freelunch import FreeU_V2
 from ldm_patched.modules.sample import prepare_mask
 from modules.lora import match_lora
 from modules.util import get_file_from_folder_list
+from modules.task_events import PreviewLimiter
+from modules.tensor_cache import TensorCache, file_signature
 from ldm_patched.modules.lora import model_lora_keys_unet, model_lora_keys_clip
 from modules.config import path_embeddings
 from ldm_patched.contrib.external_model_advanced import ModelSamplingDiscrete, ModelSamplingContinuousEDM
@@ -33,6 +36,10 @@ opFreeU = FreeU_V2()
 opModelSamplingDiscrete = ModelSamplingDiscrete()
 opModelSamplingContinuousEDM = ModelSamplingContinuousEDM()
 
+lora_weight_cache = TensorCache('LoRA Cache', args_manager.args.lora_cache_size * 1024 * 1024,
+                                os.path.join(modules.config.path_cache, 'lora'),
+                                args_manager.args.lora_cache_disk_size * 1024 * 1024)
+
 
 class StableDiffusionModel:
     def __init__(self, unet=None, vae=None, clip=None, clip_vision=None, filename=None, vae_filename=None):
@@ -121,6 +128,23 @@ class StableDiffusionModel:
                     if item not in loaded_keys:
                         print("CLIP LoRA key skipped: ", item)
 
+        if self.filename is None:
+            return
+
+        checkpoint = file_signature(self.filename)
+        lora_stack = tuple((file_signature(lora_filename), weight) for lora_filename, weight in loras_to_load)
+
+        if lora_weight_cache.max_bytes > 0:
+            for name, patcher in [('unet', self.unet_with_lora),
+                                  ('clip', self.clip_with_lora.patcher if self.clip_with_lora is not None else None)]:
+                if patcher is not None:
+                    patcher.weight_cache = lora_weight_cache
+                    patcher.weight_cache_key = (checkpoint, name, lora_stack)
+
+        if self.clip_with_lora is not None:
+            # identifies the CLIP weights for caching text conditionings, see default_pipeline.clip_encode_single
+            self.clip_with_lora.cond_cache_key = (checkpoint, lora_stack)
+
 
 @torch.no_grad()
 @torch.inference_mode()
@@ -159,7 +183,8 @@ def generate_empty_latent(width=1024, height=1024, batch_size=1):
 @torch.inference_mode()
 def decode_vae(vae, latent_image, tiled=False):
     if tiled:
-        return opVAEDecodeTiled.decode(samples=latent_image, vae=vae, tile_size=512)[0]
+        return opVAEDecodeTiled.decode(samples=latent_image, vae=vae, tile_size=512,
+                                       single_pass=args_manager.args.vae_tiled_single_pass)[0]
     else:
         return opVAEDecode.decode(samples=latent_image, vae=vae)[0]
 
@@ -168,7 +193,8 @@ def decode_vae(vae, latent_image, tiled=False):
 @torch.inference_mode()
 def encode_vae(vae, pixels, tiled=False):
     if tiled:
-        return opVAEEncodeTiled.encode(pixels=pixels, vae=vae, tile_size=512)[0]
+        return opVAEEncodeTiled.encode(pixels=pixels, vae=vae, tile_size=512,
+                                       single_pass=args_manager.args.vae_tiled_single_pass)[0]
     else:
         return opVAEEncode.encode(pixels=pixels, vae=vae)[0]
 
@@ -276,7 +302,12 @@ def ksampler(model, positive, negative, latent, seed=None, steps=30, cfg=7.0, sa
         noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
     else:
         batch_inds = latent["batch_index"] if "batch_index" in latent else None
-        noise = ldm_patched.modules.sample.prepare_noise(latent_image, seed, batch_inds)
+        if isinstance(seed, list):
+            # one independent noise per image, identical to sampling each image on its own
+            noise = torch.cat([ldm_patched.modules.sample.prepare_noise(latent_image[i:i + 1], s)
+                               for i, s in enumerate(seed)], dim=0)
+        else:
+            noise = ldm_patched.modules.sample.prepare_noise(latent_image, seed, batch_inds)
 
     if isinstance(noise_mean, torch.Tensor):
         noise = noise + noise_mean - torch.mean(noise, dim=1, keepdim=True)
@@ -293,10 +324,12 @@ def ksampler(model, positive, negative, latent, seed=None, steps=30, cfg=7.0, sa
     if previewer_end is None:
         previewer_end = steps
 
+    preview_due = PreviewLimiter(args_manager.args.preview_interval)
+
     def callback(step, x0, x, total_steps):
         ldm_patched.modules.model_management.throw_exception_if_processing_interrupted()
         y = None
-        if previewer is not None and not disable_preview:
+        if previewer is not None and not disable_preview and preview_due(previewer_start + step, previewer_end):
             y = previewer(x0, previewer_start + step, previewer_end)
         if callback_function is not None:
             callback_function(previewer_start + step, x0, x, previewer_end, y)
@@ -0,0 +1,40 @@
+class DeepCache:
+    """
+    Reuses the deep UNet features of one sampling step in the following steps, as in DeepCache (Ma et al. 2023).
+
+    Every interval steps the UNet runs in full and the input of its output block len(output_blocks) - depth is
+    stored. The other steps only run the first depth input blocks and the last depth output blocks, the skip
+    connections between them are computed as usual and the stored features take the place of everything deeper.
+
+    Features are stored per input shape and cond/uncond composition of the batch, since the sampler may evaluate cond
+    and uncond in separate calls. The step at the refiner switch runs in full and the cache is cleared after it, the
+    refiner starts from its own features.
+    """
+
+    def __init__(self, interval=3, depth=3, switch_step=-1):
+        self.interval = interval
+        self.depth = depth
+        self.switch_step = switch_step
+        self.step = 0
+        self.start_step = 0
+        self.features = {}
+
+    def set_step(self, step):
+        self.step = step
+
+    def reset(self, step):
+        self.start_step = step
+        self.step = step
+        self.features.clear()
+
+    def is_full_step(self):
+        return self.interval <= 1 or self.step == self.switch_step or (self.step - self.start_step) % self.interval == 0
+
+    def get(self, key):
+        """Returns the features to continue from in this step, None if the UNet has to run in full."""
+        if self.is_full_step():
+            return None
+        return self.features.get(key)
+
+    def store(self, key, h):
+        self.features[key] = h
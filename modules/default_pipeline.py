@@ -1,23 +1,42 @@
 import modules.core as core
 import os
+import args_manager
 import torch
 import modules.patch
 import modules.config
 import modules.flags
 import ldm_patched.modules.model_management
 import ldm_patched.modules.latent_formats
+import ldm_patched.modules.utils
 import modules.inpaint_worker
 import extras.vae_interpose as vae_interpose
 from extras.expansion import FooocusExpansion
 
 from ldm_patched.modules.model_base import SDXL, SDXLRefiner
 from modules.sample_hijack import clip_separate
+from modules.tensor_cache import TensorCache
+from modules.model_pool import ModelPool
 from modules.util import get_file_from_folder_list, get_enabled_loras
 
 
 model_base = core.StableDiffusionModel()
 model_refiner = core.StableDiffusionModel()
 
+
+def load_pooled_model(filename, vae_filename=None, role='base'):
+    model = core.load_model(filename, vae_filename)
+    if role != 'refiner':
+        return model
+
+    # the refiner only samples with the UNet, and decodes with its VAE unless it is an SDXL model
+    refiner_vae = None if isinstance(model.unet.model, (SDXL, SDXLRefiner)) else model.vae
+    return core.StableDiffusionModel(unet=model.unet, vae=refiner_vae, filename=filename)
+
+
+model_pool = ModelPool(load_pooled_model, max_models=args_manager.args.model_pool_size,
+                       max_bytes=args_manager.args.model_pool_memory * 1024 * 1024
+                       if args_manager.args.model_pool_memory is not None else None)
+
 final_expansion = None
 final_unet = None
 final_clip = None
@@ -27,6 +46,11 @@ final_refiner_vae = None
 
 loaded_ControlNets = {}
 
+# keyed by (CLIP weights and LoRA stack, clip skip, text), so it stays valid across refresh_everything
+clip_cond_cache = TensorCache('CLIP Cache', args_manager.args.clip_cache_size * 1024 * 1024,
+                              os.path.join(modules.config.path_cache, 'clip'),
+                              args_manager.args.clip_cache_disk_size * 1024 * 1024)
+
 
 @torch.no_grad()
 @torch.inference_mode()
@@ -69,9 +93,11 @@ def refresh_base_model(name, vae_name=None):
         vae_filename = get_file_from_folder_list(vae_name, modules.config.path_vae)
 
     if model_base.filename == filename and model_base.vae_filename == vae_filename:
+        model_pool.touch(filename, vae_filename)
         return
 
-    model_base = core.load_model(filename, vae_filename)
+    # the refiner is refreshed first and stays in use
+    model_base = model_pool.get(filename, vae_filename, keep=[(model_refiner.filename, None, 'refiner')])
     print(f'Base model loaded: {model_base.filename}')
     print(f'VAE loaded: {model_base.vae_filename}')
     return
@@ -85,6 +111,7 @@ def refresh_refiner_model(name):
     filename = get_file_from_folder_list(name, modules.config.paths_checkpoints)
 
     if model_refiner.filename == filename:
+        model_pool.touch(filename, role='refiner')
         return
 
     model_refiner = core.StableDiffusionModel()
@@ -93,18 +120,10 @@ def refresh_refiner_model(name):
         print(f'Refiner unloaded.')
         return
 
-    model_refiner = core.load_model(filename)
+    # the base model may be kept by refresh_base_model right after this
+    model_refiner = model_pool.get(filename, role='refiner',
+                                   keep=[(model_base.filename, model_base.vae_filename, 'base')])
     print(f'Refiner model loaded: {model_refiner.filename}')
-
-    if isinstance(model_refiner.unet.model, SDXL):
-        model_refiner.clip = None
-        model_refiner.vae = None
-    elif isinstance(model_refiner.unet.model, SDXLRefiner):
-        model_refiner.clip = None
-        model_refiner.vae = None
-    else:
-        model_refiner.clip = None
-
     return
 
 
@@ -142,17 +161,27 @@ def refresh_loras(loras, base_model_additional_loras=None):
     return
 
 
+def clip_cond_cache_key(clip, text):
+    """Returns the key of the conditioning of text in clip_cond_cache, or None if it is not cached."""
+    if getattr(clip, 'cond_cache_key', None) is None or clip_cond_cache.max_bytes <= 0:
+        return None
+    return clip.cond_cache_key, clip.layer_idx, text
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def clip_encode_single(clip, text, verbose=False):
-    cached = clip.fcs_cond_cache.get(text, None)
-    if cached is not None:
-        if verbose:
-            print(f'[CLIP Cached] {text}')
-        return cached
+    cache_key = clip_cond_cache_key(clip, text)
+    if cache_key is not None:
+        cached = clip_cond_cache.get(cache_key)
+        if cached is not None:
+            if verbose:
+                print(f'[CLIP Cached] {text}')
+            return cached
     tokens = clip.tokenize(text)
     result = clip.encode_from_tokens(tokens, return_pooled=True)
-    clip.fcs_cond_cache[text] = result
+    if cache_key is not None:
+        result = clip_cond_cache.put(cache_key, result)
     if verbose:
         print(f'[CLIP Encoded] {text}')
     return result
@@ -179,7 +208,58 @@ def clone_cond(conds):
 
 @torch.no_grad()
 @torch.inference_mode()
-def clip_encode(texts, pool_top_k=1):
+def batch_conds(conds_list):
+    results = []
+
+    for entries in zip(*conds_list):
+        c = torch.cat([c for c, p in entries], dim=0)
+        p = torch.cat([p["pooled_output"] for c, p in entries], dim=0)
+        results.append([c, {"pooled_output": p}])
+
+    return results
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def clip_encode_texts(texts, verbose=False):
+    """
+    Returns a dict of text -> (cond, pooled) for the unique texts. Texts not in clip_cond_cache are encoded together
+    in batches and put into the cache.
+    """
+    global final_clip
+
+    results = {}
+    if final_clip is None:
+        return results
+
+    missing = []
+    for text in dict.fromkeys(texts):
+        cache_key = clip_cond_cache_key(final_clip, text)
+        if cache_key is not None:
+            cached = clip_cond_cache.get(cache_key)
+            if cached is not None:
+                if verbose:
+                    print(f'[CLIP Cached] {text}')
+                results[text] = cached
+                continue
+        missing.append(text)
+
+    if len(missing) > 0:
+        tokens = [final_clip.tokenize(text) for text in missing]
+        for text, result in zip(missing, final_clip.encode_from_tokens_batch(tokens)):
+            cache_key = clip_cond_cache_key(final_clip, text)
+            if cache_key is not None:
+                result = clip_cond_cache.put(cache_key, result)
+            if verbose:
+                print(f'[CLIP Encoded] {text}')
+            results[text] = result
+
+    return results
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def clip_encode(texts, pool_top_k=1, encoded=None):
     global final_clip
 
     if final_clip is None:
@@ -193,7 +273,10 @@ def clip_encode(texts, pool_top_k=1):
     pooled_acc = 0
 
     for i, text in enumerate(texts):
-        cond, pooled = clip_encode_single(final_clip, text)
+        if encoded is not None and text in encoded:
+            cond, pooled = encoded[text]
+        else:
+            cond, pooled = clip_encode_single(final_clip, text)
         cond_list.append(cond)
         if i < pool_top_k:
             pooled_acc += pooled
@@ -212,11 +295,6 @@ def set_clip_skip(clip_skip: int):
     final_clip.clip_layer(-abs(clip_skip))
     return
 
-@torch.no_grad()
-@torch.inference_mode()
-def clear_all_caches():
-    final_clip.fcs_cond_cache = {}
-
 
 @torch.no_grad()
 @torch.inference_mode()
@@ -263,7 +341,6 @@ def refresh_everything(refiner_model_name, base_model_name, loras,
         final_expansion = FooocusExpansion()
 
     prepare_text_encoder(async_call=True)
-    clear_all_caches()
     return
 
 
@@ -331,6 +408,33 @@ def get_candidate_vae(steps, switch, denoise=1.0, refiner_swap_method='joint'):
     return final_vae, final_refiner_vae
 
 
+# samplers whose only randomness is the initial noise and the seeded Brownian tree,
+# so sampling several images as one batch gives the same result as sampling them one by one
+batchable_sampler_names = ['euler', 'heun', 'heunpp2', 'dpm_2', 'lms', 'dpmpp_2m', 'dpmpp_sde', 'dpmpp_sde_gpu',
+                           'dpmpp_2m_sde', 'dpmpp_2m_sde_gpu', 'dpmpp_3m_sde', 'dpmpp_3m_sde_gpu',
+                           'ddim', 'uni_pc', 'uni_pc_bh2']
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def get_sampling_batch_size(width, height, max_batch_size):
+    if max_batch_size <= 1 or final_unet is None:
+        return 1
+
+    device = ldm_patched.modules.model_management.get_torch_device()
+    free_memory = ldm_patched.modules.model_management.get_free_memory(device)
+
+    model_size = 0
+    for unet in [final_unet, final_refiner_unet]:
+        if unet is not None and unet.current_device != device:
+            model_size = max(model_size, unet.model_size())
+    free_memory -= model_size + ldm_patched.modules.model_management.minimum_inference_memory()
+
+    # positive and negative are evaluated together, so each image counts twice
+    memory_per_image = final_unet.model.memory_required([2, 4, height // 8, width // 8])
+    return int(max(1, min(max_batch_size, free_memory // memory_per_image)))
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def process_diffusion(positive_cond, negative_cond, steps, switch, width, height, image_seed, callback, sampler_name, scheduler_name, latent=None, denoise=1.0, tiled=False, cfg_scale=7.0, refiner_swap_method='joint', disable_preview=False):
@@ -358,10 +462,15 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
 
     print(f'[Sampler] refiner_swap_method = {refiner_swap_method}')
 
+    batch_size = len(image_seed) if isinstance(image_seed, list) else 1
+
     if latent is None:
-        initial_latent = core.generate_empty_latent(width=width, height=height, batch_size=1)
+        initial_latent = core.generate_empty_latent(width=width, height=height, batch_size=batch_size)
     else:
         initial_latent = latent
+        if initial_latent['samples'].shape[0] != batch_size:
+            initial_latent = initial_latent.copy()
+            initial_latent['samples'] = ldm_patched.modules.utils.repeat_to_batch_size(initial_latent['samples'], batch_size)
 
     minmax_sigmas = calculate_sigmas(sampler=sampler_name, scheduler=scheduler_name, model=final_unet.model, steps=steps, denoise=denoise)
     sigma_min, sigma_max = minmax_sigmas[minmax_sigmas > 0].min(), minmax_sigmas.max()
@@ -371,7 +480,7 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
 
     modules.patch.BrownianTreeNoiseSamplerPatched.global_init(
         initial_latent['samples'].to(ldm_patched.modules.model_management.get_torch_device()),
-        sigma_min, sigma_max, seed=image_seed, cpu=False)
+        sigma_min, sigma_max, seed=image_seed, cpu=False, noise=args_manager.args.sde_noise)
 
     decoded_latent = None
 
@@ -481,7 +590,7 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
                                   denoise=denoise)[switch:] * k_sigmas
         len_sigmas = len(sigmas) - 1
 
-        noise_mean = torch.mean(modules.patch.patch_settings[os.getpid()].eps_record, dim=1, keepdim=True)
+        noise_mean = torch.mean(modules.patch.patch_settings[os.getpid()].eps_record, dim=1, keepdim=True).cpu()
 
         if modules.inpaint_worker.current_task is not None:
             modules.inpaint_worker.current_task.swap()
@@ -492,7 +601,7 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
             negative=clip_separate(negative_cond, target_model=target_model.model, target_clip=target_clip),
             latent=sampled_latent,
             steps=len_sigmas, start_step=0, last_step=len_sigmas, disable_noise=False, force_full_denoise=True,
-            seed=image_seed+1,
+            seed=[x + 1 for x in image_seed] if isinstance(image_seed, list) else image_seed + 1,
             denoise=denoise,
             callback_function=callback,
             cfg=cfg_scale,
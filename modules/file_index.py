@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+
+file_index_version = 2
+
+
+class FileIndex:
+    """
+    Persistent index of the files below the model, LoRA, VAE and wildcard folders.
+
+    Every directory is stored with its modification time, its subdirectories and the size and modification time of
+    its files. A refresh only lists directories whose modification time changed, others are
+    taken from the index with a single stat, which is what makes refreshing cheap on network mounts with thousands
+    of files. Adding, removing or renaming a file changes the modification time of its directory, a file rewritten
+    in place keeps its old size and modification time in the index until its directory changes.
+
+    list_files gives the same list as extra_utils.get_files_from_folder, find looks up names in a dict instead of
+    probing the folders.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.folders = {}  # folder -> {relative directory: [mtime_ns, subdirectories, {filename: [size, mtime_ns]}]}
+        self.names = {}  # folder -> {normalized relative path: file entry}
+        self.resolved = {}  # (folder, name) -> real path
+        self.loaded = False
+        self.dirty = False
+
+    @staticmethod
+    def key(folder):
+        return os.path.abspath(folder)
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == file_index_version:
+                self.folders = data['folders']
+                for folder in self.folders:
+                    self.update_names(folder)
+        except Exception as e:
+            print(f'[File Index] Loading {self.filename} failed: {e}')
+            self.folders = {}
+            self.names = {}
+
+    def save(self):
+        with self.lock:
+            if self.filename is None or not self.dirty:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                temp_filename = f'{self.filename}.{os.getpid()}.tmp'
+                with open(temp_filename, 'wt', encoding='utf-8') as f:
+                    json.dump({'version': file_index_version, 'folders': self.folders}, f, separators=(',', ':'))
+                os.replace(temp_filename, self.filename)
+                self.dirty = False
+            except Exception as e:
+                print(f'[File Index] Saving {self.filename} failed: {e}')
+
+    def scan_directory(self, folder, relative_path, old_directories, new_directories):
+        path = os.path.join(folder, relative_path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+
+        cached = old_directories.get(relative_path)
+        if cached is not None and cached[0] == mtime:
+            subdirectories, files = cached[1], cached[2]
+        else:
+            subdirectories, files = [], {}
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if is_dir:
+                            # like os.walk, linked directories are not followed
+                            if not entry.is_symlink():
+                                subdirectories.append(entry.name)
+                            continue
+                        try:
+                            stat = entry.stat()
+                            size, file_mtime = stat.st_size, stat.st_mtime_ns
+                        except OSError:
+                            size, file_mtime = None, None
+                        files[entry.name] = [size, file_mtime]
+            except OSError:
+                return
+            self.dirty = True
+
+        new_directories[relative_path] = [mtime, subdirectories, files]
+        for subdirectory in subdirectories:
+            self.scan_directory(folder, os.path.join(relative_path, subdirectory), old_directories, new_directories)
+
+    def refresh(self, folder):
+        with self.lock:
+            self.load()
+            key = self.key(folder)
+            old_directories = self.folders.get(key, {})
+            new_directories = {}
+            self.scan_directory(key, '', old_directories, new_directories)
+            if new_directories.keys() != old_directories.keys():
+                self.dirty = True
+            self.folders[key] = new_directories
+            self.update_names(key)
+
+    def update_names(self, key):
+        names = {}
+        for relative_path, (_, _, files) in self.folders[key].items():
+            for filename, entry in files.items():
+                names[os.path.normpath(os.path.join(relative_path, filename))] = entry
+        self.names[key] = names
+        self.resolved = {k: v for k, v in self.resolved.items() if k[0] != key}
+
+    def walk(self, directories, relative_path):
+        # the order of os.walk(topdown=False), subdirectories before their parent in listing order
+        if relative_path not in directories:
+            return
+        _, subdirectories, files = directories[relative_path]
+        for subdirectory in subdirectories:
+            yield from self.walk(directories, os.path.join(relative_path, subdirectory))
+        yield relative_path, files
+
+    def list_files(self, folder, extensions=None, name_filter=None, refresh=True):
+        if not os.path.isdir(folder):
+            raise ValueError("Folder path is not a valid directory.")
+
+        with self.lock:
+            if refresh or self.key(folder) not in self.folders:
+                self.refresh(folder)
+
+            filenames = []
+            for relative_path, files in self.walk(self.folders.get(self.key(folder), {}), ''):
+                for filename in sorted(files.keys(), key=lambda s: s.casefold()):
+                    name, file_extension = os.path.splitext(filename)
+                    if (extensions is None or file_extension.lower() in extensions) and (name_filter is None or name_filter in name):
+                        filenames.append(os.path.join(relative_path, filename))
+            return filenames
+
+    def find(self, name, folders):
+        """
+        Returns the real path of name in the first of folders containing it. Returns None if it is in none of them or
+        one of the folders is not indexed, callers then look for it on disk.
+        """
+        with self.lock:
+            normalized_name = os.path.normpath(name)
+            for folder in folders:
+                key = self.key(folder)
+                names = self.names.get(key)
+                if names is None:
+                    return None
+                if normalized_name not in names:
+                    continue
+                if (key, normalized_name) not in self.resolved:
+                    self.resolved[(key, normalized_name)] = os.path.abspath(os.path.realpath(os.path.join(folder, name)))
+                return self.resolved[(key, normalized_name)]
+            return None
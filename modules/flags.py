@@ -134,6 +134,7 @@ class PerformanceLoRA(Enum):
     EXTREME_SPEED = 'sdxl_lcm_lora.safetensors'
     LIGHTNING = 'sdxl_lightning_4step_lora.safetensors'
     HYPER_SD = 'sdxl_hyper_sd_4step_lora.safetensors'
+    DEEP_CACHE = None
 
 
 class Steps(IntEnum):
@@ -142,6 +143,7 @@ class Steps(IntEnum):
     EXTREME_SPEED = 8
     LIGHTNING = 4
     HYPER_SD = 4
+    DEEP_CACHE = 30
 
     @classmethod
     def keys(cls) -> list:
@@ -154,6 +156,7 @@ class StepsUOV(IntEnum):
     EXTREME_SPEED = 8
     LIGHTNING = 4
     HYPER_SD = 4
+    DEEP_CACHE = 18
 
 
 class Performance(Enum):
@@ -162,6 +165,7 @@ class Performance(Enum):
     EXTREME_SPEED = 'Extreme Speed'
     LIGHTNING = 'Lightning'
     HYPER_SD = 'Hyper-SD'
+    DEEP_CACHE = 'Deep Cache'
 
     @classmethod
     def list(cls) -> list:
@@ -1,78 +1,204 @@
 import json
 import os
+import queue
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import cpu_count
 
 import args_manager
 from modules.util import sha256, HASH_SHA256_LENGTH, get_file_from_folder_list
 
-hash_cache_filename = 'hash_cache.txt'
-hash_cache = {}
+hash_cache_filename = 'hash_cache.json'
+legacy_hash_cache_filename = 'hash_cache.txt'
+hash_cache_version = 2
+
+# seconds between saves while files are hashed in a batch, the batch saves once more when it is done
+hash_cache_save_interval = 30.0
+
+
+class HashCache:
+    """
+    sha256 hashes of model files, each stored with the size, modification time and inode of the file it was
+    calculated for. A hash is only returned while a stat of the file still gives the same values, so a replaced file
+    is hashed again.
+
+    The cache is one compact JSON document that is replaced atomically when it is saved, after every hash asked for
+    on its own and every save interval while files are hashed in a batch. A file is never hashed by two threads at
+    once, a thread asking for a hash that is being calculated waits for it instead.
+    """
+
+    def __init__(self, filename, legacy_filename=None):
+        self.filename = filename
+        self.legacy_filename = legacy_filename
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.entries = {}  # path -> [size, mtime_ns, inode, sha256]
+        self.pending = {}  # path -> event set once the thread hashing the file is done
+        self.dirty = False
+        self.last_save_time = time.perf_counter()
+
+    @staticmethod
+    def signature(filepath):
+        stat = os.stat(filepath)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    @staticmethod
+    def is_valid_hash(hash_value):
+        return isinstance(hash_value, str) and len(hash_value) == HASH_SHA256_LENGTH
+
+    def load(self):
+        try:
+            if os.path.exists(self.filename):
+                with open(self.filename, 'rt', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') != hash_cache_version:
+                    print(f'[Cache] Ignoring {self.filename} of version {data.get("version")}')
+                    return
+                entries = {filepath: entry for filepath, entry in data['entries'].items()
+                           if isinstance(entry, list) and len(entry) == 4 and self.is_valid_hash(entry[3])}
+                with self.lock:
+                    self.entries = entries
+            elif self.legacy_filename is not None and os.path.exists(self.legacy_filename):
+                self.load_legacy()
+        except Exception as e:
+            print(f'[Cache] Loading failed: {e}')
+
+    def load_legacy(self):
+        # hash_cache.txt had one {path: hash} object per line and no file signatures, its hashes are trusted for the
+        # files as they are now, which is what they were used for before
+        entries = {}
+        with open(self.legacy_filename, 'rt', encoding='utf-8') as f:
+            for line in f:
+                for filepath, hash_value in json.loads(line).items():
+                    if not self.is_valid_hash(hash_value):
+                        print(f'[Cache] Skipping invalid cache entry: {filepath}')
+                        continue
+                    try:
+                        entries[filepath] = self.signature(filepath) + [hash_value]
+                    except OSError:
+                        print(f'[Cache] Skipping invalid cache entry: {filepath}')
+        with self.lock:
+            self.entries = entries
+            self.dirty = True
+        print(f'[Cache] Converted {self.legacy_filename} to {self.filename}')
+        self.save()
+
+    def save(self, min_interval=0.0):
+        """Writes the cache if it changed and the last save is at least min_interval seconds ago."""
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty or time.perf_counter() - self.last_save_time < min_interval:
+                    return
+                entries = dict(sorted(self.entries.items()))
+                self.dirty = False
+            self.last_save_time = time.perf_counter()
+            try:
+                temp_filename = f'{self.filename}.{os.getpid()}.tmp'
+                with open(temp_filename, 'wt', encoding='utf-8') as f:
+                    json.dump({'version': hash_cache_version, 'entries': entries}, f, separators=(',', ':'))
+                os.replace(temp_filename, self.filename)
+            except Exception as e:
+                print(f'[Cache] Saving failed: {e}')
+                with self.lock:
+                    self.dirty = True
+
+    def get(self, filepath):
+        """Returns the cached hash of filepath, None if there is none for the file as it is now."""
+        try:
+            signature = self.signature(filepath)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(filepath)
+        return entry[3] if entry is not None and entry[:3] == signature else None
+
+    def sha256(self, filepath, save=True):
+        """Returns the hash of filepath, calculated unless it is cached. Batches pass save=False and save themselves."""
+        while True:
+            signature = self.signature(filepath)
+            with self.lock:
+                entry = self.entries.get(filepath)
+                if entry is not None and entry[:3] == signature:
+                    return entry[3]
+                event = self.pending.get(filepath)
+                if event is None:
+                    event = self.pending[filepath] = threading.Event()
+                    break
+            event.wait()
+
+        try:
+            print(f"[Cache] Calculating sha256 for {filepath}")
+            hash_value = sha256(filepath)
+            print(f"[Cache] sha256 for {filepath}: {hash_value}")
+            with self.lock:
+                self.entries[filepath] = signature + [hash_value]
+                self.dirty = True
+        finally:
+            with self.lock:
+                del self.pending[filepath]
+            event.set()
+
+        if save:
+            self.save()
+        return hash_value
+
+    def warm_up(self, filepaths, max_workers=1):
+        """Hashes the files without a valid hash in daemon threads, returns the threads."""
+        jobs = queue.SimpleQueue()
+        missing = 0
+        for filepath in filepaths:
+            if self.get(filepath) is None:
+                jobs.put(filepath)
+                missing += 1
+
+        def worker():
+            while True:
+                try:
+                    filepath = jobs.get_nowait()
+                except queue.Empty:
+                    self.save()
+                    return
+                try:
+                    self.sha256(filepath, save=False)
+                except Exception as e:
+                    print(f'[Cache] Hashing {filepath} failed: {e}')
+                self.save(min_interval=hash_cache_save_interval)
+
+        threads = [threading.Thread(target=worker, name='hash_cache_warm_up', daemon=True)
+                   for _ in range(min(max_workers, missing))]
+        if threads:
+            print(f'[Cache] Hashing {missing} files in the background')
+        for thread in threads:
+            thread.start()
+        return threads
+
+
+hash_cache = HashCache(hash_cache_filename, legacy_hash_cache_filename)
 
 
 def sha256_from_cache(filepath):
-    global hash_cache
-    if filepath not in hash_cache:
-        print(f"[Cache] Calculating sha256 for {filepath}")
-        hash_value = sha256(filepath)
-        print(f"[Cache] sha256 for {filepath}: {hash_value}")
-        hash_cache[filepath] = hash_value
-        save_cache_to_file(filepath, hash_value)
-
-    return hash_cache[filepath]
-
-
-def load_cache_from_file():
-    global hash_cache
-
-    try:
-        if os.path.exists(hash_cache_filename):
-            with open(hash_cache_filename, 'rt', encoding='utf-8') as fp:
-                for line in fp:
-                    entry = json.loads(line)
-                    for filepath, hash_value in entry.items():
-                        if not os.path.exists(filepath) or not isinstance(hash_value, str) and len(hash_value) != HASH_SHA256_LENGTH:
-                            print(f'[Cache] Skipping invalid cache entry: {filepath}')
-                            continue
-                        hash_cache[filepath] = hash_value
-    except Exception as e:
-        print(f'[Cache] Loading failed: {e}')
-
-
-def save_cache_to_file(filename=None, hash_value=None):
-    global hash_cache
-
-    if filename is not None and hash_value is not None:
-        items = [(filename, hash_value)]
-        mode = 'at'
-    else:
-        items = sorted(hash_cache.items())
-        mode = 'wt'
-
-    try:
-        with open(hash_cache_filename, mode, encoding='utf-8') as fp:
-            for filepath, hash_value in items:
-                json.dump({filepath: hash_value}, fp)
-                fp.write('\n')
-    except Exception as e:
-        print(f'[Cache] Saving failed: {e}')
+    return hash_cache.sha256(filepath)
 
 
 def init_cache(model_filenames, paths_checkpoints, lora_filenames, paths_loras):
-    load_cache_from_file()
+    hash_cache.load()
 
     if args_manager.args.rebuild_hash_cache:
         max_workers = args_manager.args.rebuild_hash_cache if args_manager.args.rebuild_hash_cache > 0 else cpu_count()
         rebuild_cache(lora_filenames, model_filenames, paths_checkpoints, paths_loras, max_workers)
-
-    # write cache to file again for sorting and cleanup of invalid cache entries
-    save_cache_to_file()
+    elif args_manager.args.hash_cache_warm_up:
+        max_workers = args_manager.args.hash_cache_warm_up if args_manager.args.hash_cache_warm_up > 0 else cpu_count()
+        filepaths = [get_file_from_folder_list(filename, paths_checkpoints) for filename in model_filenames]
+        filepaths += [get_file_from_folder_list(filename, paths_loras) for filename in lora_filenames]
+        hash_cache.warm_up(filepaths, max_workers)
 
 
 def rebuild_cache(lora_filenames, model_filenames, paths_checkpoints, paths_loras, max_workers=cpu_count()):
     def thread(filename, paths):
         filepath = get_file_from_folder_list(filename, paths)
-        sha256_from_cache(filepath)
+        hash_cache.sha256(filepath, save=False)
+        hash_cache.save(min_interval=hash_cache_save_interval)
 
     print('[Cache] Rebuilding hash cache')
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
@@ -80,4 +206,5 @@ def rebuild_cache(lora_filenames, model_filenames, paths_checkpoints, paths_lora
             executor.submit(thread, model_filename, paths_checkpoints)
         for lora_filename in lora_filenames:
             executor.submit(thread, lora_filename, paths_loras)
+    hash_cache.save()
     print('[Cache] Done')
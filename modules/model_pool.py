@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def model_ram_size(model):
+    size = 0
+    if model.unet is not None:
+        size += model.unet.model_size()
+    if model.clip is not None:
+        size += model.clip.patcher.model_size()
+    if model.vae is not None:
+        size += sum(p.numel() * p.element_size() for p in model.vae.first_stage_model.state_dict().values())
+    return size
+
+
+class ModelPool:
+    """
+    Keeps recently used checkpoints loaded in RAM so that switching back to one does not reload it from disk.
+
+    Entries are StableDiffusionModel instances keyed by (checkpoint, vae, role) and evicted least recently used
+    first once there are more than max_models of them or they take more than max_bytes together. The loader is
+    called with the same three values, so that a refiner can be loaded without the parts it does not use. The
+    most recently used model and the keys passed as keep, the models in use, are never evicted. Models are moved
+    to the GPU as usual by model_management.load_models_gpu when they are sampled with, evicted models are
+    unloaded from the GPU by model_management.cleanup_models once nothing references them anymore.
+    """
+
+    def __init__(self, loader, max_models=2, max_bytes=None):
+        self.loader = loader
+        self.max_models = max(max_models, 1)
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.models = OrderedDict()  # key -> (model, size)
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_load_time = 0.0
+        self.last_load_time = 0.0
+
+    def get(self, filename, vae_filename=None, role='base', keep=()):
+        key = (filename, vae_filename, role)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.hits += 1
+                print(f'[Model Pool] Reusing loaded model [{filename}].')
+                return self.models[key][0]
+
+            self.misses += 1
+            # make room before loading so that peak RAM stays within the budget where possible
+            self.evict(reserve=1, keep=keep)
+
+            start_time = time.perf_counter()
+            model = self.loader(filename, vae_filename, role)
+            self.last_load_time = time.perf_counter() - start_time
+            self.total_load_time += self.last_load_time
+
+            size = model_ram_size(model)
+            self.models[key] = (model, size)
+            self.total_bytes += size
+            self.evict(keep=keep)
+            print(f'[Model Pool] Loaded [{filename}] in {self.last_load_time:.2f} seconds, '
+                  f'{len(self.models)} models in pool using {self.total_bytes / (1024 * 1024):.0f} MB.')
+            return model
+
+    def touch(self, filename, vae_filename=None, role='base'):
+        """Marks a model that is still in use as recently used."""
+        with self.lock:
+            key = (filename, vae_filename, role)
+            if key in self.models:
+                self.models.move_to_end(key)
+
+    def evict(self, reserve=0, keep=()):
+        # without reserving room for a new model, the most recently used one stays
+        candidates = [key for key in list(self.models)[:len(self.models) - 1 + reserve] if key not in keep]
+        for key in candidates:
+            if len(self.models) + reserve <= self.max_models and \
+                    (self.max_bytes is None or self.total_bytes <= self.max_bytes):
+                break
+            model, size = self.models.pop(key)
+            self.total_bytes -= size
+            self.evictions += 1
+            print(f'[Model Pool] Evicted [{key[0]}].')
+
+    def remove(self, filename, vae_filename=None, role='base'):
+        with self.lock:
+            entry = self.models.pop((filename, vae_filename, role), None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.models)
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                models=[key[0] for key in self.models],
+                bytes=self.total_bytes,
+                max_bytes=self.max_bytes,
+                max_models=self.max_models,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                average_load_time=self.total_load_time / self.misses if self.misses > 0 else 0.0,
+                last_load_time=self.last_load_time,
+            )
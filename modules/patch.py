@@ -15,6 +15,7 @@ import ldm_patched.ldm.modules.diffusionmodules.model
 import ldm_patched.modules.sd
 import ldm_patched.controlnet.cldm
 import ldm_patched.modules.model_patcher
+import ldm_patched.modules.utils
 import ldm_patched.modules.samplers
 import ldm_patched.modules.args_parser
 import warnings
@@ -23,6 +24,7 @@ import modules.constants as constants
 
 from ldm_patched.modules.samplers import calc_cond_uncond_batch
 from ldm_patched.k_diffusion.sampling import BatchedBrownianTree
+from modules.brownian_noise import DeviceBrownianTree
 from ldm_patched.ldm.modules.diffusionmodules.openaimodel import forward_timestep_embed, apply_control
 from modules.patch_precision import patch_all_precision
 from modules.patch_clip import patch_all_clip
@@ -35,13 +37,15 @@ class PatchSettings:
                  positive_adm_scale=1.5,
                  negative_adm_scale=0.8,
                  controlnet_softness=0.25,
-                 adaptive_cfg=7.0):
+                 adaptive_cfg=7.0,
+                 deep_cache_interval=0):
         self.sharpness = sharpness
         self.adm_scaler_end = adm_scaler_end
         self.positive_adm_scale = positive_adm_scale
         self.negative_adm_scale = negative_adm_scale
         self.controlnet_softness = controlnet_softness
         self.adaptive_cfg = adaptive_cfg
+        self.deep_cache_interval = deep_cache_interval
         self.global_diffusion_progress = 0
         self.eps_record = None
 
@@ -188,14 +192,17 @@ class BrownianTreeNoiseSamplerPatched:
     tree = None
 
     @staticmethod
-    def global_init(x, sigma_min, sigma_max, seed=None, transform=lambda x: x, cpu=False):
+    def global_init(x, sigma_min, sigma_max, seed=None, transform=lambda x: x, cpu=False, noise='torchsde'):
         if ldm_patched.modules.model_management.directml_enabled:
             cpu = True
 
         t0, t1 = transform(torch.as_tensor(sigma_min)), transform(torch.as_tensor(sigma_max))
 
         BrownianTreeNoiseSamplerPatched.transform = transform
-        BrownianTreeNoiseSamplerPatched.tree = BatchedBrownianTree(x, t0, t1, seed, cpu=cpu)
+        if noise == 'device':
+            BrownianTreeNoiseSamplerPatched.tree = DeviceBrownianTree(x, t0, t1, seed, cpu=cpu)
+        else:
+            BrownianTreeNoiseSamplerPatched.tree = BatchedBrownianTree(x, t0, t1, seed, cpu=cpu)
 
     def __init__(self, *args, **kwargs):
         pass
@@ -230,7 +237,7 @@ def patched_sampling_function(model, x, timestep, uncond, cond, cond_scale, mode
         final_x0 = calc_cond_uncond_batch(model, cond, None, x, timestep, model_options)[0]
 
         if patch_settings[pid].eps_record is not None:
-            patch_settings[pid].eps_record = ((x - final_x0) / timestep).cpu()
+            patch_settings[pid].eps_record = (x - final_x0) / timestep
 
         return final_x0
 
@@ -248,7 +255,7 @@ def patched_sampling_function(model, x, timestep, uncond, cond, cond_scale, mode
                             cfg_scale=cond_scale, t=patch_settings[pid].global_diffusion_progress)
 
     if patch_settings[pid].eps_record is not None:
-        patch_settings[pid].eps_record = (final_eps / timestep).cpu()
+        patch_settings[pid].eps_record = final_eps / timestep
 
     return x - final_eps
 
@@ -375,7 +382,14 @@ def patched_cldm_forward(self, x, hint, timesteps, context, y=None, **kwargs):
 
 def patched_unet_forward(self, x, timesteps=None, context=None, y=None, control=None, transformer_options={}, **kwargs):
     self.current_step = 1.0 - timesteps.to(x) / 999.0
-    patch_settings[os.getpid()].global_diffusion_progress = float(self.current_step.detach().cpu().numpy().tolist()[0])
+
+    # sample_hacked computes the progress from the sigmas before sampling, reading it back from the device here
+    # would wait for all queued work on every call
+    diffusion_progress = transformer_options.get('diffusion_progress')
+    if diffusion_progress is None:
+        diffusion_progress = float(self.current_step.detach().cpu().numpy().tolist()[0])
+        transformer_options = {**transformer_options, 'diffusion_progress': diffusion_progress}
+    patch_settings[os.getpid()].global_diffusion_progress = diffusion_progress
 
     y = timed_adm(y, timesteps)
 
@@ -398,8 +412,22 @@ def patched_unet_forward(self, x, timesteps=None, context=None, y=None, control=
         assert y.shape[0] == x.shape[0]
         emb = emb + self.label_emb(y)
 
+    # on the steps DeepCache reuses features only the outermost blocks run, everything deeper is taken from the cache
+    deep_cache = transformer_options.get('deep_cache')
+    deep_cache_key = None
+    cached_h = None
+    if deep_cache is not None:
+        deep_cache_key = (tuple(x.shape), tuple(transformer_options.get('cond_or_uncond', [])))
+        cached_h = deep_cache.get(deep_cache_key)
+    num_input_blocks = len(self.input_blocks) if cached_h is None else deep_cache.depth
+    first_output_block = 0 if cached_h is None else len(self.output_blocks) - deep_cache.depth
+
+    if cached_h is not None and control is not None and 'output' in control:
+        # controls of the skipped output blocks are at the end of the list, apply_control pops from there
+        control = {**control, 'output': control['output'][:max(len(control['output']) - first_output_block, 0)]}
+
     h = x
-    for id, module in enumerate(self.input_blocks):
+    for id, module in enumerate(self.input_blocks[:num_input_blocks]):
         transformer_options["block"] = ("input", id)
         h = forward_timestep_embed(module, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
         h = apply_control(h, control, 'input')
@@ -414,11 +442,18 @@ def patched_unet_forward(self, x, timesteps=None, context=None, y=None, control=
             for p in patch:
                 h = p(h, transformer_options)
 
-    transformer_options["block"] = ("middle", 0)
-    h = forward_timestep_embed(self.middle_block, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
-    h = apply_control(h, control, 'middle')
+    if cached_h is None:
+        transformer_options["block"] = ("middle", 0)
+        h = forward_timestep_embed(self.middle_block, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
+        h = apply_control(h, control, 'middle')
+    else:
+        h = cached_h
 
     for id, module in enumerate(self.output_blocks):
+        if id < first_output_block:
+            continue
+        if deep_cache is not None and cached_h is None and id == len(self.output_blocks) - deep_cache.depth:
+            deep_cache.store(deep_cache_key, h)
         transformer_options["block"] = ("output", id)
         hsp = hs.pop()
         hsp = apply_control(hsp, control, 'output')
@@ -508,6 +543,7 @@ def patch_all():
     warnings.filterwarnings(action='ignore', module='torchsde')
 
     build_loaded(safetensors.torch, 'load_file')
+    build_loaded(ldm_patched.modules.utils, 'SafetensorsReader')
     build_loaded(torch, 'load')
 
     return
@@ -1,8 +1,13 @@
+import atexit
+import concurrent.futures
 import os
+import threading
+import traceback
 import args_manager
 import modules.config
 import json
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
@@ -10,7 +15,11 @@ from modules.flags import OutputFormat
 from modules.meta_parser import MetadataParser, get_exif
 from modules.util import generate_temp_filename
 
-log_cache = {}
+# log.html files opened in this session, entries are appended to them
+html_logs = set()
+html_logs_lock = threading.Lock()
+
+html_log_marker = '<!--fooocus-log-entries-->'
 
 
 def get_current_html_path(output_format=None):
@@ -97,14 +106,83 @@ def build_outputs_browser_html():
     return html_path
 
 
-def log(img, metadata, metadata_parser: MetadataParser | None = None, output_format=None, task=None, persist_image=True) -> str:
-    path_outputs = modules.config.temp_path if args_manager.args.disable_image_log or not persist_image else modules.config.path_outputs
-    output_format = output_format if output_format else modules.config.default_output_format
-    date_string, local_temp_filename, only_name = generate_temp_filename(folder=path_outputs, extension=output_format)
-    os.makedirs(os.path.dirname(local_temp_filename), exist_ok=True)
+class OutputWriter:
+    """
+    Encodes and saves output images on background threads so that the worker can go on sampling.
+
+    Images are saved by a pool of max_workers threads, log.html entries are appended by a single thread so that
+    they keep the order in which they were submitted. At most max_pending images wait to be saved, submitting
+    more blocks until one of them is written. With max_workers=0 everything is written on the calling thread.
+    """
+
+    def __init__(self, max_workers=2, max_pending=8):
+        self.image_executor = None
+        self.log_executor = None
+        if max_workers > 0:
+            self.image_executor = ThreadPoolExecutor(max_workers, thread_name_prefix='image_writer')
+            self.log_executor = ThreadPoolExecutor(1, thread_name_prefix='log_writer')
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.lock = threading.Lock()
+        self.pending = {}  # path -> future
+        self.last_log = None
+
+    def submit_image(self, path, fn, *args):
+        if self.image_executor is None:
+            fn(*args)
+            return
+
+        self.slots.acquire()
+        future = self.image_executor.submit(fn, *args)
+        with self.lock:
+            self.pending[path] = future
+        future.add_done_callback(lambda f: self.image_done(path, f))
+
+    def image_done(self, path, future):
+        with self.lock:
+            if self.pending.get(path) is future:
+                del self.pending[path]
+        self.slots.release()
+        if future.exception() is not None:
+            traceback.print_exception(future.exception())
+
+    def submit_log(self, fn, *args):
+        if self.log_executor is None:
+            fn(*args)
+            return
+        self.last_log = self.log_executor.submit(run_and_print_exceptions, fn, *args)
+
+    def wait(self, paths=None):
+        """Blocks until the given output paths, or all pending images and log entries, are written."""
+        with self.lock:
+            if paths is None:
+                futures = list(self.pending.values())
+            else:
+                futures = [self.pending[p] for p in paths if isinstance(p, str) and p in self.pending]
+        if paths is None and self.last_log is not None:
+            # log entries are written in order by a single thread
+            futures.append(self.last_log)
+        concurrent.futures.wait(futures)
+
+    def shutdown(self):
+        """Writes everything that is pending, called on exit."""
+        if self.image_executor is not None:
+            self.image_executor.shutdown()
+            self.log_executor.shutdown()
 
-    parsed_parameters = metadata_parser.to_string(metadata.copy()) if metadata_parser is not None else ''
-    image = Image.fromarray(img)
+
+def run_and_print_exceptions(fn, *args):
+    try:
+        fn(*args)
+    except Exception:
+        traceback.print_exc()
+
+
+output_writer = OutputWriter(args_manager.args.image_writer_threads, args_manager.args.image_writer_queue_size)
+atexit.register(output_writer.shutdown)
+
+
+def save_image(image, local_temp_filename, output_format, metadata, metadata_parser: MetadataParser | None = None):
+    parsed_parameters = metadata_parser.to_string(metadata) if metadata_parser is not None else ''
 
     if output_format == OutputFormat.PNG.value:
         if parsed_parameters != '':
@@ -121,15 +199,13 @@ def log(img, metadata, metadata_parser: MetadataParser | None = None, output_for
     else:
         image.save(local_temp_filename)
 
-    if args_manager.args.disable_image_log:
-        return local_temp_filename
-
-    html_name = os.path.join(os.path.dirname(local_temp_filename), 'log.html')
 
+def get_html_log_begin(date_string):
     css_styles = (
         "<style>"
         "body { background-color: #121212; color: #E0E0E0; } "
         "a { color: #BB86FC; } "
+        ".log-entries { display: flex; flex-direction: column-reverse; } "
         ".metadata { border-collapse: collapse; width: 100%; } "
         ".metadata .label { width: 15%; } "
         ".metadata .value { width: 85%; font-weight: bold; } "
@@ -167,19 +243,41 @@ def log(img, metadata, metadata_parser: MetadataParser | None = None, output_for
         </script>"""
     )
 
-    begin_part = f"<!DOCTYPE html><html><head><title>Fooocus Log {date_string}</title>{css_styles}</head><body>{js}<p>Fooocus Log {date_string} (private)</p>\n<p>Metadata is embedded if enabled in the config or developer debug mode. You can find the information for each image in line Metadata Scheme.</p><!--fooocus-log-split-->\n\n"
-    end_part = f'\n<!--fooocus-log-split--></body></html>'
+    # entries are appended in chronological order and shown newest first by the column-reverse container,
+    # the container, body and html elements are closed implicitly at the end of the file
+    return f"<!DOCTYPE html><html><head><title>Fooocus Log {date_string}</title>{css_styles}</head><body>{js}<p>Fooocus Log {date_string} (private)</p>\n<p>Metadata is embedded if enabled in the config or developer debug mode. You can find the information for each image in line Metadata Scheme.</p><div class=\"log-entries\">{html_log_marker}\n\n"
 
-    middle_part = log_cache.get(html_name, "")
 
-    if middle_part == "":
-        if os.path.exists(html_name):
-            existing_split = open(html_name, 'r', encoding='utf-8').read().split('<!--fooocus-log-split-->')
-            if len(existing_split) == 3:
-                middle_part = existing_split[1]
-            else:
-                middle_part = existing_split[0]
+def open_html_log(html_name, date_string):
+    if os.path.exists(html_name):
+        with open(html_name, 'r', encoding='utf-8') as f:
+            content = f.read()
+        if html_log_marker in content:
+            return
 
+        # log written by an older version, newest entry first with a fixed end, converted once
+        existing_split = content.split('<!--fooocus-log-split-->')
+        middle_part = existing_split[1] if len(existing_split) == 3 else existing_split[0]
+        with open(html_name, 'w', encoding='utf-8') as f:
+            f.write(get_html_log_begin(date_string) + f'<div>{middle_part}</div>\n\n')
+        return
+
+    with open(html_name, 'w', encoding='utf-8') as f:
+        f.write(get_html_log_begin(date_string))
+
+
+def append_html_log(html_name, date_string, item):
+    with html_logs_lock:
+        if html_name not in html_logs:
+            open_html_log(html_name, date_string)
+            html_logs.add(html_name)
+        with open(html_name, 'a', encoding='utf-8') as f:
+            f.write(item)
+
+    print(f'Image generated with private log at: {html_name}')
+
+
+def render_html_log_item(only_name, metadata, task=None):
     div_name = only_name.replace('.', '_')
     item = f"<div id=\"{div_name}\" class=\"image-container\"><hr><table><tr>\n"
     item += f"<td><a href=\"{only_name}\" target=\"_blank\"><img src='{only_name}' onerror=\"this.closest('.image-container').style.display='none';\" loading='lazy'/></a><div>{only_name}</div></td>"
@@ -200,14 +298,28 @@ def log(img, metadata, metadata_parser: MetadataParser | None = None, output_for
 
     item += "</td>"
     item += "</tr></table></div>\n\n"
+    return item
 
-    middle_part = item + middle_part
 
-    with open(html_name, 'w', encoding='utf-8') as f:
-        f.write(begin_part + middle_part + end_part)
+def log(img, metadata, metadata_parser: MetadataParser | None = None, output_format=None, task=None, persist_image=True) -> str:
+    """
+    Saves the image and appends it to the log.html of the day. Both are written by output_writer in the
+    background, the returned path only exists once output_writer.wait() returned for it.
+    """
+    path_outputs = modules.config.temp_path if args_manager.args.disable_image_log or not persist_image else modules.config.path_outputs
+    output_format = output_format if output_format else modules.config.default_output_format
+    date_string, local_temp_filename, only_name = generate_temp_filename(folder=path_outputs, extension=output_format)
+    os.makedirs(os.path.dirname(local_temp_filename), exist_ok=True)
 
-    print(f'Image generated with private log at: {html_name}')
+    # copy, the caller may reuse the array once this returns
+    image = Image.fromarray(img.copy())
+    output_writer.submit_image(local_temp_filename, save_image, image, local_temp_filename, output_format,
+                               metadata.copy(), metadata_parser)
 
-    log_cache[html_name] = middle_part
+    if args_manager.args.disable_image_log:
+        return local_temp_filename
+
+    html_name = os.path.join(os.path.dirname(local_temp_filename), 'log.html')
+    output_writer.submit_log(append_html_log, html_name, date_string, render_html_log_item(only_name, metadata, task))
 
     return local_temp_filename
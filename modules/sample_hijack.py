@@ -1,6 +1,11 @@
+import os
+import warnings
+
 import torch
+import args_manager
 import ldm_patched.modules.samplers
 import ldm_patched.modules.model_management
+import modules.patch
 
 from collections import namedtuple
 from ldm_patched.contrib.external_align_your_steps import AlignYourStepsScheduler
@@ -12,12 +17,47 @@ from ldm_patched.modules.conds import CONDRegular
 from ldm_patched.modules.sample import get_additional_models, get_models_from_cond, cleanup_additional_models
 from ldm_patched.modules.samplers import resolve_areas_and_cond_masks, wrap_model, calculate_start_end_timesteps, \
     create_cond_with_same_area_if_none, pre_run_control, apply_empty_x_to_equal_area, encode_model_conds
+from modules.deep_cache import DeepCache
 
 
 current_refiner = None
 refiner_switch_step = -1
 
 
+class SyncPointCounter:
+    """
+    Counts the host-device synchronizations of every sampling step with torch.cuda.set_sync_debug_mode, enabled
+    with --debug-sync-points. Synchronizations of the step callback (previews) are not counted. CUDA only.
+    """
+
+    def __init__(self):
+        self.counts = []
+        self.catcher = None
+        self.records = None
+
+    def __enter__(self):
+        self.catcher = warnings.catch_warnings(record=True)
+        self.records = self.catcher.__enter__()
+        warnings.simplefilter('always')
+        torch.cuda.set_sync_debug_mode('warn')
+        return self
+
+    def count(self, step):
+        count = sum(1 for w in self.records if 'synchroniz' in str(w.message))
+        self.counts.append(count)
+        self.records.clear()
+        print(f'[Sync Points] Step {step}: {count} host-device synchronizations.')
+
+    def discard(self):
+        self.records.clear()
+
+    def __exit__(self, *exc_info):
+        torch.cuda.set_sync_debug_mode('default')
+        self.catcher.__exit__(*exc_info)
+        if len(self.counts) > 0:
+            print(f'[Sync Points] {sum(self.counts)} host-device synchronizations in {len(self.counts)} steps.')
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def clip_separate_inner(c, p, target_model=None, target_clip=None):
@@ -84,6 +124,16 @@ def clip_separate_after_preparation(cond, target_model=None, target_clip=None):
     return results
 
 
+def get_diffusion_progress(model, sampler, sigmas):
+    # the diffusion progress of every step is known from the sigmas, computing it once saves the UNet and the attention
+    # patches from reading the timestep back from the device on every call. Samplers that also call the model with other
+    # sigmas (second order steps, restart, dpm_fast, dpm_adaptive) get None, the UNet then reads the progress from the
+    # timestep it is called with.
+    if not getattr(sampler, 'steps_follow_sigmas', True):
+        return None
+    return (1.0 - model.model_sampling.timestep(sigmas).float() / 999.0).tolist()
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def sample_hacked(model, noise, positive, negative, cfg, device, sampler, sigmas, model_options={}, latent_image=None, denoise_mask=None, callback=None, disable_pbar=False, seed=None):
@@ -119,6 +169,21 @@ def sample_hacked(model, noise, positive, negative, cfg, device, sampler, sigmas
     apply_empty_x_to_equal_area(list(filter(lambda c: c.get('control_apply_to_uncond', False) == True, positive)), negative, 'control', lambda cond_cnets, x: cond_cnets[x])
     apply_empty_x_to_equal_area(positive, negative, 'gligen', lambda cond_cnets, x: cond_cnets[x])
 
+    diffusion_progress = get_diffusion_progress(model, sampler, sigmas)
+    sampling_state = {}
+    if diffusion_progress is not None:
+        sampling_state['diffusion_progress'] = diffusion_progress[0]
+
+    patch_settings = modules.patch.patch_settings.get(os.getpid())
+    deep_cache = None
+    if patch_settings is not None and patch_settings.deep_cache_interval > 1:
+        deep_cache = DeepCache(patch_settings.deep_cache_interval,
+                               switch_step=refiner_switch_step if current_refiner is not None else -1)
+        sampling_state['deep_cache'] = deep_cache
+
+    model_options = {**model_options, 'transformer_options': {
+        **model_options.get('transformer_options', {}), **sampling_state}}
+
     extra_args = {"cond":positive, "uncond":negative, "cond_scale": cfg, "model_options": model_options, "seed":seed}
 
     if current_refiner is not None and hasattr(current_refiner.model, 'extra_conds'):
@@ -135,7 +200,8 @@ def sample_hacked(model, noise, positive, negative, cfg, device, sampler, sigmas
         extra_args["uncond"] = negative_refiner
 
         # clear ip-adapter for refiner
-        extra_args['model_options'] = {k: {} if k == 'transformer_options' else v for k, v in extra_args['model_options'].items()}
+        extra_args['model_options'] = {k: {key: v[key] for key in sampling_state} if k == 'transformer_options' else v
+                                       for k, v in extra_args['model_options'].items()}
 
         models, inference_memory = get_additional_models(positive_refiner, negative_refiner, current_refiner.model_dtype())
         ldm_patched.modules.model_management.load_models_gpu(
@@ -146,16 +212,34 @@ def sample_hacked(model, noise, positive, negative, cfg, device, sampler, sigmas
         print('Refiner Swapped')
         return
 
+    sync_point_counter = None
+    if args_manager.args.debug_sync_points and noise.device.type == 'cuda':
+        sync_point_counter = SyncPointCounter()
+
     def callback_wrap(step, x0, x, total_steps):
+        if sync_point_counter is not None:
+            sync_point_counter.count(step)
         if step == refiner_switch_step and current_refiner is not None:
             refiner_switch()
+            if deep_cache is not None:
+                deep_cache.reset(step + 1)
+        if diffusion_progress is not None and step + 1 < len(diffusion_progress):
+            extra_args['model_options']['transformer_options']['diffusion_progress'] = diffusion_progress[step + 1]
+        if deep_cache is not None:
+            deep_cache.set_step(step + 1)
         if callback is not None:
             # residual_noise_preview = x - x0
             # residual_noise_preview /= residual_noise_preview.std()
             # residual_noise_preview *= x0.std()
             callback(step, x0, x, total_steps)
+        if sync_point_counter is not None:
+            sync_point_counter.discard()
 
-    samples = sampler.sample(model_wrap, sigmas, extra_args, callback_wrap, noise, latent_image, denoise_mask, disable_pbar)
+    if sync_point_counter is None:
+        samples = sampler.sample(model_wrap, sigmas, extra_args, callback_wrap, noise, latent_image, denoise_mask, disable_pbar)
+    else:
+        with sync_point_counter:
+            samples = sampler.sample(model_wrap, sigmas, extra_args, callback_wrap, noise, latent_image, denoise_mask, disable_pbar)
     return model.process_latent_out(samples.to(torch.float32))
 
 
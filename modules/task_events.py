@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import deque
+
+
+class TaskEvents:
+    """
+    Bounded, thread-safe channel of [flag, product] events from the worker to one consumer.
+
+    Consumers block in get() and wake as soon as an event arrives. A new 'preview' replaces a preview that
+    has not been consumed yet, and a new 'results' replaces unconsumed results since they always carry the
+    full result list, so a slow consumer only ever sees the latest state. When the channel is full, append()
+    waits up to put_timeout for the consumer and then drops the oldest preview rather than blocking the
+    worker on a consumer that went away. 'finish' and other events are never dropped.
+    """
+
+    coalesced_flags = ('preview', 'results')
+
+    def __init__(self, max_size=16, put_timeout=1.0):
+        self.condition = threading.Condition()
+        self.events = deque()
+        self.max_size = max_size
+        self.put_timeout = put_timeout
+
+    def append(self, event):
+        flag, product = event
+        with self.condition:
+            if flag in self.coalesced_flags and len(self.events) > 0 and self.events[-1][0] == flag:
+                if flag == 'preview' and product[2] is None:
+                    # keep the last preview image when only the progress text changed
+                    product = (product[0], product[1], self.events[-1][1][2])
+                self.events[-1] = [flag, product]
+                self.condition.notify_all()
+                return
+
+            if not self.condition.wait_for(lambda: len(self.events) < self.max_size, timeout=self.put_timeout):
+                for i, (queued_flag, _) in enumerate(self.events):
+                    if queued_flag == 'preview':
+                        del self.events[i]
+                        break
+
+            self.events.append([flag, product])
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """Blocks until an event is available and returns it, or None on timeout."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.events) > 0, timeout=timeout):
+                return None
+            event = self.events.popleft()
+            self.condition.notify_all()
+            return event
+
+    def __len__(self):
+        with self.condition:
+            return len(self.events)
+
+    def __deepcopy__(self, memo):
+        # gr.State deep-copies its initial AsyncTask per session, each copy gets its own empty channel
+        return TaskEvents(self.max_size, self.put_timeout)
+
+
+class PreviewLimiter:
+    """Lets a preview through at most once per interval, the last step of a run always gets one."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_time = None
+
+    def __call__(self, step, total_steps):
+        now = time.perf_counter()
+        if step + 1 < total_steps and self.last_time is not None and now - self.last_time < self.interval:
+            return False
+        self.last_time = now
+        return True
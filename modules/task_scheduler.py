@@ -0,0 +1,133 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+
+class TaskScheduler:
+    """
+    Blocking multi-consumer job queue for AsyncTask objects.
+
+    Tasks are ordered by priority (higher first), then round-robin across clients so that one client
+    queueing many jobs cannot starve the others, then FIFO within a client. Consumers block on a
+    condition variable in get() instead of polling.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()  # client_id -> heap of [-priority, seq, task], in round-robin order
+        self.enqueue_times = {}
+        self.counter = itertools.count()
+        self.closed = False
+
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.running = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.last_wait_time = 0.0
+        self.total_run_time = 0.0
+        self.start_times = {}
+
+    def put(self, task, priority=None, client_id=None):
+        if priority is None:
+            priority = getattr(task, 'priority', 0)
+        if client_id is None:
+            client_id = getattr(task, 'client_id', None)
+
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('Task scheduler is shut down.')
+            heapq.heappush(self.pending.setdefault(client_id, []), [-priority, next(self.counter), task])
+            self.enqueue_times[id(task)] = time.perf_counter()
+            self.submitted += 1
+            self.condition.notify()
+
+    # list-like alias, so code written against the old async_tasks list keeps working
+    append = put
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.closed or len(self.pending) > 0, timeout=timeout):
+                return None
+            if len(self.pending) == 0:
+                return None
+
+            best_client = None
+            best_priority = None
+            for client_id, heap in self.pending.items():
+                if best_priority is None or heap[0][0] < best_priority:
+                    best_client, best_priority = client_id, heap[0][0]
+
+            heap = self.pending.pop(best_client)
+            _, _, task = heapq.heappop(heap)
+            if len(heap) > 0:
+                # served client goes to the back of the round-robin order
+                self.pending[best_client] = heap
+
+            now = time.perf_counter()
+            wait_time = now - self.enqueue_times.pop(id(task), now)
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.last_wait_time = wait_time
+            self.started += 1
+            self.running += 1
+            self.start_times[id(task)] = now
+            return task
+
+    def task_done(self, task):
+        with self.condition:
+            start_time = self.start_times.pop(id(task), None)
+            if start_time is not None:
+                self.total_run_time += time.perf_counter() - start_time
+            self.running = max(self.running - 1, 0)
+            self.completed += 1
+            self.condition.notify_all()
+
+    def cancel(self, task):
+        """Remove a task that has not started yet. Returns False if it is not pending."""
+        with self.condition:
+            for client_id, heap in self.pending.items():
+                for i, entry in enumerate(heap):
+                    if entry[2] is task:
+                        heap.pop(i)
+                        heapq.heapify(heap)
+                        if len(heap) == 0:
+                            del self.pending[client_id]
+                        self.enqueue_times.pop(id(task), None)
+                        self.cancelled += 1
+                        self.condition.notify_all()
+                        return True
+        return False
+
+    def join(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.pending) == 0 and self.running == 0, timeout=timeout)
+
+    def shutdown(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        with self.condition:
+            return sum(len(heap) for heap in self.pending.values())
+
+    def stats(self):
+        with self.condition:
+            return dict(
+                queue_depth=sum(len(heap) for heap in self.pending.values()),
+                queued_clients=len(self.pending),
+                running=self.running,
+                submitted=self.submitted,
+                started=self.started,
+                completed=self.completed,
+                cancelled=self.cancelled,
+                average_wait_time=self.total_wait_time / self.started if self.started > 0 else 0.0,
+                max_wait_time=self.max_wait_time,
+                last_wait_time=self.last_wait_time,
+                average_run_time=self.total_run_time / self.completed if self.completed > 0 else 0.0,
+            )
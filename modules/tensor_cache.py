@@ -0,0 +1,161 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def to_cpu(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu')
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_cpu(x) for x in value)
+    if isinstance(value, dict):
+        return {k: to_cpu(v) for k, v in value.items()}
+    return value
+
+
+def size_in_bytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(size_in_bytes(x) for x in value)
+    if isinstance(value, dict):
+        return sum(size_in_bytes(v) for v in value.values())
+    return 0
+
+
+def file_signature(filename):
+    """Cheap identity of a file on disk that changes when the file is replaced."""
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_size, stat.st_mtime_ns
+
+
+class TensorCache:
+    """
+    LRU cache of tensors (or nested lists/tuples/dicts of tensors) bounded by their size in bytes.
+
+    Values are kept on the CPU. When a disk directory and budget are given, values are also written
+    to disk, so entries evicted from RAM or created by a previous process can be loaded back instead
+    of being recomputed. Keys must be hashable and have a stable repr() for the disk store.
+    """
+
+    def __init__(self, name, max_bytes, disk_path=None, max_disk_bytes=0):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path if disk_path is not None and max_disk_bytes > 0 else None
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.disk_entries = OrderedDict()
+        self.total_disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_path is not None:
+            os.makedirs(self.disk_path, exist_ok=True)
+            files = [os.path.join(self.disk_path, f) for f in os.listdir(self.disk_path) if f.endswith('.pt')]
+            for filename in sorted(files, key=os.path.getmtime):
+                size = os.path.getsize(filename)
+                self.disk_entries[filename] = size
+                self.total_disk_bytes += size
+
+    def disk_filename(self, key):
+        return os.path.join(self.disk_path, hashlib.sha256(repr(key).encode('utf-8')).hexdigest() + '.pt')
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+
+            if self.disk_path is not None:
+                filename = self.disk_filename(key)
+                if filename in self.disk_entries:
+                    try:
+                        value = torch.load(filename, map_location='cpu', weights_only=True)
+                    except Exception as e:
+                        print(f'[{self.name}] Failed to load cache entry {filename}: {e}')
+                        self.remove_disk_entry(filename)
+                    else:
+                        self.disk_entries.move_to_end(filename)
+                        self.disk_hits += 1
+                        self.insert(key, value)
+                        return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        value = to_cpu(value)
+        with self.lock:
+            self.insert(key, value)
+            if self.disk_path is not None:
+                self.write_to_disk(key, value)
+        return value
+
+    def insert(self, key, value):
+        size = size_in_bytes(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+    def write_to_disk(self, key, value):
+        filename = self.disk_filename(key)
+        if filename in self.disk_entries:
+            return
+        try:
+            torch.save(value, filename)
+        except Exception as e:
+            print(f'[{self.name}] Failed to write cache entry {filename}: {e}')
+            return
+        size = os.path.getsize(filename)
+        self.disk_entries[filename] = size
+        self.total_disk_bytes += size
+        while self.total_disk_bytes > self.max_disk_bytes and len(self.disk_entries) > 0:
+            self.remove_disk_entry(next(iter(self.disk_entries)))
+
+    def remove_disk_entry(self, filename):
+        self.total_disk_bytes -= self.disk_entries.pop(filename, 0)
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return dict(
+                entries=len(self.entries),
+                bytes=self.total_bytes,
+                max_bytes=self.max_bytes,
+                disk_entries=len(self.disk_entries),
+                disk_bytes=self.total_disk_bytes,
+                hits=self.hits,
+                disk_hits=self.disk_hits,
+                misses=self.misses,
+                hit_rate=(self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+            )
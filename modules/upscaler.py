@@ -1,33 +1,103 @@
+import threading
 from collections import OrderedDict
 
 import modules.core as core
 import torch
-from ldm_patched.contrib.external_upscale_model import ImageUpscaleWithModel
+import ldm_patched.modules.model_management as model_management
+import ldm_patched.modules.utils
+from ldm_patched.modules.model_patcher import ModelPatcher
 from ldm_patched.pfn.architecture.RRDB import RRDBNet as ESRGAN
 from modules.config import downloading_upscale_model
 
-opImageUpscaleWithModel = ImageUpscaleWithModel()
-model = None
 
+class Upscaler:
+    """
+    Runs the ESRGAN upscale model on the device model_management picks, in fp16 where the device supports it. The
+    model is loaded through model_management like every other model, so it stays loaded between upscales until the
+    memory is needed for something else.
 
-def perform_upscale(img):
-    global model
+    Images are upscaled in tiles, the largest tile size of tile_sizes for which a batch of at least one tile fits in
+    the free memory is used, with as many tiles per batch as fit.
+    """
 
-    print(f'Upscaling image with shape {str(img.shape)} ...')
+    tile_sizes = (512, 256, 128)
+    overlap = 32
+
+    def __init__(self, state_dict):
+        sd = OrderedDict()
+        for k, v in state_dict.items():
+            sd[k.replace('residual_block_', 'RDB')] = v
+        self.model = ESRGAN(sd)
+        self.model.eval()
+
+        load_device = model_management.get_torch_device()
+        offload_device = model_management.unet_offload_device()
+        self.dtype = torch.float16 if model_management.should_use_fp16(device=load_device) else torch.float32
+        self.model.to(self.dtype)
+
+        self.patcher = ModelPatcher(self.model, load_device=load_device, offload_device=offload_device)
+        self.lock = threading.Lock()
+        print(f'Upscaler loaded for {load_device}, dtype = {self.dtype}.')
+
+    def memory_per_tile(self, tile):
+        # peak activation memory of a tile, the same estimate ImageUpscaleWithModel uses
+        return tile * tile * 3 * model_management.dtype_size(self.dtype) * max(self.model.scale, 1.0) * 384.0
+
+    def tile_size_and_batch_size(self, free_memory):
+        for tile in self.tile_sizes:
+            batch_size = int(free_memory // self.memory_per_tile(tile))
+            if batch_size >= 1:
+                return tile, batch_size
+        return self.tile_sizes[-1], 1
+
+    @torch.no_grad()
+    @torch.inference_mode()
+    def upscale(self, img):
+        with self.lock:
+            device = self.patcher.load_device
+            model_management.load_models_gpu([self.patcher], memory_required=self.memory_per_tile(self.tile_sizes[-1]))
+            samples = core.numpy_to_pytorch(img).movedim(-1, -3)
+            tile, batch_size = self.tile_size_and_batch_size(model_management.get_free_memory(device))
+
+            while True:
+                try:
+                    s = self.upscale_tiles(samples.to(device), tile, batch_size)
+                    break
+                except model_management.OOM_EXCEPTION as e:
+                    if tile <= self.tile_sizes[-1]:
+                        raise e
+                    tile //= 2
+                    batch_size = 1
+                    model_management.soft_empty_cache(True)
+
+            s = torch.clamp(s.movedim(-3, -1), min=0, max=1.0)
+            return core.pytorch_to_numpy(s)[0]
 
-    if model is None:
-        model_filename = downloading_upscale_model()
-        sd = torch.load(model_filename, weights_only=True)
-        sdo = OrderedDict()
-        for k, v in sd.items():
-            sdo[k.replace('residual_block_', 'RDB')] = v
-        del sd
-        model = ESRGAN(sdo)
-        model.cpu()
-        model.eval()
-
-    img = core.numpy_to_pytorch(img)
-    img = opImageUpscaleWithModel.upscale(model, img)[0]
-    img = core.pytorch_to_numpy(img)[0]
-
-    return img
+    def run_model(self, x):
+        return self.model(x.to(self.dtype))
+
+    def upscale_tiles(self, samples, tile, batch_size):
+        steps = samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(
+            samples.shape[3], samples.shape[2], tile_x=tile, tile_y=tile, overlap=self.overlap)
+        pbar = ldm_patched.modules.utils.ProgressBar(steps)
+        return ldm_patched.modules.utils.tiled_scale(
+            samples, self.run_model, tile_x=tile, tile_y=tile, overlap=self.overlap,
+            upscale_amount=self.model.scale, pbar=pbar, max_batch_size=batch_size)
+
+
+upscaler = None
+upscaler_lock = threading.Lock()
+
+
+def get_upscaler():
+    global upscaler
+
+    with upscaler_lock:
+        if upscaler is None:
+            upscaler = Upscaler(torch.load(downloading_upscale_model(), weights_only=True))
+        return upscaler
+
+
+def perform_upscale(img):
+    print(f'Upscaling image with shape {str(img.shape)} ...')
+    return get_upscaler().upscale(img)
@@ -7,6 +7,7 @@ import math
 import os
 import cv2
 import re
+import threading
 from typing import List, Tuple, AnyStr, NamedTuple
 
 import json
@@ -202,13 +203,15 @@ def addnet_hash_safetensors(b):
     return hash_sha256.hexdigest()
 
 
-def calculate_sha256(filename) -> str:
+def calculate_sha256(filename, blksize=16 * 1024 * 1024) -> str:
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
+    # read into one reused buffer, hashlib and readinto both release the GIL for blocks this large
+    buffer = bytearray(blksize)
+    view = memoryview(buffer)
 
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+    with open(filename, "rb", buffering=0) as f:
+        while n := f.readinto(buffer):
+            hash_sha256.update(view[:n])
 
     return hash_sha256.hexdigest()
 
@@ -373,6 +376,10 @@ def get_file_from_folder_list(name, folders):
     if not isinstance(folders, list):
         folders = [folders]
 
+    filename = modules.config.file_index.find(name, folders)
+    if filename is not None:
+        return filename
+
     for folder in folders:
         filename = os.path.abspath(os.path.realpath(os.path.join(folder, name)))
         if os.path.isfile(filename):
@@ -465,18 +472,58 @@ def cleanup_prompt(prompt):
     return cleaned_prompt[:-2]
 
 
+class WildcardIndex:
+    """
+    Maps wildcard names to files of modules.config.wildcard_filenames and keeps the non-empty lines of every file
+    that was used. The name map is rebuilt when update_files replaces the file list, lines are read again when the
+    modification time or size of their file changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.filenames = None
+        self.path = None
+        self.paths = {}  # name -> path of the first file with that name, like the linear search used to pick
+        self.words = {}  # path -> (mtime_ns, size, words)
+
+    def get_words(self, name):
+        with self.lock:
+            if self.filenames is not modules.config.wildcard_filenames or self.path != modules.config.path_wildcards:
+                self.filenames = modules.config.wildcard_filenames
+                self.path = modules.config.path_wildcards
+                self.paths = {}
+                for filename in self.filenames:
+                    self.paths.setdefault(os.path.splitext(os.path.basename(filename))[0],
+                                          os.path.join(self.path, filename))
+                paths = set(self.paths.values())
+                self.words = {k: v for k, v in self.words.items() if k in paths}
+
+            path = self.paths[name]
+            stat = os.stat(path)
+            cached = self.words.get(path)
+            if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                return cached[2]
+
+            words = open(path, encoding='utf-8').read().splitlines()
+            words = [x for x in words if x != '']
+            self.words[path] = (stat.st_mtime_ns, stat.st_size, words)
+            return words
+
+
+wildcard_index = WildcardIndex()
+wildcard_pattern = re.compile(r'__([\w-]+)__')
+
+
 def apply_wildcards(wildcard_text, rng, i, read_wildcards_in_order) -> str:
     for _ in range(modules.config.wildcards_max_bfs_depth):
-        placeholders = re.findall(r'__([\w-]+)__', wildcard_text)
+        placeholders = wildcard_pattern.findall(wildcard_text)
         if len(placeholders) == 0:
             return wildcard_text
 
         print(f'[Wildcards] processing: {wildcard_text}')
         for placeholder in placeholders:
             try:
-                matches = [x for x in modules.config.wildcard_filenames if os.path.splitext(os.path.basename(x))[0] == placeholder]
-                words = open(os.path.join(modules.config.path_wildcards, matches[0]), encoding='utf-8').read().splitlines()
-                words = [x for x in words if x != '']
+                words = wildcard_index.get_words(placeholder)
                 assert len(words) > 0
                 if read_wildcards_in_order:
                     wildcard_text = wildcard_text.replace(f'__{placeholder}__', words[i % len(words)], 1)
@@ -2,3 +2,8 @@ import sys
 import pathlib
 
 sys.path.append(pathlib.Path(f'{__file__}/../modules').parent.resolve())
+
+import args_manager
+
+# models are placed by model_management, run them on the CPU like --always-cpu does, no test should depend on a GPU
+args_manager.args.always_cpu = -1
@@ -0,0 +1,49 @@
+import unittest
+
+import torch
+
+import modules.anisotropic as anisotropic
+
+
+class TestBilateralBlur(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.input = torch.randn(2, 4, 37, 29, dtype=torch.float64)
+        self.guidance = torch.randn(2, 4, 37, 29, dtype=torch.float64)
+
+    def assert_matches_unfold(self, input, guidance, **kwargs):
+        expected = anisotropic._bilateral_blur(input, guidance, **kwargs)
+        actual = anisotropic._bilateral_blur_accumulate(input, guidance, **kwargs)
+        self.assertEqual(expected.shape, actual.shape)
+        self.assertEqual(expected.dtype, actual.dtype)
+        torch.testing.assert_close(actual, expected, rtol=1e-10, atol=1e-10)
+
+    def test_matches_unfold_implementation(self):
+        for color_distance_type in ['l1', 'l2']:
+            for guidance in [None, self.guidance]:
+                self.assert_matches_unfold(self.input, guidance, kernel_size=(13, 13), sigma_color=3.0,
+                                           sigma_space=3.0, color_distance_type=color_distance_type)
+
+    def test_matches_unfold_implementation_with_other_parameters(self):
+        self.assert_matches_unfold(self.input, self.guidance, kernel_size=(5, 7), sigma_color=torch.tensor([0.5, 2.0]),
+                                   sigma_space=1.5, border_type='replicate')
+
+    def test_adaptive_anisotropic_filter_in_float32(self):
+        x = torch.randn(1, 4, 128, 128)
+        g = torch.randn(1, 4, 128, 128) * 5 + 1
+        s, m = torch.std_mean(g, dim=(1, 2, 3), keepdim=True)
+        expected = anisotropic._bilateral_blur(x, (g - m) / (s + 1e-5), kernel_size=(13, 13), sigma_color=3.0,
+                                               sigma_space=3.0)
+        torch.testing.assert_close(anisotropic.adaptive_anisotropic_filter(x, g), expected, rtol=1e-5, atol=1e-5)
+
+    def test_half_precision_accumulates_in_float32(self):
+        x = torch.randn(1, 4, 32, 32)
+        actual = anisotropic._bilateral_blur_accumulate(x.half(), None, kernel_size=(13, 13), sigma_color=3.0,
+                                                        sigma_space=3.0)
+        expected = anisotropic._bilateral_blur(x, None, kernel_size=(13, 13), sigma_color=3.0, sigma_space=3.0)
+        self.assertEqual(torch.float16, actual.dtype)
+        torch.testing.assert_close(actual.float(), expected, rtol=1e-2, atol=1e-2)
+
+    def test_rejects_unknown_color_distance(self):
+        with self.assertRaises(ValueError):
+            anisotropic._bilateral_blur_accumulate(self.input, None, 3, 1.0, 1.0, color_distance_type='l3')
@@ -0,0 +1,125 @@
+import base64
+import http.client
+import io
+import json
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+import modules.api as api
+import modules.patch
+
+# the API only needs the tasks of the worker, not the sampling patches it applies on import
+with mock.patch.object(modules.patch, 'patch_all'):
+    import modules.async_worker as worker
+from modules.task_scheduler import TaskScheduler
+
+
+def encode_png(image):
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+class FinishingScheduler(TaskScheduler):
+    # stands in for the worker, finishes every task with one image of its seed in the first pixel
+    def put(self, task):
+        super().put(task)
+        image = np.zeros((8, 8, 3), dtype=np.uint8)
+        image[0, 0, 0] = task.seed % 256
+        task.yields.append(['preview', (50, 'Sampling ...', None)])
+        task.yields.append(['finish', [image]])
+
+
+class TestFromParams(unittest.TestCase):
+    def test_defaults(self):
+        task = worker.AsyncTask.from_params({'prompt': 'a cat', 'seed': 7})
+        self.assertEqual('a cat', task.prompt)
+        self.assertEqual(7, task.seed)
+        self.assertEqual(task.performance_selection.steps(), task.steps)
+        self.assertEqual({}, task.enhance_stats)
+        self.assertEqual(0, task.images_to_enhance_count)
+        self.assertFalse(task.should_enhance)
+
+    def test_enhance(self):
+        task = worker.AsyncTask.from_params({'enhance_checkbox': True,
+                                             'enhance_ctrls': [{'mask_dino_prompt_text': 'face'}]})
+        self.assertTrue(task.should_enhance)
+        self.assertEqual(1, len(task.enhance_ctrls))
+        self.assertEqual('face', task.enhance_ctrls[0][0])
+        # the worker counts the enhanced images per task in these
+        self.assertEqual({}, task.enhance_stats)
+        self.assertEqual(0, task.images_to_enhance_count)
+
+    def test_random_seed_and_images(self):
+        image = np.full((4, 6, 3), 200, dtype=np.uint8)
+        task = api.create_task({'seed': -1, 'uov_input_image': encode_png(image),
+                                'image_prompts': [{'image': encode_png(image), 'type': 'ImagePrompt'}]})
+        self.assertGreaterEqual(task.seed, 0)
+        np.testing.assert_array_equal(image, task.uov_input_image)
+        self.assertEqual(1, len(task.cn_tasks['ImagePrompt']))
+        np.testing.assert_array_equal(image, task.cn_tasks['ImagePrompt'][0][0])
+
+    def test_unknown_parameters(self):
+        with self.assertRaises(ValueError):
+            worker.AsyncTask.from_params({'promt': 'a cat'})
+
+
+class TestApiHandler(unittest.TestCase):
+    def setUp(self):
+        self.async_tasks = mock.patch.object(worker, 'async_tasks', FinishingScheduler())
+        self.async_tasks.start()
+        self.server = api.create_server('127.0.0.1', 0)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.async_tasks.stop()
+
+    def request(self, method, path, body=None, headers=None):
+        connection = http.client.HTTPConnection(*self.server.server_address, timeout=10)
+        try:
+            connection.request(method, path, body=None if body is None else json.dumps(body), headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.read().decode('utf-8')
+        finally:
+            connection.close()
+
+    def test_health(self):
+        status, body = self.request('GET', '/v1/health')
+        self.assertEqual(200, status)
+        self.assertEqual('ok', json.loads(body)['status'])
+
+    def test_generation(self):
+        status, body = self.request('POST', '/v1/generation', {'prompt': 'a cat', 'seed': 42})
+        self.assertEqual(200, status)
+        result = json.loads(body)
+        self.assertEqual(42, result['seed'])
+        image = np.array(Image.open(io.BytesIO(base64.b64decode(result['images'][0]))))
+        self.assertEqual(42, image[0, 0, 0])
+        self.assertEqual({}, api.jobs)
+
+    def test_streamed_generation(self):
+        status, body = self.request('POST', '/v1/generation', {'seed': 3, 'stream': True})
+        self.assertEqual(200, status)
+        events = [event.split('\n') for event in body.strip().split('\n\n')]
+        self.assertEqual(['event: queued', 'event: preview', 'event: finish'], [event[0] for event in events])
+        self.assertEqual(50, json.loads(events[1][1][len('data: '):])['progress'])
+        self.assertEqual(1, len(json.loads(events[2][1][len('data: '):])['images']))
+
+    def test_errors(self):
+        status, body = self.request('POST', '/v1/generation', {'promt': 'a cat'})
+        self.assertEqual(400, status)
+        self.assertIn('promt', json.loads(body)['error'])
+        self.assertEqual(404, self.request('POST', '/v1/jobs/unknown/stop')[0])
+        self.assertEqual(404, self.request('GET', '/v1/unknown')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
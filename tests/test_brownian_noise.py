@@ -0,0 +1,47 @@
+import unittest
+
+import torch
+
+from modules.brownian_noise import DeviceBrownianTree
+
+
+class TestDeviceBrownianTree(unittest.TestCase):
+    def setUp(self):
+        self.x = torch.zeros(2, 4, 64, 64)
+        self.sigmas = torch.linspace(14.6, 0.03, 12).tolist()
+
+    def test_reproducible_and_consistent(self):
+        tree = DeviceBrownianTree(self.x, 0.03, 14.6, seed=[1, 2])
+        steps = [tree(s, s_next) for s, s_next in zip(self.sigmas[:-1], self.sigmas[1:])]
+        again = DeviceBrownianTree(self.x, 0.03, 14.6, seed=[1, 2])
+        for (s, s_next), w in zip(zip(self.sigmas[:-1], self.sigmas[1:]), steps):
+            self.assertTrue(torch.equal(w, again(s, s_next)))
+        # increments of adjacent intervals add up to the increment of their union
+        torch.testing.assert_close(sum(steps), tree(self.sigmas[0], self.sigmas[-1]), rtol=1e-5, atol=1e-5)
+
+    def test_batch_items_only_depend_on_their_seed(self):
+        batched = DeviceBrownianTree(self.x, 0.03, 14.6, seed=[7, 8])(5.0, 2.5)
+        single = DeviceBrownianTree(self.x[:1], 0.03, 14.6, seed=[8])(5.0, 2.5)
+        self.assertEqual(self.x.shape, batched.shape)
+        self.assertTrue(torch.equal(batched[1], single[0]))
+        self.assertFalse(torch.equal(batched[0], batched[1]))
+
+        unbatched = DeviceBrownianTree(self.x, 0.03, 14.6, seed=8)(5.0, 2.5)
+        self.assertEqual(self.x.shape, unbatched.shape)
+
+    def test_increments_are_brownian(self):
+        x = torch.zeros(8, 4, 64, 64)
+        tree = DeviceBrownianTree(x, 0.03, 14.6, seed=list(range(8)))
+        first = tree(10.0, 6.0)
+        second = tree(6.0, 5.5)
+        self.assertAlmostEqual(4.0, first.var().item(), delta=0.1)
+        self.assertAlmostEqual(0.5, second.var().item(), delta=0.015)
+        self.assertAlmostEqual(0.0, first.mean().item(), delta=0.05)
+        correlation = torch.corrcoef(torch.stack([first.flatten(), second.flatten()]))[0, 1]
+        self.assertAlmostEqual(0.0, correlation.item(), delta=0.02)
+
+    def test_sign_follows_time_direction(self):
+        # samplers transform sigma with a decreasing function like -log(sigma)
+        tree = DeviceBrownianTree(self.x, -torch.tensor(0.03).log(), -torch.tensor(14.6).log(), seed=3)
+        forward = tree(torch.tensor(1.0), torch.tensor(2.0))
+        torch.testing.assert_close(forward, -tree(torch.tensor(2.0), torch.tensor(1.0)))
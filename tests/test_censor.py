@@ -0,0 +1,119 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import cv2
+import numpy as np
+import torch
+from transformers import CLIPImageProcessor
+
+import extras.censor
+from extras.censor import Censor
+
+
+class BrightnessChecker(torch.nn.Module):
+    # flags images brighter than the mean of the CLIP normalization, and records the batch sizes it was called with
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.zeros(1), requires_grad=False)
+        self.batch_sizes = []
+
+    def forward(self, clip_input, images):
+        self.batch_sizes.append(clip_input.shape[0])
+        return images, [bool(x.float().mean() > 0) for x in clip_input]
+
+
+class SlowChecker(BrightnessChecker):
+    def __init__(self):
+        super().__init__()
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def forward(self, clip_input, images):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        return super().forward(clip_input, images)
+
+
+class TestCensor(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.processor = CLIPImageProcessor.from_json_file(extras.censor.preprocessor_config_path)
+        self.censor = Censor(max_batch_size=2)
+        self.checker = BrightnessChecker()
+        self.censor.set_model(self.checker, self.processor)
+
+    def image(self, height, width, bright):
+        low, high = (160, 256) if bright else (0, 96)
+        return self.rng.integers(low, high, (height, width, 3), dtype=np.uint8)
+
+    def test_preprocess_matches_clip_image_processor(self):
+        for height, width in [(96, 96), (300, 200), (256, 448)]:
+            # PIL clips between the two passes of its resize, which only matters for images as sharp as noise
+            image = cv2.GaussianBlur(self.rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 3)
+            expected = self.processor(image, return_tensors='pt').pixel_values
+            clip_input = self.censor.preprocess(self.censor.to_pixels(image[None]))
+            self.assertEqual(expected.shape, clip_input.shape)
+            # PIL rounds the resized image to uint8
+            difference = (clip_input.float() - expected).abs()
+            self.assertLess(difference.max().item(), 0.03)
+            self.assertLess(difference.mean().item(), 0.01)
+
+    def test_censor_blacks_out_flagged_images_in_batches(self):
+        bright = [True, False, True, True, False]
+        images = [self.image(64, 48, b) for b in bright]
+        censored = self.censor.censor(images)
+
+        self.assertEqual([2, 2, 1], self.checker.batch_sizes)
+        for image, censored_image, b in zip(images, censored, bright):
+            np.testing.assert_array_equal(np.zeros_like(image) if b else image, censored_image)
+
+        single = self.image(40, 40, True)
+        np.testing.assert_array_equal(np.zeros_like(single), self.censor.censor(single))
+
+        # images of different sizes are preprocessed one by one, checked together
+        self.checker.batch_sizes.clear()
+        images = [self.image(64, 48, True), self.image(32, 80, False)]
+        censored = self.censor.censor(images)
+        self.assertEqual([2], self.checker.batch_sizes)
+        np.testing.assert_array_equal(np.zeros_like(images[0]), censored[0])
+        np.testing.assert_array_equal(images[1], censored[1])
+
+    def test_submit_runs_in_the_background_only_for_a_cpu_checker_beside_another_sampling_device(self):
+        images = [self.image(64, 48, True)]
+        future = self.censor.submit(images)
+        self.assertTrue(future.done())
+        self.assertIsNone(self.censor.executor)
+        self.assertFalse(future.result()[0].any())
+
+        with mock.patch.object(extras.censor.model_management, 'get_torch_device', return_value=torch.device('cuda')):
+            self.assertTrue(self.censor.runs_in_background())
+            with mock.patch.object(extras.censor.model_management, 'load_model_gpu') as load_model_gpu:
+                self.assertFalse(self.censor.submit(images).result()[0].any())
+                load_model_gpu.assert_not_called()
+            self.assertIsNotNone(self.censor.executor)
+        self.censor.executor.shutdown()
+
+    def test_background_checks_and_checks_on_the_worker_thread_are_serialized(self):
+        checker = SlowChecker()
+        self.censor.set_model(checker, self.processor)
+        images = [self.image(64, 48, b) for b in [True, False]]
+        with mock.patch.object(extras.censor.model_management, 'get_torch_device', return_value=torch.device('cuda')):
+            futures = [self.censor.submit(images) for _ in range(2)]
+            censored = self.censor.censor(images)
+            for result in [future.result() for future in futures] + [censored]:
+                self.assertFalse(result[0].any())
+                np.testing.assert_array_equal(images[1], result[1])
+        self.censor.executor.shutdown()
+        self.assertEqual(3, len(checker.batch_sizes))
+        self.assertEqual(1, checker.max_running)
+
+
+if __name__ == '__main__':
+    unittest.main()
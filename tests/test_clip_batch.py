@@ -0,0 +1,71 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+
+import ldm_patched.modules.sd
+import ldm_patched.modules.sd1_clip as sd1_clip
+import ldm_patched.modules.sdxl_clip as sdxl_clip
+import modules.patch_clip
+from ldm_patched.modules.supported_models_base import ClipTarget
+
+
+def write_clip_config(path, name, hidden_act):
+    filename = os.path.join(path, f'clip_{name}.json')
+    with open(filename, 'w') as f:
+        json.dump({
+            "attention_dropout": 0.0, "bos_token_id": 0, "dropout": 0.0, "eos_token_id": 2, "hidden_act": hidden_act,
+            "hidden_size": 32, "initializer_factor": 1.0, "initializer_range": 0.02, "intermediate_size": 64,
+            "layer_norm_eps": 1e-05, "max_position_embeddings": 77, "model_type": "clip_text_model",
+            "num_attention_heads": 2, "num_hidden_layers": 3, "pad_token_id": 1, "projection_dim": 32,
+            "torch_dtype": "float32", "vocab_size": 49408
+        }, f)
+    return filename
+
+
+class TestClipBatch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        modules.patch_clip.patch_all_clip()
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        config_l = write_clip_config(cls.temp_dir.name, 'l', 'quick_gelu')
+        config_g = write_clip_config(cls.temp_dir.name, 'g', 'gelu')
+
+        class SmallSDXLClipModel(sdxl_clip.SDXLClipModel):
+            def __init__(self, device='cpu', dtype=None):
+                torch.nn.Module.__init__(self)
+                self.clip_l = sd1_clip.SDClipModel(layer='hidden', layer_idx=-2, device=device, dtype=dtype,
+                                                   textmodel_json_config=config_l, layer_norm_hidden_state=False)
+                self.clip_g = sd1_clip.SDClipModel(layer='hidden', layer_idx=-2, device=device, dtype=dtype,
+                                                   textmodel_json_config=config_g, layer_norm_hidden_state=False,
+                                                   special_tokens={"start": 49406, "end": 49407, "pad": 0})
+
+        cls.clip = ldm_patched.modules.sd.CLIP(target=ClipTarget(sdxl_clip.SDXLTokenizer, SmallSDXLClipModel))
+        torch.manual_seed(0)
+        for p in cls.clip.cond_stage_model.parameters():
+            p.data.normal_(0, 0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    def test_batch_matches_single_texts(self):
+        texts = ['a cat', '(a dog:1.3) in the park', '', ' '.join(['word'] * 100), 'a (castle:0.8), (moat:1.2)']
+        expected = [self.clip.encode_from_tokens(self.clip.tokenize(text), return_pooled=True) for text in texts]
+        actual = self.clip.encode_from_tokens_batch([self.clip.tokenize(text) for text in texts])
+        self.assertEqual(len(expected), len(actual))
+        for (expected_cond, expected_pooled), (cond, pooled) in zip(expected, actual):
+            torch.testing.assert_close(cond, expected_cond, rtol=1e-5, atol=1e-5)
+            torch.testing.assert_close(pooled, expected_pooled, rtol=1e-5, atol=1e-5)
+
+    def test_small_batches(self):
+        texts = ['a cat', 'a dog', ' '.join(['word'] * 100)]
+        expected = self.clip.encode_from_tokens_batch([self.clip.tokenize(text) for text in texts])
+        with mock.patch.object(modules.patch_clip, 'clip_encode_batch_size', return_value=1):
+            actual = self.clip.encode_from_tokens_batch([self.clip.tokenize(text) for text in texts])
+        for (expected_cond, expected_pooled), (cond, pooled) in zip(expected, actual):
+            torch.testing.assert_close(cond, expected_cond, rtol=1e-5, atol=1e-5)
+            torch.testing.assert_close(pooled, expected_pooled, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import safetensors.torch
+import torch
+
+import modules.core as core
+from ldm_patched.modules.model_patcher import ModelPatcher
+
+
+class Clip:
+    # stands in for ldm_patched.modules.sd.CLIP
+    def __init__(self):
+        self.cond_stage_model = torch.nn.Linear(2, 2)
+        self.patcher = ModelPatcher(self.cond_stage_model, load_device=torch.device('cpu'),
+                                    offload_device=torch.device('cpu'))
+        self.layer_idx = None
+
+    def clone(self):
+        n = Clip()
+        n.layer_idx = self.layer_idx
+        return n
+
+    def clip_layer(self, layer_idx):
+        self.layer_idx = layer_idx
+
+
+class TestClipCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.checkpoints = [self.write_file(f'model_{i}.safetensors') for i in range(2)]
+        self.lora = self.write_file('lora.safetensors')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_file(self, name):
+        filename = os.path.join(self.temp_dir.name, name)
+        safetensors.torch.save_file({'weight': torch.zeros(1)}, filename)
+        return filename
+
+    def cache_key(self, checkpoint, loras, clip_skip=2):
+        # the part of the key of default_pipeline.clip_cond_cache that identifies the CLIP, for a freshly loaded model
+        clip = Clip()
+        with mock.patch.object(core, 'model_lora_keys_unet', return_value={}), \
+                mock.patch.object(core, 'model_lora_keys_clip', return_value={}):
+            model = core.StableDiffusionModel(unet=ModelPatcher(torch.nn.Linear(2, 2), load_device=torch.device('cpu'),
+                                                                offload_device=torch.device('cpu')),
+                                              clip=clip, filename=checkpoint)
+            model.refresh_loras(loras)
+        model.clip_with_lora.clip_layer(-clip_skip)
+        return model.clip_with_lora.cond_cache_key, model.clip_with_lora.layer_idx
+
+    def test_cond_cache_key_and_layer_idx_separate_the_clip_weights(self):
+        configurations = [(self.checkpoints[0], [], 2), (self.checkpoints[1], [], 2),
+                          (self.checkpoints[0], [(self.lora, 0.5)], 2), (self.checkpoints[0], [(self.lora, 1.0)], 2),
+                          (self.checkpoints[0], [], 1)]
+        keys = [self.cache_key(*configuration) for configuration in configurations]
+        self.assertEqual(len(keys), len(set(keys)))
+
+        # entries stay valid for the same weights loaded again
+        self.assertEqual(keys, [self.cache_key(*configuration) for configuration in configurations])
+
+    def test_replaced_checkpoint_is_not_taken_from_the_cache(self):
+        key = self.cache_key(self.checkpoints[0], [])
+        safetensors.torch.save_file({'weight': torch.ones(2)}, self.checkpoints[0])
+        self.assertNotEqual(key, self.cache_key(self.checkpoints[0], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
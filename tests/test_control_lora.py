@@ -0,0 +1,119 @@
+import types
+import unittest
+from unittest import mock
+
+import torch
+
+import ldm_patched.controlnet.cldm
+import ldm_patched.modules.controlnet as controlnet
+import ldm_patched.modules.ops
+import ldm_patched.modules.utils
+from ldm_patched.ldm.modules.diffusionmodules.openaimodel import UNetModel
+
+unet_config = {
+    'image_size': 32, 'in_channels': 4, 'out_channels': 4, 'model_channels': 32, 'num_res_blocks': [1, 1],
+    'channel_mult': [1, 2], 'transformer_depth': [0, 1], 'transformer_depth_middle': 1,
+    'transformer_depth_output': [0, 0, 1, 1], 'context_dim': 32, 'num_head_channels': 16,
+    'use_linear_in_transformer': True, 'use_spatial_transformer': True, 'legacy': False, 'dtype': torch.float32,
+}
+
+
+def create_base_model():
+    # what ControlLora.pre_run uses of a model_base.BaseModel
+    diffusion_model = UNetModel(**unet_config, operations=ldm_patched.modules.ops.disable_weight_init)
+    for p in diffusion_model.parameters():
+        p.data.normal_(0, 0.05)
+    return types.SimpleNamespace(model_config=types.SimpleNamespace(unet_config=unet_config),
+                                 manual_cast_dtype=None, get_dtype=lambda: torch.float32,
+                                 diffusion_model=diffusion_model, model_sampling=None)
+
+
+def create_control_weights(diffusion_model, rank=4):
+    config = {k: v for k, v in unet_config.items() if k != 'out_channels'}
+    control_model = ldm_patched.controlnet.cldm.ControlNet(hint_channels=3, **config)
+    unet_sd = diffusion_model.state_dict()
+    control_weights = {'lora_controlnet': torch.tensor([])}
+    for k, v in control_model.state_dict().items():
+        if k not in unet_sd:
+            control_weights[k] = torch.randn(v.shape) * 0.05
+        elif k.endswith('.weight') and v.ndim == 2 and '.transformer_blocks.' in k:
+            control_weights[k[:-len('.weight')] + '.up'] = torch.randn(v.shape[0], rank) * 0.05
+            control_weights[k[:-len('.weight')] + '.down'] = torch.randn(rank, v.shape[1]) * 0.05
+    return control_weights
+
+
+def reference_control_model(control_weights, model):
+    # the control network as ControlLora.pre_run used to build it on every run
+    config = {k: v for k, v in unet_config.items() if k != 'out_channels'}
+
+    class control_lora_ops(controlnet.ControlLoraOps, ldm_patched.modules.ops.disable_weight_init):
+        pass
+
+    control_model = ldm_patched.controlnet.cldm.ControlNet(hint_channels=3, operations=control_lora_ops, **config)
+    for k, weight in model.diffusion_model.state_dict().items():
+        try:
+            ldm_patched.modules.utils.set_attr(control_model, k, weight)
+        except:
+            pass
+    for k in control_weights:
+        if k != 'lora_controlnet':
+            ldm_patched.modules.utils.set_attr(control_model, k, control_weights[k])
+    return control_model
+
+
+class TestControlLora(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = create_base_model()
+        self.control_weights = create_control_weights(self.model.diffusion_model)
+        self.control = controlnet.ControlLora(self.control_weights, device='cpu')
+        self.inputs = dict(x=torch.randn(2, 4, 16, 16), hint=torch.rand(2, 3, 128, 128),
+                           timesteps=torch.tensor([500.0, 500.0]), context=torch.randn(2, 7, 32))
+        self.networks = mock.patch.dict(controlnet.control_lora_networks, clear=True)
+        self.networks.start()
+
+    def tearDown(self):
+        self.networks.stop()
+
+    def run_control(self, control):
+        control.pre_run(self.model, lambda percent: 999.0 * (1.0 - percent))
+        try:
+            with torch.no_grad():
+                return control.control_model(**self.inputs)
+        finally:
+            control.cleanup()
+
+    def assert_outputs_equal(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for e, a in zip(expected, actual):
+            torch.testing.assert_close(a, e)
+
+    def test_network_is_built_once(self):
+        with torch.no_grad():
+            expected = reference_control_model(self.control_weights, self.model)(**self.inputs)
+        self.assertEqual([], self.control.get_models())
+        self.assert_outputs_equal(expected, self.run_control(self.control))
+
+        network = controlnet.control_lora_networks[id(self.control_weights)]
+        self.assertEqual([network.patcher], self.control.get_models())
+        with mock.patch.object(ldm_patched.controlnet.cldm, 'ControlNet', side_effect=AssertionError):
+            self.assert_outputs_equal(expected, self.run_control(self.control.copy()))
+
+    def test_only_control_weights_are_managed(self):
+        self.assertGreater(self.control.inference_memory_requirements(torch.float32), 0)
+        self.run_control(self.control)
+        # model_management loads the control weights now, they are no longer part of the inference memory
+        self.assertEqual(0, self.control.inference_memory_requirements(torch.float32))
+        network = controlnet.control_lora_networks[id(self.control_weights)]
+        self.assertEqual(set(self.control_weights) - {'lora_controlnet'}, set(network.control_model.state_dict()))
+        # nothing refers to the UNet between runs
+        self.assertTrue(all(getattr(module, name) is None for module, name, _ in network.links))
+
+    def test_replaced_unet_weights_are_used(self):
+        self.run_control(self.control)
+        # patching a LoRA into the UNet replaces its parameters
+        for k, weight in list(self.model.diffusion_model.state_dict().items()):
+            ldm_patched.modules.utils.set_attr(self.model.diffusion_model, k, weight * 1.1)
+        with torch.no_grad():
+            expected = reference_control_model(self.control_weights, self.model)(**self.inputs)
+        self.assert_outputs_equal(expected, self.run_control(self.control.copy()))
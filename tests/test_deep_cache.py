@@ -0,0 +1,94 @@
+import os
+import unittest
+from unittest import mock
+
+import torch
+
+import ldm_patched.modules.ops
+import modules.patch
+from ldm_patched.ldm.modules.diffusionmodules.openaimodel import UNetModel
+from modules.deep_cache import DeepCache
+
+
+def control_for(unet, x, t, context):
+    # residuals in the shapes a ControlNet gives for the skip connections and the middle block
+    shapes = []
+    options = {'patches': {'input_block_patch': [lambda h, transformer_options: shapes.append(h.shape) or h]}}
+    with torch.no_grad():
+        unet(x, t, context=context, transformer_options=options)
+    return lambda: {'input': [], 'middle': [torch.full(shapes[-1], 0.1)],
+                    'output': [torch.full(shape, 0.01 * (i + 1)) for i, shape in enumerate(shapes)]}
+
+
+class TestDeepCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        cls.unet = UNetModel(image_size=32, in_channels=4, model_channels=32, out_channels=4, num_res_blocks=2,
+                             channel_mult=(1, 2, 4), transformer_depth=[0, 0, 1, 1, 1, 1], transformer_depth_middle=1,
+                             transformer_depth_output=[0, 0, 0, 1, 1, 1, 1, 1, 1], context_dim=32,
+                             num_head_channels=16, use_linear_in_transformer=True, use_spatial_transformer=True,
+                             operations=ldm_patched.modules.ops.disable_weight_init)
+        for p in cls.unet.parameters():
+            p.data.normal_(0, 0.05)
+        cls.forward = mock.patch.object(UNetModel, 'forward', modules.patch.patched_unet_forward)
+        cls.forward.start()
+        cls.patch_settings = mock.patch.dict(modules.patch.patch_settings, {os.getpid(): modules.patch.PatchSettings()})
+        cls.patch_settings.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.forward.stop()
+        cls.patch_settings.stop()
+
+    def setUp(self):
+        self.x = torch.randn(2, 4, 16, 16)
+        self.t = torch.tensor([500.0, 500.0])
+        self.context = torch.randn(2, 7, 32)
+
+    def run_unet(self, deep_cache, x=None, control=None):
+        options = {'diffusion_progress': 0.5, 'cond_or_uncond': [0, 1]}
+        if deep_cache is not None:
+            options['deep_cache'] = deep_cache
+        with torch.no_grad():
+            return self.unet(self.x if x is None else x, self.t, context=self.context, control=control,
+                             transformer_options=options)
+
+    def test_cached_steps_continue_from_the_stored_features(self):
+        expected = self.run_unet(None)
+        deep_cache = DeepCache(interval=3, depth=3)
+        torch.testing.assert_close(self.run_unet(deep_cache), expected)
+
+        other = self.run_unet(None, x=self.x * 0.5)
+        deep_cache.set_step(1)
+        forward_timestep_embed = modules.patch.forward_timestep_embed
+
+        def skip_middle_block(module, *args, **kwargs):
+            self.assertIsNot(self.unet.middle_block, module)
+            return forward_timestep_embed(module, *args, **kwargs)
+
+        with mock.patch.object(modules.patch, 'forward_timestep_embed', skip_middle_block):
+            # same input as the stored step, so reusing the deep features is exact
+            torch.testing.assert_close(self.run_unet(deep_cache), expected)
+            self.assertFalse(torch.allclose(self.run_unet(deep_cache, x=self.x * 0.5), other))
+
+        deep_cache.set_step(3)
+        torch.testing.assert_close(self.run_unet(deep_cache, x=self.x * 0.5), other)
+
+    def test_control_of_the_computed_blocks_is_applied(self):
+        control = control_for(self.unet, self.x, self.t, self.context)
+        expected = self.run_unet(None, control=control())
+        deep_cache = DeepCache(interval=2, depth=3)
+        self.run_unet(deep_cache, control=control())
+        deep_cache.set_step(1)
+        torch.testing.assert_close(self.run_unet(deep_cache, control=control()), expected)
+
+    def test_full_steps(self):
+        deep_cache = DeepCache(interval=3, switch_step=4)
+        deep_cache.store('key', torch.zeros(1))
+        self.assertEqual([True, False, False, True, True, False, True],
+                         [deep_cache.set_step(step) or deep_cache.get('key') is None for step in range(7)])
+        deep_cache.reset(5)
+        self.assertIsNone(deep_cache.get('key'))
+        self.assertEqual([True, False, False, True],
+                         [deep_cache.set_step(step) or deep_cache.is_full_step() for step in range(5, 9)])
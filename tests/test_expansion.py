@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel, set_seed
+from transformers.generation.logits_process import LogitsProcessorList
+
+import extras.expansion as expansion
+import modules.config
+
+
+def reference_expansion(e, prompt, seed):
+    # one prompt at a time with model.generate, as FooocusExpansion used to work
+    set_seed(int(seed) % expansion.SEED_LIMIT_NUMPY)
+    prompt = expansion.safe_str(prompt) + ','
+    tokenized_kwargs = e.tokenizer(prompt, return_tensors="pt")
+    current_token_length = int(tokenized_kwargs.data['input_ids'].shape[1])
+    max_new_tokens = 75 * ((current_token_length + 74) // 75) - current_token_length
+
+    def logits_processor(input_ids, scores):
+        bias = e.logits_bias.clone()
+        bias[0, input_ids[0].long()] = expansion.neg_inf
+        bias[0, 11] = 0
+        return scores + bias
+
+    features = e.model.generate(**tokenized_kwargs, top_k=100, max_new_tokens=max_new_tokens, do_sample=True,
+                                pad_token_id=e.tokenizer.eos_token_id,
+                                logits_processor=LogitsProcessorList([logits_processor]))
+    return expansion.safe_str(e.tokenizer.batch_decode(features, skip_special_tokens=True)[0])
+
+
+class TestFooocusExpansion(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the real tokenizer and vocab with a tiny randomly initialized GPT-2
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        for filename in os.listdir(modules.config.path_fooocus_expansion):
+            if filename.endswith('.json') or filename.endswith('.txt'):
+                shutil.copy(os.path.join(modules.config.path_fooocus_expansion, filename), cls.temp_dir.name)
+        torch.manual_seed(0)
+        GPT2LMHeadModel(GPT2Config(n_embd=64, n_layer=2, n_head=2)).save_pretrained(cls.temp_dir.name)
+
+        cls.expansion = expansion.FooocusExpansion(path=cls.temp_dir.name, max_batch_size=3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    def setUp(self):
+        self.expansion.cache.clear()
+
+    def test_batches_match_one_by_one_generation(self):
+        prompts = ['a cat', 'a dog in the park', 'a cat', 'a castle', 'a cave', 'a cake', 'a cat']
+        seeds = [1, 2, 3, 4, 5, 6, 2 ** 32 + 1]
+        expected = [reference_expansion(self.expansion, p, s) for p, s in zip(prompts, seeds)]
+        self.assertEqual(expected, self.expansion.expand(prompts, seeds))
+        self.assertEqual(expected[1], self.expansion('a dog in the park', 2))
+        # seeds are taken modulo 2 ** 32
+        self.assertEqual(expected[0], expected[6])
+
+    def test_cached_results_skip_the_model(self):
+        first = self.expansion.expand(['a cat', 'a dog'], [1, 2])
+        with mock.patch.object(self.expansion, 'sample', side_effect=AssertionError):
+            self.assertEqual(first, self.expansion.expand(['a cat ', 'a dog'], [1, 2]))
+            self.assertEqual('', self.expansion('', 3))
+
+    def test_cache_size(self):
+        self.expansion.cache_size = 2
+        try:
+            self.expansion.expand(['a cat', 'a dog', 'a cow'], [1, 1, 1])
+            self.assertEqual([('a dog,', 1), ('a cow,', 1)], list(self.expansion.cache.keys()))
+        finally:
+            self.expansion.cache_size = 1024
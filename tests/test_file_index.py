@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from modules import extra_utils
+from modules.file_index import FileIndex, file_index_version
+
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.folder = os.path.join(self.temp_dir.name, 'loras')
+        for name in ['b.safetensors', 'A.safetensors', 'notes.txt', os.path.join('sdxl', 'c.safetensors'),
+                     os.path.join('sdxl', 'styles', 'd.safetensors'), os.path.join('sd15', 'e.pth')]:
+            self.write(name, name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, name, content):
+        filename = os.path.join(self.folder, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            f.write(content)
+
+    def test_list_files_matches_get_files_from_folder(self):
+        index = FileIndex()
+        for extensions, name_filter in [(None, None), (['.safetensors'], None), (['.safetensors', '.pth'], 'c')]:
+            self.assertEqual(extra_utils.get_files_from_folder(self.folder, extensions, name_filter),
+                             index.list_files(self.folder, extensions, name_filter))
+
+        self.write(os.path.join('sdxl', 'f.safetensors'), 'f')
+        os.remove(os.path.join(self.folder, 'b.safetensors'))
+        self.assertEqual(extra_utils.get_files_from_folder(self.folder), index.list_files(self.folder))
+
+        with self.assertRaises(ValueError):
+            index.list_files(os.path.join(self.folder, 'missing'))
+
+    def test_refresh_only_lists_changed_directories(self):
+        index = FileIndex()
+        index.list_files(self.folder)
+
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            index.list_files(self.folder)
+            self.assertEqual(0, scandir.call_count)
+
+            self.write(os.path.join('sdxl', 'f.safetensors'), 'f')
+            self.assertIn(os.path.join('sdxl', 'f.safetensors'), index.list_files(self.folder))
+            scandir.assert_called_once_with(os.path.join(os.path.abspath(self.folder), 'sdxl'))
+
+    def test_find(self):
+        other = os.path.join(self.temp_dir.name, 'other')
+        os.makedirs(other)
+        index = FileIndex()
+        index.list_files(self.folder)
+
+        # unindexed folders are left to the caller
+        self.assertIsNone(index.find('b.safetensors', [other, self.folder]))
+
+        index.list_files(other)
+        expected = os.path.realpath(os.path.join(self.folder, 'sdxl', 'c.safetensors'))
+        self.assertEqual(expected, index.find(os.path.join('sdxl', 'c.safetensors'), [other, self.folder]))
+        self.assertEqual(expected, index.find('sdxl/./c.safetensors', [other, self.folder]))
+        self.assertIsNone(index.find('missing.safetensors', [other, self.folder]))
+
+    def test_index_is_persisted(self):
+        filename = os.path.join(self.temp_dir.name, 'cache', 'file_index.json')
+        index = FileIndex(filename)
+        index.list_files(self.folder)
+        index.save()
+        self.assertTrue(os.path.exists(filename))
+
+        loaded = FileIndex(filename)
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertEqual(index.list_files(self.folder), loaded.list_files(self.folder))
+            self.assertEqual(0, scandir.call_count)
+
+        # an index of another version is listed again
+        with open(filename, 'wt', encoding='utf-8') as f:
+            json.dump({'version': file_index_version - 1, 'folders': loaded.folders}, f)
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertEqual(index.list_files(self.folder), FileIndex(filename).list_files(self.folder))
+            self.assertGreater(scandir.call_count, 0)
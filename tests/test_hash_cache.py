@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from modules import hash_cache
+from modules.util import HASH_SHA256_LENGTH
+
+
+class TestHashCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = hash_cache.HashCache(self.path('hash_cache.json'), self.path('hash_cache.txt'))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.temp_dir.name, name)
+
+    def write(self, name, content):
+        with open(self.path(name), 'wb') as f:
+            f.write(content)
+        return self.path(name)
+
+    @staticmethod
+    def expected(content):
+        return hashlib.sha256(content).hexdigest()[:HASH_SHA256_LENGTH]
+
+    def test_replaced_files_are_hashed_again(self):
+        filepath = self.write('model.safetensors', b'first' * 1000)
+        self.assertIsNone(self.cache.get(filepath))
+        self.assertEqual(self.expected(b'first' * 1000), self.cache.sha256(filepath))
+
+        with mock.patch.object(hash_cache, 'sha256', side_effect=AssertionError):
+            self.assertEqual(self.expected(b'first' * 1000), self.cache.sha256(filepath))
+
+        os.replace(self.write('new.safetensors', b'second' * 1000), filepath)
+        self.assertIsNone(self.cache.get(filepath))
+        self.assertEqual(self.expected(b'second' * 1000), self.cache.sha256(filepath))
+
+    def test_replaced_files_of_the_same_size_and_time_are_hashed_again(self):
+        filepath = self.write('model.safetensors', b'first' * 1000)
+        self.cache.sha256(filepath)
+        stat = os.stat(filepath)
+        # like cp -p or rsync, which keep the modification time
+        replacement = self.write('new.safetensors', b'other' * 1000)
+        os.utime(replacement, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(replacement, filepath)
+        self.assertEqual(self.expected(b'other' * 1000), self.cache.sha256(filepath))
+
+    def test_batches_save_once(self):
+        filepaths = [self.write(f'{i}.safetensors', bytes([i]) * 100) for i in range(5)]
+        with mock.patch.object(hash_cache.os, 'replace', wraps=os.replace) as replace:
+            for thread in self.cache.warm_up(filepaths, max_workers=1):
+                thread.join()
+            self.assertEqual(1, replace.call_count)
+
+            # nothing changed since
+            self.cache.save()
+            self.cache.sha256(filepaths[0])
+            self.assertEqual(1, replace.call_count)
+
+        loaded = hash_cache.HashCache(self.path('hash_cache.json'))
+        loaded.load()
+        self.assertEqual(self.cache.entries, loaded.entries)
+
+    def test_persistence_and_legacy_cache(self):
+        a = self.write('a.safetensors', b'a')
+        b = self.write('b.safetensors', b'b')
+        with open(self.path('hash_cache.txt'), 'w') as f:
+            for filepath, hash_value in [(a, 'a' * HASH_SHA256_LENGTH), (b, 'short'), (self.path('missing'), 'c' * 10)]:
+                json.dump({filepath: hash_value}, f)
+                f.write('\n')
+
+        self.cache.load()
+        self.assertEqual('a' * HASH_SHA256_LENGTH, self.cache.get(a))
+        self.assertIsNone(self.cache.get(b))
+        self.assertEqual(self.expected(b'b'), self.cache.sha256(b))
+
+        loaded = hash_cache.HashCache(self.path('hash_cache.json'))
+        loaded.load()
+        self.assertEqual(self.cache.entries, loaded.entries)
+        self.assertEqual(['hash_cache.json', 'hash_cache.txt'], sorted(f for f in os.listdir(self.temp_dir.name)
+                                                                      if f.startswith('hash_cache')))
+
+    def test_warm_up_hashes_every_file_once(self):
+        filepaths = [self.write(f'{i}.safetensors', bytes([i]) * 100) for i in range(6)]
+        self.cache.sha256(filepaths[0])
+        calls = []
+
+        def slow_sha256(filepath):
+            calls.append(filepath)
+            time.sleep(0.05)
+            with open(filepath, 'rb') as f:
+                return self.expected(f.read())
+
+        with mock.patch.object(hash_cache, 'sha256', side_effect=slow_sha256):
+            threads = self.cache.warm_up(filepaths, max_workers=3)
+            # asking for a hash that is being calculated waits for it
+            requests = [threading.Thread(target=self.cache.sha256, args=(filepath,)) for filepath in filepaths]
+            for thread in requests:
+                thread.start()
+            for thread in threads + requests:
+                thread.join()
+
+        self.assertEqual(3, len(threads))
+        self.assertEqual(sorted(filepaths[1:]), sorted(calls))
+        for i, filepath in enumerate(filepaths):
+            self.assertEqual(self.expected(bytes([i]) * 100), self.cache.get(filepath))
@@ -0,0 +1,82 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+import extras.inpaint_mask as inpaint_mask
+from extras.sam.predictor import SamPredictor
+from segment_anything.modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer
+
+
+def create_sam():
+    # the layout of SAM with a 64 pixel input and a single narrow transformer block everywhere
+    torch.manual_seed(0)
+    image_encoder = ImageEncoderViT(img_size=64, embed_dim=32, depth=1, num_heads=2, out_chans=16)
+    prompt_encoder = PromptEncoder(embed_dim=16, image_embedding_size=(4, 4), input_image_size=(64, 64),
+                                   mask_in_chans=4)
+    mask_decoder = MaskDecoder(transformer_dim=16, iou_head_hidden_dim=16,
+                               transformer=TwoWayTransformer(depth=1, embedding_dim=16, num_heads=2, mlp_dim=32))
+    return Sam(image_encoder, prompt_encoder, mask_decoder).eval()
+
+
+class TestInpaintMask(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.mask_models = mock.patch.object(inpaint_mask, 'mask_models', inpaint_mask.OrderedDict())
+        self.mask_models.start()
+
+    def tearDown(self):
+        self.mask_models.stop()
+
+    def test_rembg_sessions_are_reused(self):
+        image = self.rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)
+        with mock.patch.object(inpaint_mask, 'new_session', side_effect=lambda *args, **kwargs: object()) as new_session, \
+                mock.patch.object(inpaint_mask, 'remove', return_value=image) as remove:
+            for _ in range(2):
+                inpaint_mask.generate_mask_from_image(image, 'u2net', sam_options=None)
+                inpaint_mask.generate_mask_from_image(image, 'u2net_cloth_seg', {'cloth_category': 'full'}, None)
+
+            self.assertEqual([mock.call('u2net', ['CPUExecutionProvider']),
+                              mock.call('u2net_cloth_seg', ['CPUExecutionProvider'], cloth_category='full')],
+                             new_session.call_args_list)
+            sessions = [call.kwargs['session'] for call in remove.call_args_list]
+            self.assertEqual([sessions[0], sessions[1]] * 2, sessions)
+
+            # the least recently used session is dropped beyond mask_models_size
+            inpaint_mask.generate_mask_from_image(image, 'isnet-anime', sam_options=None)
+            inpaint_mask.generate_mask_from_image(image, 'u2net', sam_options=None)
+            self.assertEqual(4, new_session.call_count)
+
+    def test_sam_predictors_are_reused(self):
+        build_sam = mock.Mock(side_effect=lambda checkpoint: create_sam())
+        with mock.patch.dict(inpaint_mask.sam_model_registry, {'vit_b': build_sam}), \
+                mock.patch.object(inpaint_mask.modules.config, 'download_sam_model', return_value=None):
+            predictor = inpaint_mask.get_sam_predictor('vit_b')
+            self.assertIs(predictor, inpaint_mask.get_sam_predictor('vit_b'))
+            build_sam.assert_called_once_with(checkpoint=None)
+
+    def test_image_embeddings_are_reused(self):
+        predictor = SamPredictor(create_sam(), load_device=torch.device('cpu'), offload_device=torch.device('cpu'),
+                                 embeddings_size=2)
+        images = [self.rng.integers(0, 256, (48, 40, 3), dtype=np.uint8) for _ in range(3)]
+        box = torch.tensor([[4.0, 4.0, 30.0, 40.0]])
+
+        def predict(image):
+            predictor.set_image(image)
+            return predictor.predict_torch(None, None, boxes=predictor.transform.apply_boxes_torch(box, image.shape[:2]),
+                                           multimask_output=False, return_logits=True)[0]
+
+        with mock.patch.object(predictor.patcher.model.image_encoder, 'forward',
+                               wraps=predictor.patcher.model.image_encoder.forward) as encode:
+            expected = [predict(image) for image in images[:2]]
+            self.assertEqual(2, encode.call_count)
+            torch.testing.assert_close(expected[0], predict(images[0].copy()))
+            torch.testing.assert_close(expected[1], predict(images[1]))
+            self.assertEqual(2, encode.call_count)
+
+            predict(images[2])
+            predict(images[1])
+            self.assertEqual(3, encode.call_count)
+            torch.testing.assert_close(expected[0], predict(images[0]))
+            self.assertEqual(4, encode.call_count)
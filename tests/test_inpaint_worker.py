@@ -0,0 +1,107 @@
+import unittest
+
+import cv2
+import numpy as np
+from PIL import Image, ImageFilter
+
+import modules.inpaint_worker as inpaint_worker
+
+
+def reference_morphological_open(x):
+    x_int16 = np.zeros_like(x, dtype=np.int16)
+    x_int16[x > 127] = 256
+    for i in range(32):
+        maxed = cv2.dilate(x_int16, np.ones((3, 3), dtype=np.int16)) - 8
+        x_int16 = np.maximum(maxed, x_int16)
+    return np.clip(x_int16, 0, 255).astype(np.uint8)
+
+
+def reference_solve_abcd(x, a, b, c, d, k):
+    H, W = x.shape[:2]
+    if k == 1.0:
+        return 0, H, 0, W
+    while True:
+        if b - a >= H * k and d - c >= W * k:
+            break
+        add_h = (b - a) < (d - c)
+        add_w = not add_h
+        if b - a == H:
+            add_w = True
+        if d - c == W:
+            add_h = True
+        if add_h:
+            a -= 1
+            b += 1
+        if add_w:
+            c -= 1
+            d += 1
+        a, b, c, d = inpaint_worker.regulate_abcd(x, a, b, c, d)
+    return a, b, c, d
+
+
+def reference_fooocus_fill(image, mask):
+    current_image = image.copy()
+    area = np.where(mask < 127)
+    store = image[area]
+    for k, repeats in [(512, 2), (256, 2), (128, 4), (64, 4), (33, 8), (15, 8), (5, 16), (3, 16)]:
+        for _ in range(repeats):
+            current_image = np.array(Image.fromarray(current_image).filter(ImageFilter.BoxBlur(k)))
+            current_image[area] = store
+    return current_image
+
+
+class TestInpaintWorker(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def random_mask(self, H, W):
+        mask = np.zeros((H, W), dtype=np.uint8)
+        for _ in range(3):
+            y, x = self.rng.integers(0, H), self.rng.integers(0, W)
+            mask[y:y + self.rng.integers(1, H // 2 + 2), x:x + self.rng.integers(1, W // 2 + 2)] = self.rng.integers(100, 256)
+        return mask
+
+    def test_morphological_open(self):
+        for H, W in [(1, 1), (7, 90), (96, 64)]:
+            mask = self.random_mask(H, W)
+            np.testing.assert_array_equal(reference_morphological_open(mask), inpaint_worker.morphological_open(mask))
+        for value in [0, 255]:
+            mask = np.full((40, 30), value, dtype=np.uint8)
+            np.testing.assert_array_equal(reference_morphological_open(mask), inpaint_worker.morphological_open(mask))
+
+    def test_compute_initial_abcd(self):
+        mask = np.zeros((100, 80), dtype=bool)
+        mask[30:41, 50:56] = True
+        # the bounding box 30..40 x 50..55 as a square around its center, 1.15 times the larger half size
+        self.assertEqual((30, 41, 47, 58), inpaint_worker.compute_initial_abcd(mask))
+
+    def test_solve_abcd_matches_growing_one_pixel_at_a_time(self):
+        for H in range(1, 9):
+            for W in range(1, 9):
+                x = np.zeros((H, W), dtype=np.uint8)
+                for a in range(H):
+                    for b in range(a + 1, H + 1):
+                        for c in range(W):
+                            for d in range(c + 1, W + 1):
+                                for k in [0.0, 0.3, 0.618, 0.9, 1.0]:
+                                    self.assertEqual(reference_solve_abcd(x, a, b, c, d, k),
+                                                     inpaint_worker.solve_abcd(x, a, b, c, d, k),
+                                                     (H, W, a, b, c, d, k))
+
+    def test_fooocus_fill(self):
+        for (H, W), (a, b, c, d) in [((256, 320), (40, 200, 100, 180)), ((150, 90), (0, 150, 60, 90))]:
+            image = cv2.GaussianBlur(self.rng.integers(0, 256, (H, W, 3), dtype=np.uint8), (0, 0), 3)
+            mask = np.zeros((H, W), dtype=np.uint8)
+            mask[a:b, c:d] = 255
+            mask[a + 10:a + 20, c + 5:c + 15] = 0
+
+            filled = inpaint_worker.fooocus_fill(image, mask)
+            expected = reference_fooocus_fill(image, mask)
+            np.testing.assert_array_equal(image[mask < 127], filled[mask < 127])
+            # the box blur rounds once instead of after each direction
+            difference = np.abs(filled.astype(np.int16) - expected)
+            self.assertLessEqual(difference.max(), 2)
+            self.assertLess(difference.mean(), 0.1)
+
+        image = self.rng.integers(0, 256, (20, 30, 3), dtype=np.uint8)
+        np.testing.assert_array_equal(image, inpaint_worker.fooocus_fill(image, np.zeros((20, 30), dtype=np.uint8)))
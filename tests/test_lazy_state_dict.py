@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import safetensors.torch
+import torch
+
+import ldm_patched.modules.utils as utils
+
+
+class TestLazyStateDict(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.temp_dir.name, 'model.safetensors')
+        torch.manual_seed(0)
+        self.tensors = {
+            'model.0.weight': torch.randn(8, 4, dtype=torch.float16),
+            'model.0.bias': torch.randn(8, dtype=torch.float16),
+            'model.1.weight': torch.randn(2, 8, dtype=torch.bfloat16),
+            'other.scale': torch.tensor([3], dtype=torch.int64),
+            'other.empty': torch.zeros(0),
+        }
+        safetensors.torch.save_file(self.tensors, self.filename)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_reads_same_tensors_as_eager_loading(self):
+        lazy = utils.load_torch_file(self.filename, lazy=True)
+        eager = utils.load_torch_file(self.filename)
+        self.assertEqual(set(eager.keys()), set(lazy.keys()))
+        for k in eager:
+            self.assertEqual(eager[k].dtype, lazy[k].dtype)
+            self.assertTrue(torch.equal(eager[k], lazy[k]))
+
+    def test_shapes_and_parameters_without_reading(self):
+        lazy = utils.load_torch_file(self.filename, lazy=True)
+        self.assertEqual((2, 8), lazy.shape('model.1.weight'))
+        self.assertEqual(8 * 4 + 8 + 16, utils.calculate_parameters(lazy, 'model.'))
+
+    def test_prefix_replace_keeps_tensors_lazy(self):
+        lazy = utils.load_torch_file(self.filename, lazy=True)
+        out = utils.state_dict_prefix_replace(lazy, {'model.': ''}, filter_keys=True)
+        self.assertIsInstance(out, utils.LazyStateDict)
+        self.assertEqual({'0.weight', '0.bias', '1.weight'}, set(out.keys()))
+        self.assertEqual({'other.scale', 'other.empty'}, set(lazy.keys()))
+        self.assertTrue(all(isinstance(source, str) for source in out.sources.values()))
+        self.assertTrue(torch.equal(self.tensors['model.0.bias'], out['0.bias']))
+
+    def test_streaming_load_matches_load_state_dict(self):
+        expected = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.ReLU(), torch.nn.Linear(8, 3))
+        streamed = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.ReLU(), torch.nn.Linear(8, 3))
+
+        eager = utils.load_torch_file(self.filename)
+        expected.load_state_dict({'0.weight': eager['model.0.weight'], '0.bias': eager['model.0.bias']}, strict=False)
+
+        lazy = utils.state_dict_prefix_replace(utils.load_torch_file(self.filename, lazy=True), {'model.': ''},
+                                               filter_keys=True)
+        with self.assertRaises(RuntimeError):
+            utils.load_state_dict_streaming(torch.nn.Sequential(torch.nn.Linear(4, 9)), lazy)
+
+        lazy = utils.state_dict_prefix_replace(utils.load_torch_file(self.filename, lazy=True), {'model.0.': '0.'},
+                                               filter_keys=True)
+        lazy['unused'] = torch.zeros(1)
+        missing, unexpected = utils.load_state_dict_streaming(streamed, lazy)
+        self.assertEqual(['2.weight', '2.bias'], missing)
+        self.assertEqual(['unused'], unexpected)
+        self.assertEqual(['unused'], list(lazy.keys()))
+        for k in ['0.weight', '0.bias']:
+            self.assertTrue(torch.equal(expected.state_dict()[k], streamed.state_dict()[k]))
+
+    def test_reader_keeps_one_file_open(self):
+        reader = utils.SafetensorsReader(self.filename)
+        try:
+            with mock.patch('builtins.open') as open_file:
+                for k in self.tensors:
+                    self.assertTrue(torch.equal(self.tensors[k], reader.get_tensor(k)))
+                open_file.assert_not_called()
+        finally:
+            reader.close()
+        self.assertTrue(reader.file.closed)
+
+    def test_short_reads_raise(self):
+        reader = utils.SafetensorsReader(self.filename)
+        try:
+            # the file is cut after the reader checked its size
+            os.truncate(self.filename, os.path.getsize(self.filename) - 4)
+            last = max(reader.keys(), key=lambda k: reader.header[k]['data_offsets'][1])
+            with self.assertRaises(ValueError):
+                reader.get_tensor(last)
+        finally:
+            reader.close()
+        with self.assertRaises(ValueError):
+            utils.SafetensorsReader(self.filename)
@@ -0,0 +1,80 @@
+import unittest
+from unittest import mock
+
+import torch
+
+from ldm_patched.modules.model_patcher import ModelPatcher
+from modules.tensor_cache import TensorCache
+
+
+def lora_patches(model, rank=2):
+    patches = {}
+    for key, weight in model.state_dict().items():
+        if key.endswith('.weight'):
+            out_features, in_features = weight.shape
+            patches[key] = ('lora', (torch.randn(out_features, rank), torch.randn(rank, in_features), None, None))
+    return patches
+
+
+class TestLoraCache(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = torch.nn.Sequential(torch.nn.Linear(8, 6), torch.nn.Linear(6, 4))
+        self.original = {k: v.clone() for k, v in self.model.state_dict().items()}
+        self.patches = lora_patches(self.model)
+
+    def patcher(self, weight_cache=None):
+        patcher = ModelPatcher(self.model, load_device=torch.device('cpu'), offload_device=torch.device('cpu'))
+        patcher.add_patches(self.patches, 0.5)
+        patcher.weight_cache = weight_cache
+        patcher.weight_cache_key = ('checkpoint', 'unet', (('lora', 0.5),))
+        return patcher
+
+    def patched_weights(self, patcher):
+        patcher.patch_model()
+        weights = {k: v.clone() for k, v in self.model.state_dict().items()}
+        patcher.unpatch_model()
+        self.assert_weights_equal(self.original, self.model.state_dict())
+        return weights
+
+    def assert_weights_equal(self, expected, weights):
+        self.assertEqual(expected.keys(), weights.keys())
+        for k in expected:
+            torch.testing.assert_close(expected[k], weights[k], rtol=0, atol=0)
+
+    def test_patch_model_loads_the_merged_stack_from_the_cache(self):
+        expected = self.patched_weights(self.patcher())
+        cache = TensorCache('test', max_bytes=1 << 20)
+        patcher = self.patcher(cache)
+
+        with mock.patch.object(patcher, 'calculate_weight', wraps=patcher.calculate_weight) as calculate_weight:
+            self.assert_weights_equal(expected, self.patched_weights(patcher))
+            self.assertEqual(2, calculate_weight.call_count)
+            self.assertEqual(1, len(cache))
+
+            for _ in range(2):
+                self.assert_weights_equal(expected, self.patched_weights(patcher))
+            self.assertEqual(2, calculate_weight.call_count)
+            self.assertEqual(2, cache.stats()['hits'])
+
+        # the patched model does not share storage with the cache
+        cached = cache.get(patcher.weight_cache_key)
+        patcher.patch_model()
+        for key, weight in self.model.state_dict().items():
+            if key in cached:
+                self.assertNotEqual(cached[key].data_ptr(), weight.data_ptr())
+        patcher.unpatch_model()
+
+        # other patches are not described by the key
+        patcher.add_patches(lora_patches(self.model), 1.0)
+        self.assertIsNone(patcher.weight_cache_key)
+
+    def test_stacks_larger_than_the_cache_are_not_cached(self):
+        expected = self.patched_weights(self.patcher())
+        # the biases are not patched, one weight of the two fits
+        cache = TensorCache('test', max_bytes=6 * 8 * 4)
+        patcher = self.patcher(cache)
+        for _ in range(2):
+            self.assert_weights_equal(expected, self.patched_weights(patcher))
+        self.assertEqual(0, len(cache))
+        self.assertEqual(2, cache.stats()['misses'])
@@ -0,0 +1,95 @@
+import unittest
+
+from modules.model_pool import ModelPool
+
+
+class FakeUnet:
+    def __init__(self, size):
+        self.size = size
+
+    def model_size(self):
+        return self.size
+
+
+class FakeModel:
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.unet = FakeUnet(size)
+        self.clip = None
+        self.vae = None
+
+
+class TestModelPool(unittest.TestCase):
+    def create_pool(self, **kwargs):
+        self.loaded = []
+
+        def loader(filename, vae_filename=None, role='base'):
+            self.loaded.append(filename)
+            return FakeModel(filename, 100)
+
+        return ModelPool(loader, **kwargs)
+
+    def test_reuses_loaded_models(self):
+        pool = self.create_pool(max_models=2)
+        a = pool.get('a')
+        pool.get('b')
+        self.assertIs(a, pool.get('a'))
+        self.assertEqual(['a', 'b'], self.loaded)
+        stats = pool.stats()
+        self.assertEqual((1, 2, 0), (stats['hits'], stats['misses'], stats['evictions']))
+
+    def test_evicts_least_recently_used(self):
+        pool = self.create_pool(max_models=2)
+        pool.get('a')
+        pool.get('b')
+        pool.get('a')
+        pool.get('c')
+        self.assertEqual(['a', 'c'], pool.stats()['models'])
+        pool.get('b')
+        self.assertEqual(['a', 'b', 'c', 'b'], self.loaded)
+
+    def test_memory_budget(self):
+        pool = self.create_pool(max_models=10, max_bytes=250)
+        for name in ['a', 'b', 'c', 'd']:
+            pool.get(name)
+        self.assertEqual(['c', 'd'], pool.stats()['models'])
+        self.assertEqual(200, pool.stats()['bytes'])
+
+    def test_keeps_most_recent_model_over_budget(self):
+        pool = self.create_pool(max_models=2, max_bytes=50)
+        pool.get('a')
+        pool.get('b')
+        self.assertEqual(['b'], pool.stats()['models'])
+
+    def test_vae_is_part_of_key(self):
+        pool = self.create_pool(max_models=3)
+        pool.get('a')
+        pool.get('a', 'vae')
+        self.assertEqual(2, len(pool))
+
+    def test_role_is_part_of_key(self):
+        pool = self.create_pool(max_models=3)
+        base = pool.get('a')
+        refiner = pool.get('a', role='refiner')
+        self.assertIsNot(base, refiner)
+        self.assertIs(refiner, pool.get('a', role='refiner'))
+        self.assertEqual(['a', 'a'], self.loaded)
+
+    def test_models_in_use_are_kept(self):
+        pool = self.create_pool(max_models=2)
+        # a refiner is loaded before the base model, and the base model switched while the refiner stays
+        refiner = ('r', None, 'refiner')
+        pool.get('r', role='refiner')
+        pool.get('a')
+        pool.touch('r', role='refiner')
+        pool.get('b', keep=[refiner])
+        self.assertEqual(['r', 'b'], pool.stats()['models'])
+
+        # without touching it, the refiner would be the least recently used
+        pool.get('c', keep=[refiner])
+        self.assertEqual(['r', 'c'], pool.stats()['models'])
+        self.assertEqual(['r', 'a', 'b', 'c'], self.loaded)
+
+        # the pool goes over its size rather than evicting models in use
+        pool.get('d', keep=[refiner, ('c', None, 'base')])
+        self.assertEqual(['r', 'c', 'd'], pool.stats()['models'])
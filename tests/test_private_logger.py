@@ -0,0 +1,85 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import modules.config
+import modules.private_logger as private_logger
+
+
+class TestOutputWriter(unittest.TestCase):
+    def test_backpressure_and_wait(self):
+        writer = private_logger.OutputWriter(max_workers=1, max_pending=1)
+        release = threading.Event()
+        written = []
+
+        def write(name):
+            release.wait()
+            written.append(name)
+
+        writer.submit_image('a', write, 'a')
+        submitted = threading.Event()
+        thread = threading.Thread(target=lambda: (writer.submit_image('b', write, 'b'), submitted.set()))
+        thread.start()
+        self.assertFalse(submitted.wait(0.2))
+
+        release.set()
+        thread.join()
+        writer.wait(['b'])
+        self.assertEqual(['a', 'b'], written)
+        writer.shutdown()
+
+    def test_synchronous_writer(self):
+        writer = private_logger.OutputWriter(max_workers=0)
+        written = []
+        writer.submit_image('a', written.append, 'a')
+        writer.submit_log(written.append, 'log')
+        self.assertEqual(['a', 'log'], written)
+
+
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(modules.config, 'path_outputs', self.temp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.temp_dir.cleanup)
+        self.addCleanup(private_logger.html_logs.clear)
+
+    def log(self, value):
+        img = np.full((8, 8, 3), value, dtype=np.uint8)
+        return private_logger.log(img, [('Seed', 'seed', str(value))], output_format='png')
+
+    def test_images_and_entries_are_appended_in_order(self):
+        paths = [self.log(i) for i in range(3)]
+        private_logger.output_writer.wait()
+
+        self.assertTrue(all(os.path.exists(p) for p in paths))
+        with open(os.path.join(os.path.dirname(paths[0]), 'log.html'), encoding='utf-8') as f:
+            content = f.read()
+        self.assertEqual(1, content.count('<!DOCTYPE html>'))
+        positions = [content.index(os.path.basename(p)) for p in paths]
+        self.assertEqual(sorted(positions), positions)
+
+    def test_converts_log_of_older_version(self):
+        date_string, filename, _ = private_logger.generate_temp_filename(folder=self.temp_dir.name)
+        html_name = os.path.join(os.path.dirname(filename), 'log.html')
+        os.makedirs(os.path.dirname(html_name))
+        with open(html_name, 'w', encoding='utf-8') as f:
+            f.write('<html><!--fooocus-log-split-->\n\n<div>old entry</div><!--fooocus-log-split--></body></html>')
+
+        path = self.log(1)
+        private_logger.output_writer.wait()
+
+        with open(html_name, encoding='utf-8') as f:
+            content = f.read()
+        self.assertIn(private_logger.html_log_marker, content)
+        self.assertNotIn('fooocus-log-split', content)
+        self.assertLess(content.index('old entry'), content.index(os.path.basename(path)))
+
+
+if __name__ == '__main__':
+    unittest.main()
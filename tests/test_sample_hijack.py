@@ -0,0 +1,91 @@
+import unittest
+from unittest import mock
+
+import torch
+
+import ldm_patched.modules.samplers
+from ldm_patched.modules.model_sampling import ModelSamplingDiscrete, EPS
+from ldm_patched.k_diffusion import sampling as k_diffusion_sampling
+from modules.patch_precision import patched_register_schedule
+from modules.sample_hijack import get_diffusion_progress
+
+
+class ModelSampling(ModelSamplingDiscrete, EPS):
+    pass
+
+
+class Model:
+    def __init__(self):
+        # the schedule Fooocus samples with
+        with mock.patch.object(ModelSamplingDiscrete, '_register_schedule', patched_register_schedule):
+            self.model_sampling = ModelSampling()
+
+
+class ProgressRecorder(torch.nn.Module):
+    # stands in for the wrapped UNet, records the progress it is given next to the one of the sigma it is called with
+    def __init__(self, model):
+        super().__init__()
+        self.inner_model = model
+        self.progress = []
+
+    def forward(self, x, sigma, cond, uncond, cond_scale, model_options={}, seed=None):
+        timestep_progress = 1.0 - float(self.inner_model.model_sampling.timestep(sigma)[0]) / 999.0
+        progress = model_options['transformer_options'].get('diffusion_progress', timestep_progress)
+        self.progress.append((progress, timestep_progress))
+        return x * 0.5
+
+
+class TestDiffusionProgress(unittest.TestCase):
+    def setUp(self):
+        self.model = Model()
+        s = self.model.model_sampling
+        self.sigmas = k_diffusion_sampling.get_sigmas_karras(8, float(s.sigma_min), float(s.sigma_max))
+
+    def sample(self, sampler_name):
+        # sets the progress from the callback the way sample_hacked does
+        sampler = ldm_patched.modules.samplers.sampler_object(sampler_name)
+        diffusion_progress = get_diffusion_progress(self.model, sampler, self.sigmas)
+        transformer_options = {}
+        if diffusion_progress is not None:
+            transformer_options['diffusion_progress'] = diffusion_progress[0]
+        steps = []
+
+        def callback(step, x0, x, total_steps):
+            steps.append(step)
+            if diffusion_progress is not None and step + 1 < len(diffusion_progress):
+                transformer_options['diffusion_progress'] = diffusion_progress[step + 1]
+
+        model_wrap = ProgressRecorder(self.model)
+        extra_args = {'cond': None, 'uncond': None, 'cond_scale': 1.0, 'seed': 0,
+                      'model_options': {'transformer_options': transformer_options}}
+        torch.manual_seed(0)
+        sampler.sample(model_wrap, self.sigmas, extra_args, callback, torch.randn(1, 4, 8, 8), disable_pbar=True)
+        return diffusion_progress, steps, model_wrap.progress
+
+    def assert_progress_of_evaluated_sigmas(self, sampler_name, progress):
+        self.assertGreater(len(progress), 0)
+        for given, expected in progress:
+            self.assertAlmostEqual(expected, given, places=4, msg=sampler_name)
+
+    def test_progress_is_the_one_of_the_evaluated_sigma(self):
+        for sampler_name in ldm_patched.modules.samplers.SAMPLER_NAMES:
+            if sampler_name == 'edm_playground_v2.5':
+                # a scheduler, not a sampler
+                continue
+            diffusion_progress, steps, progress = self.sample(sampler_name)
+            own_sigmas = sampler_name in ldm_patched.modules.samplers.KSAMPLERS_WITH_SIGMAS_OF_THEIR_OWN
+            self.assertEqual(own_sigmas, diffusion_progress is None, sampler_name)
+            self.assert_progress_of_evaluated_sigmas(sampler_name, progress)
+
+    def test_restart_calls_the_model_with_sigmas_of_its_own(self):
+        s = self.model.model_sampling
+        self.sigmas = k_diffusion_sampling.get_sigmas_karras(24, float(s.sigma_min), float(s.sigma_max))
+        diffusion_progress, steps, progress = self.sample('restart')
+        self.assertIsNone(diffusion_progress)
+        schedule = (1.0 - s.timestep(self.sigmas) / 999.0).tolist()
+        self.assertTrue(any(min(abs(expected - p) for p in schedule) > 1e-3 for _, expected in progress))
+        self.assert_progress_of_evaluated_sigmas('restart', progress)
+
+
+if __name__ == '__main__':
+    unittest.main()
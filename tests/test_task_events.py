@@ -0,0 +1,61 @@
+import copy
+import threading
+import unittest
+
+from modules.task_events import TaskEvents, PreviewLimiter
+
+
+class TestTaskEvents(unittest.TestCase):
+    def test_events_in_order(self):
+        events = TaskEvents()
+        events.append(['preview', (1, 'a', None)])
+        events.append(['results', ['x']])
+        events.append(['finish', ['x']])
+        self.assertEqual(['preview', 'results', 'finish'], [events.get()[0] for _ in range(3)])
+        self.assertIsNone(events.get(timeout=0))
+
+    def test_previews_are_coalesced(self):
+        events = TaskEvents()
+        events.append(['preview', (1, 'step 1', 'image 1')])
+        events.append(['preview', (2, 'step 2', None)])
+        events.append(['preview', (3, 'step 3', None)])
+        self.assertEqual(1, len(events))
+        self.assertEqual(['preview', (3, 'step 3', 'image 1')], events.get())
+
+    def test_results_are_coalesced(self):
+        events = TaskEvents()
+        events.append(['results', ['a']])
+        events.append(['results', ['a', 'b']])
+        events.append(['finish', ['a', 'b']])
+        self.assertEqual(['results', ['a', 'b']], events.get())
+        self.assertEqual('finish', events.get()[0])
+
+    def test_full_channel_drops_oldest_preview_but_not_finish(self):
+        events = TaskEvents(max_size=2, put_timeout=0.01)
+        events.append(['preview', (1, 'a', None)])
+        events.append(['results', ['a']])
+        events.append(['preview', (2, 'b', None)])
+        events.append(['finish', ['a']])
+        self.assertEqual(['results', 'finish'], [events.get()[0] for _ in range(2)])
+        self.assertIsNone(events.get(timeout=0))
+
+    def test_get_wakes_on_append(self):
+        events = TaskEvents()
+        received = []
+        consumer = threading.Thread(target=lambda: received.append(events.get(timeout=5)))
+        consumer.start()
+        events.append(['finish', []])
+        consumer.join(timeout=5)
+        self.assertEqual([['finish', []]], received)
+
+    def test_deepcopy_creates_empty_channel(self):
+        events = TaskEvents()
+        events.append(['finish', []])
+        self.assertEqual(0, len(copy.deepcopy(events)))
+
+    def test_preview_limiter(self):
+        limiter = PreviewLimiter(interval=60)
+        self.assertTrue(limiter(0, 10))
+        self.assertFalse(limiter(1, 10))
+        self.assertTrue(limiter(9, 10))
+        self.assertTrue(PreviewLimiter(interval=0)(1, 10))
@@ -0,0 +1,89 @@
+import threading
+import unittest
+
+from modules.task_scheduler import TaskScheduler
+
+
+class DummyTask:
+    def __init__(self, name, client_id=None, priority=0):
+        self.name = name
+        self.client_id = client_id
+        self.priority = priority
+
+
+class TestTaskScheduler(unittest.TestCase):
+    def drain(self, scheduler):
+        names = []
+        while len(scheduler) > 0:
+            task = scheduler.get(timeout=0)
+            names.append(task.name)
+            scheduler.task_done(task)
+        return names
+
+    def test_fifo_for_single_client(self):
+        scheduler = TaskScheduler()
+        for name in ['a', 'b', 'c']:
+            scheduler.put(DummyTask(name))
+        self.assertEqual(['a', 'b', 'c'], self.drain(scheduler))
+
+    def test_round_robin_between_clients(self):
+        scheduler = TaskScheduler()
+        for name in ['a1', 'a2', 'a3']:
+            scheduler.put(DummyTask(name, client_id='a'))
+        for name in ['b1', 'b2']:
+            scheduler.put(DummyTask(name, client_id='b'))
+        self.assertEqual(['a1', 'b1', 'a2', 'b2', 'a3'], self.drain(scheduler))
+
+    def test_priority_before_fairness(self):
+        scheduler = TaskScheduler()
+        scheduler.put(DummyTask('low', client_id='a'))
+        scheduler.put(DummyTask('high', client_id='b', priority=5))
+        scheduler.put(DummyTask('override', client_id='a'), priority=10)
+        self.assertEqual(['override', 'high', 'low'], self.drain(scheduler))
+
+    def test_cancel_pending_task(self):
+        scheduler = TaskScheduler()
+        keep, drop = DummyTask('keep'), DummyTask('drop')
+        scheduler.put(keep)
+        scheduler.put(drop)
+        self.assertTrue(scheduler.cancel(drop))
+        self.assertFalse(scheduler.cancel(drop))
+        self.assertEqual(['keep'], self.drain(scheduler))
+        self.assertEqual(1, scheduler.stats()['cancelled'])
+
+    def test_get_blocks_until_put(self):
+        scheduler = TaskScheduler()
+        self.assertIsNone(scheduler.get(timeout=0.01))
+
+        received = []
+        consumer = threading.Thread(target=lambda: received.append(scheduler.get(timeout=5)))
+        consumer.start()
+        task = DummyTask('a')
+        scheduler.put(task)
+        consumer.join(timeout=5)
+        self.assertEqual([task], received)
+
+    def test_shutdown_wakes_consumers(self):
+        scheduler = TaskScheduler()
+        results = []
+        consumers = [threading.Thread(target=lambda: results.append(scheduler.get())) for _ in range(3)]
+        for consumer in consumers:
+            consumer.start()
+        scheduler.shutdown()
+        for consumer in consumers:
+            consumer.join(timeout=5)
+        self.assertEqual([None, None, None], results)
+
+    def test_stats(self):
+        scheduler = TaskScheduler()
+        scheduler.put(DummyTask('a'))
+        scheduler.put(DummyTask('b'))
+        self.assertEqual(2, scheduler.stats()['queue_depth'])
+        task = scheduler.get()
+        self.assertEqual(1, scheduler.stats()['running'])
+        scheduler.task_done(task)
+        stats = scheduler.stats()
+        self.assertEqual(1, stats['queue_depth'])
+        self.assertEqual(1, stats['completed'])
+        self.assertEqual(2, stats['submitted'])
+        self.assertGreaterEqual(stats['max_wait_time'], 0.0)
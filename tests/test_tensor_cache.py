@@ -0,0 +1,52 @@
+import tempfile
+import unittest
+
+import torch
+
+from modules.tensor_cache import TensorCache
+
+
+class TestTensorCache(unittest.TestCase):
+    def test_lru_eviction_by_bytes(self):
+        cache = TensorCache('test', max_bytes=3 * 400)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, torch.zeros(100))
+        cache.get('a')
+        cache.put('d', torch.zeros(100))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(3 * 400, cache.stats()['bytes'])
+
+    def test_too_large_value_is_not_cached(self):
+        cache = TensorCache('test', max_bytes=100)
+        cache.put('a', torch.zeros(100))
+        self.assertEqual(0, len(cache))
+
+    def test_nested_values_and_counters(self):
+        cache = TensorCache('test', max_bytes=1 << 20)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', [[torch.ones(4), {'pooled_output': torch.ones(2)}]])
+        value = cache.get('a')
+        self.assertTrue(torch.equal(torch.ones(2), value[0][1]['pooled_output']))
+        stats = cache.stats()
+        self.assertEqual((1, 1), (stats['hits'], stats['misses']))
+        self.assertEqual(6 * 4, stats['bytes'])
+
+    def test_disk_store_survives_restart(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = TensorCache('test', max_bytes=1 << 20, disk_path=path, max_disk_bytes=1 << 20)
+            cache.put(('model', 'key'), torch.arange(10))
+
+            restarted = TensorCache('test', max_bytes=1 << 20, disk_path=path, max_disk_bytes=1 << 20)
+            self.assertTrue(torch.equal(torch.arange(10), restarted.get(('model', 'key'))))
+            self.assertEqual(1, restarted.stats()['disk_hits'])
+
+    def test_disk_budget(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = TensorCache('test', max_bytes=1 << 20, disk_path=path, max_disk_bytes=10000)
+            for i in range(5):
+                cache.put(i, torch.zeros(1000))
+            stats = cache.stats()
+            self.assertLessEqual(stats['disk_bytes'], 10000)
+            self.assertIn(stats['disk_entries'], [1, 2])
+            self.assertIsNotNone(TensorCache('test', 0, disk_path=path, max_disk_bytes=10000).get(4))
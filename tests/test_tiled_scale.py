@@ -0,0 +1,72 @@
+import unittest
+
+import torch
+
+import ldm_patched.modules.utils as utils
+
+
+def reference_tiled_scale(samples, function, tile_x=64, tile_y=64, overlap=8, upscale_amount=4, out_channels=3):
+    # one tile at a time with per tile feather masks, as tiled_scale used to work
+    output = torch.empty((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)))
+    for b in range(samples.shape[0]):
+        s = samples[b:b+1]
+        out = torch.zeros((1, out_channels, output.shape[2], output.shape[3]))
+        out_div = torch.zeros_like(out)
+        for y in range(0, s.shape[2], tile_y - overlap):
+            for x in range(0, s.shape[3], tile_x - overlap):
+                ps = function(s[:, :, y:y+tile_y, x:x+tile_x])
+                mask = torch.ones_like(ps)
+                feather = round(overlap * upscale_amount)
+                for t in range(feather):
+                    mask[:, :, t:1+t, :] *= ((1.0 / feather) * (t + 1))
+                    mask[:, :, mask.shape[2]-1-t:mask.shape[2]-t, :] *= ((1.0 / feather) * (t + 1))
+                    mask[:, :, :, t:1+t] *= ((1.0 / feather) * (t + 1))
+                    mask[:, :, :, mask.shape[3]-1-t:mask.shape[3]-t] *= ((1.0 / feather) * (t + 1))
+                out[:, :, round(y*upscale_amount):round((y+tile_y)*upscale_amount), round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += ps * mask
+                out_div[:, :, round(y*upscale_amount):round((y+tile_y)*upscale_amount), round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += mask
+        output[b:b+1] = out / out_div
+    return output
+
+
+class TestTiledScale(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.upscale = torch.nn.Sequential(torch.nn.Conv2d(4, 3 * 16, 3, padding=1), torch.nn.PixelShuffle(4))
+        self.downscale = torch.nn.Conv2d(3, 4, 8, stride=8)
+
+    def test_matches_reference_when_upscaling(self):
+        samples = torch.randn(2, 4, 37, 53)
+        calls = []
+
+        def function(x):
+            calls.append(x.shape[0])
+            return self.upscale(x)
+
+        expected = reference_tiled_scale(samples, self.upscale, 16, 24, 4, 4, 3)
+        for max_batch_size in [1, 3, 100]:
+            calls.clear()
+            actual = utils.tiled_scale(samples, function, 16, 24, 4, 4, 3, max_batch_size=max_batch_size)
+            self.assertTrue(torch.allclose(expected, actual, atol=1e-5))
+            self.assertLessEqual(max(calls), max_batch_size)
+        # 3 x 4 tiles of 4 different shapes for 2 images
+        self.assertEqual(4, len(calls))
+
+    def test_matches_reference_when_downscaling(self):
+        samples = torch.randn(1, 3, 200, 136)
+        expected = reference_tiled_scale(samples, self.downscale, 64, 64, 16, 1 / 8, 4)
+        actual = utils.tiled_scale(samples, self.downscale, 64, 64, 16, 1 / 8, 4, max_batch_size=4)
+        self.assertTrue(torch.allclose(expected, actual, atol=1e-5))
+
+    def test_feather_mask(self):
+        for height, width, feather in [(10, 7, 3), (4, 4, 3), (5, 9, 0)]:
+            mask = torch.ones(height, width)
+            for t in range(feather):
+                mask[t:1+t, :] *= ((1.0 / feather) * (t + 1))
+                mask[height-1-t:height-t, :] *= ((1.0 / feather) * (t + 1))
+                mask[:, t:1+t] *= ((1.0 / feather) * (t + 1))
+                mask[:, width-1-t:width-t] *= ((1.0 / feather) * (t + 1))
+            self.assertTrue(torch.allclose(mask, utils.tiled_feather_mask(height, width, feather)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+import ldm_patched.modules.model_management as model_management
+import modules.upscaler as upscaler
+
+
+def create_esrgan_state_dict(num_filters=8, growth=32):
+    # one residual block in the new ESRGAN layout, RRDBNet converts it
+    generator = torch.Generator().manual_seed(0)
+    shapes = {'conv_first': (num_filters, 3), 'trunk_conv': (num_filters, num_filters),
+              'upconv1': (num_filters, num_filters), 'upconv2': (num_filters, num_filters),
+              'HRconv': (num_filters, num_filters), 'conv_last': (3, num_filters)}
+    for r in range(1, 4):
+        for j in range(1, 6):
+            shapes[f'RRDB_trunk.0.RDB{r}.conv{j}'] = (growth if j < 5 else num_filters, num_filters + (j - 1) * growth)
+    state_dict = {}
+    for name, (out_channels, in_channels) in shapes.items():
+        state_dict[f'{name}.weight'] = torch.randn((out_channels, in_channels, 3, 3), generator=generator) / (in_channels * 9) ** 0.5
+        state_dict[f'{name}.bias'] = torch.full((out_channels,), 0.5 if name == 'conv_last' else 0.0)
+    return state_dict
+
+
+class TestUpscaler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.upscaler = upscaler.Upscaler(create_esrgan_state_dict())
+        cls.image = np.random.default_rng(0).integers(0, 256, (50, 70, 3), dtype=np.uint8)
+
+    def expected(self, image):
+        with torch.no_grad():
+            x = torch.from_numpy(image.astype(np.float32) / 255.0).movedim(-1, 0)[None]
+            y = self.upscaler.model(x).clamp(0, 1)
+        return (255.0 * y[0].movedim(0, -1).numpy()).astype(np.uint8)
+
+    def test_upscale_in_one_tile(self):
+        with mock.patch.object(model_management, 'load_models_gpu') as load_models_gpu:
+            result = self.upscaler.upscale(self.image)
+        load_models_gpu.assert_called_once()
+        self.assertEqual([self.upscaler.patcher], load_models_gpu.call_args.args[0])
+        self.assertEqual((200, 280, 3), result.shape)
+        self.assertLessEqual(np.abs(result.astype(np.int16) - self.expected(self.image)).max(), 1.0)
+
+    def test_tile_size_from_free_memory(self):
+        per_tile = self.upscaler.memory_per_tile
+        self.assertEqual((512, 3), self.upscaler.tile_size_and_batch_size(per_tile(512) * 3.5))
+        self.assertEqual((256, 2), self.upscaler.tile_size_and_batch_size(per_tile(256) * 2))
+        self.assertEqual((128, 1), self.upscaler.tile_size_and_batch_size(per_tile(128) / 2))
+
+    def test_out_of_memory_halves_the_tile_size(self):
+        tiles = []
+        upscale_tiles = self.upscaler.upscale_tiles
+
+        def run_out_of_memory(samples, tile, batch_size):
+            tiles.append(tile)
+            if tile > 128:
+                raise model_management.OOM_EXCEPTION('out of memory')
+            return upscale_tiles(samples, tile, batch_size)
+
+        with mock.patch.object(model_management, 'load_models_gpu'), \
+                mock.patch.object(model_management, 'get_free_memory', return_value=10 ** 12), \
+                mock.patch.object(self.upscaler, 'upscale_tiles', side_effect=run_out_of_memory):
+            result = self.upscaler.upscale(self.image)
+        self.assertEqual([512, 256, 128], tiles)
+        self.assertLessEqual(np.abs(result.astype(np.int16) - self.expected(self.image)).max(), 1.0)
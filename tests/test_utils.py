@@ -1,6 +1,12 @@
 import os
+import random
+import re
+import tempfile
+import time
 import unittest
+from unittest import mock
 
+import modules.config
 import modules.flags
 from modules import util
 
@@ -135,3 +141,77 @@ class TestUtils(unittest.TestCase):
             expected = test["output"]
             actual = util.parse_lora_references_from_prompt(prompt, loras, loras_limit=loras_limit, lora_filenames=lora_filenames)
             self.assertEqual(expected, actual)
+
+
+def reference_apply_wildcards(wildcard_text, rng, i, read_wildcards_in_order):
+    # reads the wildcard file for every placeholder, as apply_wildcards used to work
+    for _ in range(modules.config.wildcards_max_bfs_depth):
+        placeholders = re.findall(r'__([\w-]+)__', wildcard_text)
+        if len(placeholders) == 0:
+            return wildcard_text
+        for placeholder in placeholders:
+            try:
+                matches = [x for x in modules.config.wildcard_filenames if os.path.splitext(os.path.basename(x))[0] == placeholder]
+                words = open(os.path.join(modules.config.path_wildcards, matches[0]), encoding='utf-8').read().splitlines()
+                words = [x for x in words if x != '']
+                assert len(words) > 0
+                if read_wildcards_in_order:
+                    wildcard_text = wildcard_text.replace(f'__{placeholder}__', words[i % len(words)], 1)
+                else:
+                    wildcard_text = wildcard_text.replace(f'__{placeholder}__', rng.choice(words), 1)
+            except:
+                wildcard_text = wildcard_text.replace(f'__{placeholder}__', placeholder)
+    return wildcard_text
+
+
+class TestWildcards(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.write('color', 'red\n\nblue\ngreen\n__shade__ gray\n')
+        self.write('shade', 'light\ndark\n')
+        self.write('animal', 'cat\n__color__ dog\n__color__ __animal__\n')
+        self.write('empty', '\n')
+        os.makedirs(os.path.join(self.temp_dir.name, 'more'))
+        self.write(os.path.join('more', 'color'), 'purple\n')
+        self.patches = [
+            mock.patch.object(modules.config, 'path_wildcards', self.temp_dir.name),
+            mock.patch.object(modules.config, 'wildcard_filenames',
+                              ['animal.txt', 'color.txt', 'empty.txt', os.path.join('more', 'color.txt'), 'shade.txt']),
+            mock.patch.object(modules.config, 'wildcards_max_bfs_depth', 8),
+            mock.patch.object(util, 'wildcard_index', util.WildcardIndex()),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.temp_dir.cleanup()
+
+    def write(self, name, text):
+        with open(os.path.join(self.temp_dir.name, name + '.txt'), 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def test_same_results_as_reading_files(self):
+        prompts = ['a __animal__ in __color__, __color__ sky', '__missing__ and __empty__ __missing__',
+                   '__animal__ __animal__ __shade__', 'no wildcards']
+        for read_in_order in [False, True]:
+            for seed in range(20):
+                for prompt in prompts:
+                    expected = reference_apply_wildcards(prompt, random.Random(seed), seed, read_in_order)
+                    actual = util.apply_wildcards(prompt, random.Random(seed), seed, read_in_order)
+                    self.assertEqual(expected, actual)
+
+    def test_reads_files_once_and_again_after_changes(self):
+        with mock.patch('builtins.open', wraps=open) as opened:
+            self.assertEqual('red', util.apply_wildcards('__color__', random.Random(), 0, True))
+            self.assertEqual('blue', util.apply_wildcards('__color__', random.Random(), 1, True))
+            self.assertEqual(1, opened.call_count)
+
+        self.write('color', 'yellow\n')
+        path = os.path.join(self.temp_dir.name, 'color.txt')
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns + 1000000))
+        self.assertEqual('yellow', util.apply_wildcards('__color__', random.Random(), 1, True))
+
+        with mock.patch.object(modules.config, 'wildcard_filenames', ['shade.txt']):
+            self.assertEqual('color', util.apply_wildcards('__color__', random.Random(), 0, True))
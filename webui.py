@@ -19,7 +19,7 @@ import launch
 from extras.inpaint_mask import SAMOptions
 
 from modules.sdxl_styles import legal_style_names
-from modules.private_logger import build_outputs_browser_html, get_current_html_path
+from modules.private_logger import build_outputs_browser_html, get_current_html_path, output_writer
 from modules.ui_gradio_extensions import reload_javascript
 from modules.auth import auth_enabled, check_auth
 from modules.util import is_json
@@ -30,7 +30,7 @@ def get_task(*args):
 
     return worker.AsyncTask(args=args)
 
-def generate_clicked(task: worker.AsyncTask):
+def generate_clicked(task: worker.AsyncTask, request: gr.Request):
     import ldm_patched.modules.model_management as model_management
 
     with model_management.interrupt_processing_mutex:
@@ -48,45 +48,41 @@ def generate_clicked(task: worker.AsyncTask):
         gr.update(visible=False, value=None), \
         gr.update(visible=False)
 
-    worker.async_tasks.append(task)
+    task.client_id = request.session_hash if request is not None else None
+    worker.async_tasks.put(task)
 
     while not finished:
-        time.sleep(0.01)
-        if len(task.yields) > 0:
-            flag, product = task.yields.pop(0)
-            if flag == 'preview':
-
-                # help bad internet connection by skipping duplicated preview
-                if len(task.yields) > 0:  # if we have the next item
-                    if task.yields[0][0] == 'preview':   # if the next item is also a preview
-                        # print('Skipped one preview for better internet connection.')
-                        continue
-
-                percentage, title, image = product
-                yield gr.update(visible=True, value=modules.html.make_progress_html(percentage, title)), \
-                    gr.update(visible=True, value=image) if image is not None else gr.update(), \
-                    gr.update(), \
-                    gr.update(visible=False)
-            if flag == 'results':
-                yield gr.update(visible=True), \
-                    gr.update(visible=True), \
-                    gr.update(visible=True, value=product), \
-                    gr.update(visible=False)
-            if flag == 'finish':
-                if not args_manager.args.disable_enhance_output_sorting:
-                    product = sort_enhance_images(product, task)
-
-                yield gr.update(visible=False), \
-                    gr.update(visible=False), \
-                    gr.update(visible=False), \
-                    gr.update(visible=True, value=product)
-                finished = True
-
-                # delete Fooocus temp images, only keep gradio temp images
-                if args_manager.args.disable_image_log:
-                    for filepath in product:
-                        if isinstance(filepath, str) and os.path.exists(filepath):
-                            os.remove(filepath)
+        # blocks until the worker publishes something, stale previews are coalesced by the channel
+        flag, product = task.yields.get()
+        if flag == 'preview':
+            percentage, title, image = product
+            yield gr.update(visible=True, value=modules.html.make_progress_html(percentage, title)), \
+                gr.update(visible=True, value=image) if image is not None else gr.update(), \
+                gr.update(), \
+                gr.update(visible=False)
+        if flag == 'results':
+            # images are saved in the background, the gallery needs them on disk
+            output_writer.wait(product)
+            yield gr.update(visible=True), \
+                gr.update(visible=True), \
+                gr.update(visible=True, value=product), \
+                gr.update(visible=False)
+        if flag == 'finish':
+            output_writer.wait(product)
+            if not args_manager.args.disable_enhance_output_sorting:
+                product = sort_enhance_images(product, task)
+
+            yield gr.update(visible=False), \
+                gr.update(visible=False), \
+                gr.update(visible=False), \
+                gr.update(visible=True, value=product)
+            finished = True
+
+            # delete Fooocus temp images, only keep gradio temp images
+            if args_manager.args.disable_image_log:
+                for filepath in product:
+                    if isinstance(filepath, str) and os.path.exists(filepath):
+                        os.remove(filepath)
 
     execution_time = time.perf_counter() - execution_start_time
     print(f'Total time: {execution_time:.2f} seconds')
@@ -188,6 +184,8 @@ with shared.gradio_root:
                         currentTask.last_stop = 'stop'
                         if (currentTask.processing):
                             model_management.interrupt_current_processing()
+                        elif worker.async_tasks.cancel(currentTask):
+                            currentTask.yields.append(['finish', currentTask.results])
                         return currentTask
 
                     def skip_clicked(currentTask):